@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import datetime
+import numpy as np
+import scipy
+import pandas as pd
+import mne
+import moabb
+import download_all_datasets as pipeline
+from stages import StageRecorder, STAGES
+
+# Version of the baseline file layout and synthetic workloads (baselines of other versions are not compared)
+BASELINE_VERSION = 2
+
+# Session/run names produced by each MOABB dataset's get_data
+layouts = {
+    'BNCI2014_001': {'0train': [str(r) for r in range(6)], '1test': [str(r) for r in range(6)]},
+    'BNCI2014_002': {'0': [str(r) for r in range(8)]},
+    'Lee2019_MI': {'1': ['1train'], '2': ['1train']},
+    'PhysionetMI': {'0': [str(r) for r in range(6)]},
+    'Schirrmeister2017': {'0': ['0train', '1test']}
+}
+
+# PhysionetMI runs are annotated T0 (rest), T1 and T2; the pipeline maps them by run type
+physionet_annotations = ['T0', 'T1', 'T2']
+
+
+def make_synthetic_dataset(dataset_name, config, scale=0.1, seed=0):
+    """Stand-in for a MOABB dataset class returning random runs shaped like the real ones.
+
+    Channel counts, sampling rate and session/run layout come from the
+    dataset's 'recording' entry; run length and trial count are scaled by
+    `scale` so a full workload runs in seconds to minutes.
+    """
+    rec = config['recording']
+    duration = rec['run_duration'] * scale
+    n_trials = max(2, int(round(rec['trials_per_run'] * scale)))
+    tmax = config['epoch_params']['tmax']
+    descriptions = list(config['event_id'])
+    if dataset_name == 'PhysionetMI':
+        # Every T1/T2 task trial follows a T0 rest period
+        descriptions = [physionet_annotations[0], physionet_annotations[1],
+                        physionet_annotations[0], physionet_annotations[2]]
+        n_trials *= 2
+    n_eog = rec['n_raw_channels'] - rec['n_channels'] - 1
+    ch_types = ['eeg'] * rec['n_channels'] + ['eog'] * n_eog + ['stim']
+    ch_names = [f'EEG{i:03d}' for i in range(rec['n_channels'])] + [f'EOG{i}' for i in range(n_eog)] + ['STI']
+
+    def make_raw(rng):
+        n_samples = int(duration * rec['sfreq'])
+        info = mne.create_info(ch_names, rec['sfreq'], ch_types)
+        data = rng.standard_normal((len(ch_names), n_samples)) * 1e-5
+        data[-1] = 0
+        raw = mne.io.RawArray(data, info, verbose=False)
+        onsets = np.linspace(1., duration - tmax - 1., n_trials)
+        raw.set_annotations(mne.Annotations(onsets, 1., [descriptions[i % len(descriptions)]
+                                                         for i in range(n_trials)]))
+        return raw
+
+    class SyntheticDataset:
+        subject_list = list(config['subjects'])
+        hand_runs = [4, 8, 12]
+        feet_runs = [6, 10, 14]
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def get_data(self, subjects):
+            rng = np.random.default_rng(seed)
+            return {subject: {session: {run: make_raw(rng) for run in runs}
+                              for session, runs in layouts[dataset_name].items()}
+                    for subject in subjects}
+
+        def data_path(self, subject):
+            return []
+
+    return SyntheticDataset
+
+
+def environment():
+    """Library versions and machine details stored with a baseline"""
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'pandas': pd.__version__,
+        'mne': mne.__version__,
+        'moabb': moabb.__version__
+    }
+
+
+def run_workload(dataset_name, scale=0.1, repeat=3, trace_memory=True):
+    """Process one synthetic subject through the dataset's process_* function.
+
+    Returns per-stage results: the fastest of `repeat` runs and the largest
+    peak memory seen.
+    """
+    config = pipeline.dataset_configs[dataset_name]
+    original_class, original_dir = config['class'], pipeline.save_dirs[dataset_name]
+    config['class'] = make_synthetic_dataset(dataset_name, config, scale)
+    stages = {}
+    try:
+        for _ in range(repeat):
+            pipeline.save_dirs[dataset_name] = tempfile.mkdtemp(prefix='benchmark_')
+            pipeline.stage_recorder = StageRecorder(trace_memory)
+            try:
+                pipeline.process_functions[dataset_name](subjects=[1])
+                results = pipeline.stage_recorder.results.get(dataset_name, {})
+            finally:
+                pipeline.stage_recorder.close()
+                pipeline.stage_recorder = None
+                shutil.rmtree(pipeline.save_dirs[dataset_name], ignore_errors=True)
+
+            for name, entry in results.items():
+                best = stages.setdefault(name, {'seconds': entry['seconds'], 'peak_mb': entry['peak_mb']})
+                best['seconds'] = min(best['seconds'], entry['seconds'])
+                best['peak_mb'] = max(best['peak_mb'], entry['peak_mb'])
+    finally:
+        config['class'], pipeline.save_dirs[dataset_name] = original_class, original_dir
+    return stages
+
+
+def compare(current, baseline, threshold, memory_threshold, min_seconds=0.05, min_mb=5.):
+    """Stages slower or larger than the baseline beyond the thresholds.
+
+    Differences below min_seconds / min_mb are treated as noise.
+    """
+    regressions = []
+    for dataset_name, stages in current.items():
+        for name, entry in stages.items():
+            base = baseline.get(dataset_name, {}).get(name)
+            if base is None:
+                continue
+            if (entry['seconds'] > base['seconds'] * (1 + threshold) and
+                    entry['seconds'] - base['seconds'] > min_seconds):
+                regressions.append((dataset_name, name, 'time', base['seconds'], entry['seconds']))
+            if (entry['peak_mb'] > base['peak_mb'] * (1 + memory_threshold) and
+                    entry['peak_mb'] - base['peak_mb'] > min_mb):
+                regressions.append((dataset_name, name, 'memory', base['peak_mb'], entry['peak_mb']))
+    return regressions
+
+
+def print_results(current, baseline=None):
+    """Print time and peak memory per dataset and stage, next to the baseline if given"""
+    for dataset_name, stages in current.items():
+        print(f"\n{dataset_name}")
+        for name in sorted(stages, key=lambda n: STAGES.index(n) if n in STAGES else len(STAGES)):
+            entry = stages[name]
+            line = f"  {name:<10}{entry['seconds']:9.3f} s {entry['peak_mb']:9.1f} MB"
+            base = (baseline or {}).get(dataset_name, {}).get(name)
+            if base is not None:
+                line += f"   (baseline {base['seconds']:.3f} s, {base['peak_mb']:.1f} MB)"
+            print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the preprocessing pipeline for performance regressions '
+                                                 'on synthetic workloads shaped like each dataset')
+    parser.add_argument('--datasets', nargs='+', choices=list(pipeline.dataset_configs.keys()),
+                        default=list(pipeline.dataset_configs.keys()),
+                        help='Datasets whose workloads are run (default: all)')
+    parser.add_argument('--baseline', default='perf_baseline.json',
+                        help='Baseline file to compare against or to write (default: perf_baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Write the measured results as the new baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed relative slowdown per stage before failing (default: 0.25)')
+    parser.add_argument('--memory-threshold', type=float, default=0.25,
+                        help='Allowed relative peak memory increase per stage before failing (default: 0.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='Slowdowns smaller than this many seconds are ignored as noise')
+    parser.add_argument('--min-mb', type=float, default=5.,
+                        help='Memory increases smaller than this many MB are ignored as noise')
+    parser.add_argument('--scale', type=float, default=0.1,
+                        help='Fraction of the real run length and trial count used for each run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Repetitions per workload; the fastest time is kept')
+    parser.add_argument('--formats', nargs='+', choices=['csv', 'npy'], default=['csv'],
+                        help='Output formats written by the workloads (default: csv)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not sample peak memory per stage')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    mne.set_log_level('WARNING')
+    pipeline.output_formats[:] = args.formats
+    workload = {'scale': args.scale, 'subjects': [1], 'formats': args.formats,
+                'trace_memory': not args.no_memory}
+
+    current = {}
+    for dataset_name in args.datasets:
+        print(f"Running {dataset_name} workload...")
+        current[dataset_name] = run_workload(dataset_name, args.scale, args.repeat, not args.no_memory)
+
+    if args.save_baseline:
+        print_results(current)
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'version': BASELINE_VERSION,
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'environment': environment(),
+                'workload': workload,
+                'stages': current
+            }, f, indent=1)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print_results(current)
+        print(f"\nNo baseline at {args.baseline}; create one with --save-baseline")
+        return 2
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('version') != BASELINE_VERSION or baseline.get('workload') != workload:
+        print(f"Baseline {args.baseline} was recorded with a different file version or workload "
+              f"({baseline.get('workload')}); record a new one with --save-baseline")
+        return 2
+
+    print_results(current, baseline['stages'])
+    changed = {key: (value, environment()[key]) for key, value in baseline['environment'].items()
+               if environment().get(key) != value}
+    for key, (old, new) in changed.items():
+        print(f"Environment change: {key} {old} -> {new}")
+
+    regressions = compare(current, baseline['stages'], args.threshold, args.memory_threshold,
+                          args.min_seconds, args.min_mb)
+    for dataset_name, name, kind, old, new in regressions:
+        unit = 's' if kind == 'time' else 'MB'
+        print(f"REGRESSION {dataset_name} {name} {kind}: {old:.3f} {unit} -> {new:.3f} {unit} "
+              f"({(new / old - 1) * 100 if old else float('inf'):+.0f}%)")
+    if regressions:
+        return 1
+    print("\nNo regressions beyond the thresholds")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import json
+import numpy as np
+
+# Named channel sets usable as a common montage (10-10 names)
+montages = {
+    # Sensorimotor channels of BNCI2014_001 (Lee2019_MI has all of them except FCz)
+    'motor': ['FC3', 'FC1', 'FCz', 'FC2', 'FC4', 'C5', 'C3', 'C1', 'Cz', 'C2', 'C4', 'C6',
+              'CP3', 'CP1', 'CPz', 'CP2', 'CP4'],
+    'bnci2014_001': ['Fz', 'FC3', 'FC1', 'FCz', 'FC2', 'FC4', 'C5', 'C3', 'C1', 'Cz', 'C2', 'C4', 'C6',
+                     'CP3', 'CP1', 'CPz', 'CP2', 'CP4', 'P1', 'Pz', 'P2', 'POz'],
+    'c3_cz_c4': ['C3', 'Cz', 'C4']
+}
+
+
+def normalize_name(name):
+    """Channel name used for matching: case-insensitive, without EDF dot padding"""
+    return name.strip().strip('.').upper()
+
+
+def build_channel_index(dataset_channels, montage='intersection'):
+    """Map every dataset's channels to a common montage.
+
+    dataset_channels maps dataset names to their EEG channel names, in the
+    order the channels are stored. montage is 'intersection' (channels
+    present in every dataset, in the order of the first one), the name of
+    an entry in `montages`, or a list of channel names; named sets are
+    reduced to the channels every dataset has. Datasets sharing no channel
+    name with the others (e.g. BNCI2014_002's numbered electrodes) are left
+    out and listed under 'excluded'.
+
+    For each included dataset the index stores 'indices', the positions of
+    the common channels in the dataset's channel order, so that
+    data[:, indices] gives an array in common channel order, and 'ch_names',
+    the dataset's own names for those channels.
+    """
+    if isinstance(montage, str) and montage != 'intersection':
+        montage_name, wanted = montage, montages[montage]
+    elif isinstance(montage, str):
+        montage_name, wanted = montage, None
+    else:
+        montage_name, wanted = 'custom', list(montage)
+
+    names = {dataset: [normalize_name(ch) for ch in chs] for dataset, chs in dataset_channels.items()}
+
+    # Datasets without any channel in the montage (or shared with another dataset) cannot be harmonized
+    if wanted is not None:
+        candidates = [normalize_name(ch) for ch in wanted]
+        excluded = [dataset for dataset, chs in names.items() if not set(chs) & set(candidates)]
+    else:
+        excluded = [dataset for dataset, chs in names.items()
+                    if not any(set(chs) & set(others) for other, others in names.items() if other != dataset)]
+    included = [dataset for dataset in names if dataset not in excluded]
+    if wanted is None:
+        candidates = names[included[0]] if included else []
+    common = [ch for ch in candidates if all(ch in names[dataset] for dataset in included)]
+
+    # Report channels with the montage's spelling, or the first dataset's for intersections
+    spelling = wanted if wanted is not None else (dataset_channels[included[0]] if included else [])
+    display = {normalize_name(ch): ch for ch in spelling}
+
+    index = {
+        'montage': montage_name,
+        'channels': [display.get(ch, ch) for ch in common],
+        'excluded': excluded,
+        'datasets': {}
+    }
+    for dataset in included:
+        indices = [names[dataset].index(ch) for ch in common]
+        index['datasets'][dataset] = {
+            'indices': indices,
+            'ch_names': [dataset_channels[dataset][i] for i in indices],
+            'n_channels': len(dataset_channels[dataset])
+        }
+    return index
+
+
+def save_channel_index(path, index):
+    """Store a channel index as JSON"""
+    with open(path, 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+def load_channel_index(path):
+    """Load a channel index written by save_channel_index"""
+    with open(path) as f:
+        return json.load(f)
+
+
+def harmonize(data, dataset_index):
+    """Select and reorder the channel axis of (..., n_channels, n_times) data to the common montage.
+
+    Only for arrays in the dataset's original channel order; outputs written
+    with harmonized channels are already in common order.
+    """
+    return np.take(data, dataset_index['indices'], axis=-2)
@@ -0,0 +1,151 @@
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+import scipy.io
+import mne
+
+# Use the dataset's own files only: MOABB must not fetch anything for the synthetic subject
+os.environ.setdefault('MOABB_DOWNLOAD_PROVIDER', 'upstream')
+
+from moabb.datasets import Lee2019_MI
+from filtering import FilterEngine
+from matfile import read_struct
+from lee2019 import read_lee2019_subject
+
+# Stored class of the EEG matrix and compression of each synthetic file layout
+layouts = {
+    'float64': (np.float64, False),
+    'float64-compressed': (np.float64, True),
+    'int16-compressed': (np.int16, True),
+    'float32': (np.float32, False)
+}
+
+# Small fields compared with scipy.io.loadmat as they are
+SMALL_FIELDS = ('t', 'fs', 'y_dec', 'y_logic', 'EMG', 'pre_rest', 'time_interval')
+
+
+def make_run(rng, n_samples, dtype, ch_names, n_trials=20, past_end=False):
+    """One run struct laid out like Lee2019's EEG_MI_train / EEG_MI_test variables"""
+    x = (rng.standard_normal((n_samples, len(ch_names))) * 20).astype(dtype)
+    # Trials spread over the run, each followed by a full epoch (tmax is 7 s)
+    t = np.linspace(2000, n_samples - 8000, n_trials).astype(np.int32)
+    if past_end:
+        # The last trial's epoch runs past the end of the recording and is dropped
+        t[-1] = n_samples - 100
+    y = rng.integers(1, 3, n_trials).astype(np.uint8)
+    return {
+        'x': x, 't': t[None], 'fs': np.array([[1000.]]), 'y_dec': y[None],
+        'y_logic': np.zeros((2, n_trials), bool),
+        'y_class': np.array(['left' if v == 2 else 'right' for v in y], dtype=object)[None],
+        'class': np.array([['1', 'right'], ['2', 'left']], dtype=object),
+        'chan': np.array(ch_names, dtype=object)[None], 'time_interval': np.array([[0, 4000]]),
+        'EMG': rng.standard_normal((n_samples, 4)),
+        'EMG_index': np.array(['EMG1', 'EMG2', 'EMG3', 'EMG4'], dtype=object)[None],
+        'pre_rest': rng.standard_normal((3000, len(ch_names))), 'post_rest': rng.standard_normal((3000, len(ch_names)))
+    }
+
+
+def make_subject(directory, layout, n_samples, seed=0):
+    """Both session files of a synthetic subject written with scipy.io.savemat"""
+    dtype, compressed = layouts[layout]
+    rng = np.random.default_rng(seed)
+    ch_names = [name for name in mne.channels.make_standard_montage('standard_1005').ch_names
+                if not name.startswith(('M', 'A'))][:62]
+    paths = []
+    for session in (1, 2):
+        path = os.path.join(directory, f'{layout}_sess{session}.mat')
+        scipy.io.savemat(path, {'EEG_MI_train': make_run(rng, n_samples, dtype, ch_names, past_end=session == 2),
+                                'EEG_MI_test': make_run(rng, n_samples // 2, dtype, ch_names)},
+                         do_compression=compressed)
+        paths.append(path)
+    return paths
+
+
+def check_parser(path, variable):
+    """Compare read_struct with scipy.io.loadmat on one run struct"""
+    expected = scipy.io.loadmat(path)[variable][0, 0]
+    fields = read_struct(path, variable, lazy=('x',))
+    try:
+        x = fields['x'].columns(0, fields['x'].shape[1])
+        assert x.dtype == expected['x'].dtype and np.array_equal(x, expected['x']), f"{variable}: x differs"
+    finally:
+        fields['x'].close()
+    for field in SMALL_FIELDS:
+        assert fields[field].dtype == expected[field].dtype, f"{variable}: {field} has dtype {fields[field].dtype}"
+        assert np.array_equal(fields[field], expected[field]), f"{variable}: {field} differs"
+    names = [np.squeeze(c).item() for c in np.ravel(fields['chan'])]
+    assert names == [np.squeeze(c).item() for c in np.ravel(expected['chan'])], f"{variable}: chan differs"
+
+
+def check_reader(paths, test_run, filter_engine, l_freq=8., h_freq=30., tmin=3., tmax=7.):
+    """Compare read_lee2019_subject with MOABB's get_data followed by the pipeline's filter and mne.Epochs"""
+    dataset = Lee2019_MI(test_run=test_run)
+    dataset.data_path = lambda subject, *args, **kwargs: paths
+
+    expected = {}
+    data = dataset.get_data(subjects=[1])[1]
+    for session, runs in data.items():
+        for run, raw in runs.items():
+            raw.pick_types(eeg=True)
+            filter_engine.filter(raw, l_freq, h_freq)
+            events, event_id = mne.events_from_annotations(raw, verbose=False)
+            expected[session, run] = mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax, baseline=None,
+                                                preload=True, verbose=False)
+
+    got = {(session, run): epochs
+           for session, run, epochs in read_lee2019_subject(dataset, paths, filter_engine, l_freq, h_freq, tmin, tmax)}
+    assert list(got) == list(expected), f"runs {list(got)}, expected {list(expected)}"
+    for key, reference in expected.items():
+        epochs = got[key]
+        assert np.array_equal(epochs.get_data(), reference.get_data()), f"{key}: epochs differ"
+        assert np.array_equal(epochs.events, reference.events) and epochs.event_id == reference.event_id, \
+            f"{key}: events differ"
+        assert np.array_equal(epochs.selection, reference.selection) and epochs.drop_log == reference.drop_log, \
+            f"{key}: dropped epochs differ"
+        assert epochs.ch_names == reference.ch_names and np.array_equal(epochs.times, reference.times), \
+            f"{key}: channels or times differ"
+        assert (epochs.info['highpass'], epochs.info['lowpass']) == \
+            (reference.info['highpass'], reference.info['lowpass']), f"{key}: filter band differs"
+    return [len(epochs) for epochs in got.values()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the MAT-file reader (matfile.py) and the out-of-core '
+                                                 'Lee2019_MI reader (lee2019.py) against scipy.io.loadmat and MOABB '
+                                                 'on synthetic files')
+    parser.add_argument('--layouts', nargs='+', choices=list(layouts), default=list(layouts),
+                        help='EEG matrix classes and compression to check (default: all)')
+    parser.add_argument('--samples', type=int, default=60000,
+                        help='Samples of each training run, at least 40000 (test runs have half as many)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.samples < 40000:
+        print("--samples must be at least 40000")
+        return 2
+    mne.set_log_level('ERROR')
+    filter_engine = FilterEngine()
+    failed = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for layout in args.layouts:
+            paths = make_subject(directory, layout, args.samples)
+            try:
+                for path in paths:
+                    for variable in ('EEG_MI_train', 'EEG_MI_test'):
+                        check_parser(path, variable)
+                for test_run in (False, True):
+                    counts = check_reader(paths, test_run, filter_engine)
+                print(f"{layout}: OK ({counts} epochs per run with the test runs)")
+            except AssertionError as e:
+                print(f"{layout}: FAILED, {str(e)}")
+                failed += 1
+    filter_engine.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+def rejection_masks(data, reject_ptp=None, flat=None):
+    """Peak-to-peak and flat-signal masks for all epochs at once.
+
+    data has shape (n_epochs, n_channels, n_times). Returns two boolean
+    arrays of shape (n_epochs, n_channels): channels whose peak-to-peak
+    amplitude is above reject_ptp, and channels whose peak-to-peak amplitude
+    is below flat. A threshold of None disables that check.
+    """
+    ptp = data.max(axis=-1) - data.min(axis=-1)
+    too_large = ptp > reject_ptp if reject_ptp is not None else np.zeros(ptp.shape, dtype=bool)
+    too_flat = ptp < flat if flat is not None else np.zeros(ptp.shape, dtype=bool)
+    return too_large, too_flat
+
+
+def clean_epochs(epochs, reject_ptp=None, flat=None, average_reference=False):
+    """Drop bad epochs and optionally re-reference, in place.
+
+    Rejection is computed on the whole epochs array with array operations
+    (an epoch is dropped if any channel fails a threshold); the common
+    average reference is applied to the remaining epochs. Returns the
+    rejection statistics stored in the run metadata.
+    """
+    data = epochs.get_data()
+    too_large, too_flat = rejection_masks(data, reject_ptp, flat)
+    bad_ptp = too_large.any(axis=1)
+    bad_flat = too_flat.any(axis=1)
+    bad = bad_ptp | bad_flat
+
+    # Channels responsible for rejections, most frequent first
+    channel_counts = (too_large | too_flat)[bad].sum(axis=0)
+    bad_channels = {epochs.ch_names[i]: int(channel_counts[i])
+                    for i in np.argsort(channel_counts)[::-1] if channel_counts[i] > 0}
+
+    stats = {
+        'n_epochs': int(len(bad)),
+        'n_rejected': int(bad.sum()),
+        'n_rejected_ptp': int(bad_ptp.sum()),
+        'n_rejected_flat': int(bad_flat.sum()),
+        'rejected_epochs': np.asarray(epochs.selection)[bad].tolist(),
+        'bad_channels': bad_channels,
+        'reject_ptp': reject_ptp,
+        'flat': flat,
+        'average_reference': average_reference
+    }
+
+    if bad.any():
+        epochs.drop(np.flatnonzero(bad), reason='CLEANING', verbose=False)
+    if average_reference and len(epochs):
+        epochs.set_eeg_reference('average', projection=False, verbose=False)
+    return stats
@@ -0,0 +1,66 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from epoch_store import load_epochs, list_runs
+from packs import open_packs
+
+
+def n_crops(n_times, window, stride):
+    """Number of crops of `window` samples taken every `stride` samples"""
+    return max(0, (n_times - window) // stride + 1)
+
+
+def crop_view(data, window, stride):
+    """Sliding-window crops of an epoch array as a strided view.
+
+    data has shape (n_epochs, n_channels, n_times); the result has shape
+    (n_epochs, n_crops, n_channels, window) and shares memory with data
+    (read-only), so no samples are copied. Works on np.memmap arrays too.
+    A window longer than the epochs gives no crops, as n_crops counts.
+    """
+    if window > data.shape[-1]:
+        return np.empty((data.shape[0], 0, data.shape[1], window), dtype=data.dtype)
+    windows = sliding_window_view(data, window, axis=-1)[:, :, ::stride]
+    return windows.transpose(0, 2, 1, 3)
+
+
+def iter_crops(data, labels, window, stride, batch_size=32):
+    """Yield (crops, labels, epoch_idx, crop_starts) for blocks of epochs.
+
+    crops is a (n_batch_epochs, n_crops, n_channels, window) view into data;
+    labels and epoch_idx give one entry per epoch of the block and
+    crop_starts the start sample of each crop within the epoch.
+    """
+    labels = np.asarray(labels)
+    crop_starts = np.arange(n_crops(data.shape[-1], window, stride)) * stride
+    for first in range(0, data.shape[0], batch_size):
+        block = data[first:first + batch_size]
+        yield crop_view(block, window, stride), labels[first:first + batch_size], \
+            np.arange(first, first + block.shape[0]), crop_starts
+
+
+def iter_run_crops(save_dir, window, stride, batch_size=32, unit='seconds'):
+    """Yield crops from every stored run of a dataset, memory-mapped from disk.
+
+    Runs packed into containers are memory-mapped from the container.
+    window and stride are in seconds by default (unit='samples' to give
+    them in samples). Each item is (filepath, crops, labels, epoch_idx, crop_starts).
+    """
+    runs = [(filepath, None) for filepath in list_runs(save_dir)]
+    runs += [(filepath, pack) for pack in open_packs(save_dir) for filepath in pack.runs()]
+    for filepath, pack in runs:
+        try:
+            if pack is None:
+                data, meta = load_epochs(filepath, mmap=True)
+            else:
+                data, meta = pack.load_epochs(filepath, mmap=True), pack.load_meta(filepath)
+        except (FileNotFoundError, KeyError):
+            # Runs written without an epoch array
+            continue
+        if unit == 'seconds':
+            window_samples = int(round(window * meta['sfreq']))
+            stride_samples = max(1, int(round(stride * meta['sfreq'])))
+        else:
+            window_samples, stride_samples = int(window), int(stride)
+        for crops, labels, epoch_idx, crop_starts in iter_crops(data, meta['label'], window_samples,
+                                                                stride_samples, batch_size):
+            yield filepath, crops, labels, epoch_idx, crop_starts
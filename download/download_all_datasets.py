@@ -4,10 +4,40 @@ import pandas as pd
 import os
 import mne
 import time
+import json
+import datetime
+import argparse
+from contextlib import contextmanager, ExitStack
 from moabb.datasets import BNCI2014_001, BNCI2014_002, Lee2019_MI, PhysionetMI, Schirrmeister2017
+from plan import plan
+from streaming import StreamingPipeline, replay_moabb, benchmark_latency
+from features import (feature_stages, feature_path, feature_fingerprint, epoch_index, save_features,
+                      load_features, read_run_csv)
+from cleaning import clean_epochs
+from epoch_store import (load_epochs, list_runs, epochs_path, run_outputs_exist, load_run_meta, csv_run_path,
+                         csv_compressions)
+from outputs import run_info, write_outputs
+from writer_pool import SharedMemoryWriterPool
+from raw_cache import RawCache, parse_size
+from filtering import FilterEngine
+from channels import montages, build_channel_index, save_channel_index
+from loader import benchmark_loader
+from watchdog import DownloadWatchdog
+from stages import StageProfiler
+from csv_writer import CsvWriter
+from packs import compact_directory, subject_outputs_exist, subject_of, open_packs
+from norm_stats import RunningStats, save_norm_stats
+from workers import RecyclingWorkerPool
+from scheduler import global_schedule, makespan_report, print_makespan
+from shards import write_shards
+from verify import verify_outputs, print_verification
+from epoching import direct_epochs
+from lee2019 import read_lee2019_subject
+from tfr import compute_tfr, load_tfr, tfr_fingerprint
 
 # Set MOABB data download directory
-moabb.set_download_dir('./data')
+download_dir = './data'
+moabb.set_download_dir(download_dir)
 
 # Create directories for saving processed data
 save_dirs = {
@@ -26,6 +56,10 @@ for save_dir in save_dirs.values():
 # Set bandpass filter parameters
 fmin, fmax = 8, 30
 
+# Shared filter engine: designs are cached per (sfreq, band, method) and channels
+# are filtered on a thread pool (set the number of threads with --filter-jobs)
+filter_engine = FilterEngine()
+
 # Maximum number of retries
 max_retries = 3
 
@@ -34,6 +68,8 @@ dataset_configs = {
     'BNCI2014_001': {
         'class': BNCI2014_001,
         'subjects': range(1, 10),  # 9 subjects
+        # Runs written per subject, as subject_<n>_<run>_data.csv (checked by --verify)
+        'runs': [f'session_{session}_run_{run}' for session in ['0train', '1test'] for run in range(6)],
         'event_id': {
             'left_hand': 1,
             'right_hand': 2,
@@ -44,6 +80,16 @@ dataset_configs = {
             'tmin': 2,
             'tmax': 6
         },
+        'recording': {
+            'n_channels': 22,  # EEG channels kept after pick_types
+            'n_raw_channels': 26,  # EEG + EOG + stim as loaded by MOABB
+            'sfreq': 250,  # Hz
+            'sessions': 2,
+            'runs_per_session': 6,
+            'run_duration': 386,  # seconds (approximate)
+            'trials_per_run': 48,
+            'raw_bytes_per_subject': 84e6  # approximate download size
+        },
         'attrs': {
             'trial_duration': '4 seconds (2-6s)',
             'rest_period': '2-3 seconds'
@@ -52,6 +98,8 @@ dataset_configs = {
     'BNCI2014_002': {
         'class': BNCI2014_002,
         'subjects': range(1, 15),  # 14 subjects
+        'runs': [f'session_0_run_{run}' for run in ['0train', '1train', '2train', '3train', '4train',
+                                                    '5test', '6test', '7test']],
         'event_id': {
             'right_hand': 1,
             'feet': 2
@@ -60,6 +108,16 @@ dataset_configs = {
             'tmin': 3,
             'tmax': 8
         },
+        'recording': {
+            'n_channels': 15,
+            'n_raw_channels': 16,
+            'sfreq': 512,
+            'sessions': 1,
+            'runs_per_session': 8,
+            'run_duration': 230,
+            'trials_per_run': 20,
+            'raw_bytes_per_subject': 60e6
+        },
         'attrs': {
             'sampling_rate': 512,  # Hz
             'electrodes': '15 electrodes (3 Laplacian derivations at C3, Cz, C4)',
@@ -72,6 +130,7 @@ dataset_configs = {
     'Lee2019_MI': {
         'class': Lee2019_MI,
         'subjects': range(1, 55),  # 54 subjects
+        'runs': ['session_1_run_1train', 'session_2_run_1train'],  # MOABB loads the training runs only
         'event_id': {
             'left_hand': 1,
             'right_hand': 2
@@ -80,6 +139,16 @@ dataset_configs = {
             'tmin': 3,
             'tmax': 7
         },
+        'recording': {
+            'n_channels': 62,
+            'n_raw_channels': 67,
+            'sfreq': 1000,
+            'sessions': 2,
+            'runs_per_session': 1,  # MOABB loads the training run of each session
+            'run_duration': 1300,
+            'trials_per_run': 100,
+            'raw_bytes_per_subject': 740e6
+        },
         'attrs': {
             'sampling_rate': 1000,  # Hz
             'electrodes': '62 Ag/AgCl electrodes',
@@ -92,6 +161,7 @@ dataset_configs = {
     'PhysionetMI': {
         'class': PhysionetMI,
         'subjects': range(1, 110),  # 109 subjects
+        'runs': [f'run_{run}' for run in [4, 8, 12, 6, 10, 14]],
         'event_id': {
             'rest': 1,
             'left_hand': 2,
@@ -103,6 +173,16 @@ dataset_configs = {
             'tmin': 0,
             'tmax': 3  # Default value, will be adjusted based on run type
         },
+        'recording': {
+            'n_channels': 64,
+            'n_raw_channels': 65,
+            'sfreq': 160,
+            'sessions': 1,
+            'runs_per_session': 6,  # imagined runs only
+            'run_duration': 125,
+            'trials_per_run': 15,  # T1/T2 task trials; the T0 rest periods between them are not epoched
+            'raw_bytes_per_subject': 15.5e6
+        },
         'attrs': {
             'trial_duration': '3 seconds',  # Default value, will be adjusted based on run type
         }
@@ -110,6 +190,7 @@ dataset_configs = {
     'Schirrmeister2017': {
         'class': Schirrmeister2017,
         'subjects': range(1, 15),  # 14 subjects
+        'runs': ['train', 'test'],
         'event_id': {
             'right_hand': 1,
             'left_hand': 2,
@@ -120,14 +201,401 @@ dataset_configs = {
             'tmin': 0,
             'tmax': 4
         },
+        'recording': {
+            'n_channels': 128,
+            'n_raw_channels': 134,
+            'sfreq': 500,
+            'sessions': 1,
+            'runs_per_session': 2,  # 1 training run, 1 test run
+            'run_duration': 3900,  # average of ~6600s train and ~1200s test
+            'trials_per_run': 520,
+            'raw_bytes_per_subject': 1.0e9
+        },
         'attrs': {
             'trial_duration': '4 seconds (0s-4s)',
         }
     }
 }
 
+# Optional feature stages computed after epoching (enable with --features)
+feature_params = {
+    'covariance': {'shrinkage': 'ledoit_wolf'},  # None, float in [0, 1], 'ledoit_wolf' or 'oas'
+    'psd': {
+        'bands': {'mu': (8, 12), 'low_beta': (13, 20), 'high_beta': (20, 30)},  # Hz
+        'seg_duration': 1.0  # Welch segment length in seconds
+    }
+}
+enabled_features = []
+
+# Optional time-frequency maps of every epoch (enable with --tfr), cached next to each run
+# as subject_<n>_..._tfr.npy (n_epochs x n_channels x n_freqs x n_times) with a _tfr.json sidecar
+tfr_params = {
+    'method': 'morlet',  # 'morlet' (wavelets) or 'stft' (short-time Fourier transform)
+    'freqs': [8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30],  # Hz
+    'n_cycles': 7,  # Morlet wavelet length in cycles of each frequency
+    'stft_window': 0.5,  # STFT window length in seconds
+    'decim': 4,  # Keep every decim-th time point
+    'log': True,  # Store log10 of the power in uV^2 (else the power itself)
+    'dtype': 'float16',  # Storage type (use float32 with log=False)
+    'chunk_mb': 256  # Memory for one batch of epochs
+}
+tfr_enabled = False
+
+# Output formats written for every run (set with --formats):
+# 'csv' is the original table layout, 'npy' stores (n_epochs, n_channels, n_times)
+# arrays that can be memory-mapped (e.g. for crops.iter_run_crops)
+output_formats = ['csv']
+
+# Build run tables with float32 channels, categorical condition and small integer
+# epoch/label columns (enable with --compact-tables). CSV values are then written
+# with float32 precision
+compact_tables = False
+
+# Optional cleaning stage applied to epochs before writing (enable with --clean).
+# Thresholds are in Volts; a dataset can override any key with a 'cleaning'
+# entry in its dataset_configs item, e.g. {'reject_ptp': 200e-6} or {'enabled': False}
+cleaning_params = {
+    'enabled': False,
+    'reject_ptp': 150e-6,  # Reject epochs where any channel's peak-to-peak exceeds this
+    'flat': 1e-6,  # Reject epochs where any channel's peak-to-peak is below this
+    'average_reference': False  # Re-reference kept epochs to the common average
+}
+
+# Per-stage time and memory recorder, set by the benchmark harness (benchmark.py)
+stage_recorder = None
+
+# Per-stage cProfile profiles (enable with --profile)
+stage_profiler = None
+
+# Epoch runs without mne.Epochs' per-epoch overhead (enable with --direct-epoching)
+direct_epoching = False
+
+# Read Lee2019_MI runs from their MAT-files a few channels at a time instead of
+# loading whole sessions with MOABB (enable with --lee-out-of-core)
+lee2019_out_of_core = False
+
+# Context for one processing stage of a dataset, recorded and profiled when enabled
+@contextmanager
+def stage(dataset_name, name):
+    with ExitStack() as stack:
+        for recorder in (stage_recorder, stage_profiler):
+            if recorder is not None:
+                stack.enter_context(recorder.stage(dataset_name, name))
+        yield
+
+# Cut one run's epochs (tmin to tmax around each event, no baseline correction) with mne.Epochs,
+# or copy them straight from the raw array when direct epoching is enabled (same epochs, less overhead)
+def epoch_run(raw, events, event_id, tmin, tmax):
+    if direct_epoching:
+        return direct_epochs(raw, events, event_id, tmin, tmax)
+    return mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax, baseline=None, preload=True)
+
+# Clean one run's epochs in place, return rejection statistics (None when disabled)
+def apply_cleaning(dataset_name, epochs):
+    params = dict(cleaning_params, **dataset_configs[dataset_name].get('cleaning', {}))
+    if not params.pop('enabled'):
+        return None
+    
+    with stage(dataset_name, 'clean'):
+        stats = clean_epochs(epochs, **params)
+    if stats['n_rejected']:
+        print(f"Rejected {stats['n_rejected']}/{stats['n_epochs']} epochs "
+              f"({stats['n_rejected_ptp']} peak-to-peak, {stats['n_rejected_flat']} flat)")
+    return stats
+
+# Effective cleaning settings of a dataset (None when cleaning is off), part of cache fingerprints
+def dataset_cleaning(dataset_name):
+    cleaning = dict(cleaning_params, **dataset_configs[dataset_name].get('cleaning', {}))
+    return cleaning if cleaning['enabled'] else None
+
+# Fingerprint of a dataset's epoching and cleaning settings and one feature's parameters
+def dataset_feature_fingerprint(dataset_name, feature):
+    config = dataset_configs[dataset_name]
+    epoch_info = {
+        'epoch_params': config['epoch_params'],
+        'event_id': config['event_id'],
+        'band': [fmin, fmax],
+        'cleaning': dataset_cleaning(dataset_name)
+    }
+    return feature_fingerprint(epoch_info, feature_params[feature])
+
+# Compute enabled feature stages for one run and store them next to its data file
+def run_feature_stages(dataset_name, epochs, filepath, label_map):
+    if not enabled_features:
+        return
+    
+    # Epoch index shared with the CSV rows
+    epoch_ids, conditions, labels = epoch_index(epochs, label_map)
+    
+    data = epochs.get_data()
+    for feature in enabled_features:
+        arrays = feature_stages[feature](data, epochs.info['sfreq'], **feature_params[feature])
+        save_features(feature_path(filepath, feature), dataset_feature_fingerprint(dataset_name, feature),
+                      epoch_ids, conditions, labels, epochs.ch_names, **arrays)
+
+# Fingerprint of everything a dataset's time-frequency maps depend on: epoching, band, cleaning and TFR settings
+def dataset_tfr_fingerprint(dataset_name):
+    config = dataset_configs[dataset_name]
+    epoch_info = {
+        'epoch_params': config['epoch_params'],
+        'event_id': config['event_id'],
+        'band': [fmin, fmax],
+        'cleaning': dataset_cleaning(dataset_name)
+    }
+    return tfr_fingerprint(epoch_info, tfr_params)
+
+# Compute the time-frequency maps of one run and store them next to its data file
+def run_tfr_stage(dataset_name, epochs, filepath, label_map):
+    epoch_ids, conditions, labels = epoch_index(epochs, label_map)
+    compute_tfr(filepath, epochs.get_data(), epochs.info['sfreq'], epochs.tmin, tfr_params,
+                dataset_tfr_fingerprint(dataset_name), epoch_ids, conditions, labels, epochs.ch_names)
+
+# Runs of a dataset directory written as CSV and/or as epoch arrays, loose or packed:
+# {run data file name: RunPack holding the run, or None for loose files}
+def stored_runs(save_dir):
+    runs = {}
+    for pack in open_packs(save_dir):
+        runs.update((csv_run_path(name), pack) for name in pack.index if csv_run_path(name))
+        runs.update((os.path.basename(f), pack) for f in pack.runs() if os.path.basename(epochs_path(f)) in pack.index)
+    runs.update((csv_run_path(f), None) for f in os.listdir(save_dir) if csv_run_path(f))
+    runs.update((os.path.basename(f), None) for f in list_runs(save_dir) if os.path.exists(epochs_path(f)))
+    return runs
+
+# Epoch array and metadata of a stored run (from its container when packed), or None without an array
+def load_stored_epochs(filepath, pack, mmap=True):
+    if pack is None:
+        return load_epochs(filepath, mmap=mmap) if os.path.exists(epochs_path(filepath)) else None
+    if os.path.basename(epochs_path(filepath)) not in pack.index:
+        return None
+    return pack.load_epochs(filepath, mmap=mmap), pack.load_meta(filepath)
+
+# Recompute missing or stale time-frequency maps of runs that were already processed
+def refresh_tfr_cache(dataset_name):
+    if not tfr_enabled:
+        return
+    
+    save_dir = save_dirs[dataset_name]
+    config = dataset_configs[dataset_name]
+    fingerprint = dataset_tfr_fingerprint(dataset_name)
+    
+    runs = stored_runs(save_dir)
+    for filename in sorted(runs):
+        filepath = os.path.join(save_dir, filename)
+        if load_tfr(filepath, fingerprint) is not None:
+            continue
+        
+        try:
+            print(f"Computing time-frequency maps for {filename}")
+            # Read the epoch array batch by batch through a memory map when there is one
+            stored = load_stored_epochs(filepath, runs[filename], mmap=True)
+            if stored is not None:
+                data, meta = stored
+                epoch_ids, conditions, labels = meta['epoch'], meta['condition'], meta['label']
+                ch_names, sfreq, tmin = meta['ch_names'], meta['sfreq'], meta['tmin']
+            else:
+                data, epoch_ids, conditions, labels, ch_names, sfreq = read_run_csv(filepath, config['event_id'],
+                                                                                    runs[filename])
+                tmin = int(round(config['epoch_params']['tmin'] * sfreq)) / sfreq
+            compute_tfr(filepath, data, sfreq, tmin, tfr_params, fingerprint, epoch_ids, conditions, labels, ch_names)
+        except Exception as e:
+            print(f"Error computing time-frequency maps for {filename}: {str(e)}")
+            continue
+
+# Recompute missing or stale feature files for runs that were already processed
+def refresh_feature_cache(dataset_name):
+    if not enabled_features:
+        return
+    
+    save_dir = save_dirs[dataset_name]
+    label_map = dataset_configs[dataset_name]['event_id']
+    
+    runs = stored_runs(save_dir)
+    for filename in sorted(runs):
+        filepath = os.path.join(save_dir, filename)
+        
+        # Only reread the CSV when at least one feature needs recomputing
+        stale = [feature for feature in enabled_features
+                 if load_features(feature_path(filepath, feature),
+                                  dataset_feature_fingerprint(dataset_name, feature)) is None]
+        if not stale:
+            continue
+        
+        try:
+            print(f"Refreshing {', '.join(stale)} features for {filename}")
+            stored = load_stored_epochs(filepath, runs[filename], mmap=False)
+            if stored is not None:
+                data, meta = stored
+                epoch_ids, conditions, labels = meta['epoch'], meta['condition'], meta['label']
+                ch_names, sfreq = meta['ch_names'], meta['sfreq']
+            else:
+                data, epoch_ids, conditions, labels, ch_names, sfreq = read_run_csv(filepath, label_map,
+                                                                                    runs[filename])
+            for feature in stale:
+                arrays = feature_stages[feature](data, sfreq, **feature_params[feature])
+                save_features(feature_path(filepath, feature), dataset_feature_fingerprint(dataset_name, feature),
+                              epoch_ids, conditions, labels, ch_names, **arrays)
+        except Exception as e:
+            print(f"Error refreshing features for {filename}: {str(e)}")
+            continue
+
+# Common channel montage across datasets (build with --montage). With
+# harmonize_outputs, runs are written with only the common channels, in common order
+channel_index = None
+channel_index_path = './channel_index.json'
+harmonize_outputs = False
+
+# EEG channel names of a dataset, from its processed runs or from its first subject
+def dataset_channels(dataset_name):
+    runs = list_runs(save_dirs[dataset_name])
+    if runs:
+        return load_run_meta(runs[0])['ch_names']
+    for pack in open_packs(save_dirs[dataset_name]):
+        if pack.runs():
+            return pack.load_meta(pack.runs()[0])['ch_names']
+    
+    config = dataset_configs[dataset_name]
+    subject = list(config['subjects'])[0]
+    raw_data = config['class']().get_data(subjects=[subject])[subject]
+    raw = next(iter(next(iter(raw_data.values())).values()))
+    return raw.copy().pick_types(eeg=True).ch_names
+
+# Build the channel mapping of the selected datasets to a common montage and save it
+def build_montage_index(dataset_names, montage):
+    index = build_channel_index({name: dataset_channels(name) for name in dataset_names}, montage)
+    save_channel_index(channel_index_path, index)
+    
+    print(f"Common montage '{index['montage']}': {len(index['channels'])} channels")
+    print(f"  {', '.join(index['channels'])}")
+    for name, entry in index['datasets'].items():
+        print(f"  {name}: {len(entry['indices'])}/{entry['n_channels']} channels kept")
+    for name in index['excluded']:
+        print(f"  {name}: no common channel names, left out of the index")
+    print(f"Channel index saved to {channel_index_path}")
+    return index
+
+# Summary of each processing run (timings, failed downloads)
+run_report_path = './run_report.json'
+
+# Result of --verify
+verify_report_path = './verify_report.json'
+
+# Writer processes receiving epoch arrays through shared memory (enable with --writers)
+writer_pool = None
+
+# Fast, optionally compressed CSV writer (enable with --fast-csv / --csv-compression)
+csv_writer = None
+
+# Write one processed run in every selected output format, plus its metadata and features
+def write_run(dataset_name, epochs, attrs, filepath, label_map, extra_columns=None):
+    # Keep only the common channels, in common order
+    if harmonize_outputs and channel_index is not None and dataset_name in channel_index['datasets']:
+        epochs.reorder_channels(channel_index['datasets'][dataset_name]['ch_names'])
+        attrs['montage'] = channel_index['montage']
+    
+    info = run_info(epochs, label_map, attrs, output_formats, dataset_name, extra_columns, compact_tables)
+    data = epochs.get_data()
+    
+    # Per-channel normalization statistics of the run, stored in its metadata
+    with stage(dataset_name, 'stats'):
+        info['stats'] = RunningStats(info['ch_names']).update(data).to_dict()
+    
+    # Hand the array to a writer process, or serialize it here
+    with stage(dataset_name, 'write'):
+        if writer_pool is not None:
+            owner = run_owner(filepath)
+            queued_runs[owner] = queued_runs.get(owner, 0) + 1
+            writer_pool.submit(filepath, data, info)
+        else:
+            write_outputs(filepath, data, info, lambda name: stage(dataset_name, name), csv_writer)
+    
+    # Compute optional features next to the run
+    if enabled_features:
+        with stage(dataset_name, 'features'):
+            run_feature_stages(dataset_name, epochs, filepath, label_map)
+    
+    # Time-frequency maps of the run's epochs
+    if tfr_enabled:
+        with stage(dataset_name, 'tfr'):
+            run_tfr_stage(dataset_name, epochs, filepath, label_map)
+
+# Size-limited cache over the raw download directory (enable with --raw-cache-limit)
+raw_cache = None
+
+# Download watchdog cancelling stalled transfers (enable with --stall-timeout / --subject-deadline)
+download_watchdog = None
+
+# Load a subject's raw data, registering its downloaded files with the raw cache
+# (files_only: only download them and return their paths, for readers that open the files themselves)
+def get_raw_data(dataset, dataset_name, subject, files_only=False):
+    # Download under the watchdog first, so a hung transfer cannot block the run
+    if download_watchdog is not None:
+        download_watchdog.fetch(dataset, dataset_name, subject)
+    load = dataset.data_path if files_only else lambda subject: dataset.get_data(subjects=[subject])
+    
+    if raw_cache is None:
+        with stage(dataset_name, 'load'):
+            return load(subject)
+    
+    # Pin the subject first so another worker cannot evict its files while we read them
+    owner = f'{dataset_name}/{subject}'
+    raw_cache.pin(owner)
+    with stage(dataset_name, 'load'):
+        raw_data = load(subject)
+    try:
+        raw_cache.register(owner, dataset.data_path(subject))
+    except Exception as e:
+        print(f"Could not register raw files of {owner} with the cache: {str(e)}")
+    return raw_data
+
+# Runs handed to the writer processes and not yet reported written, per (dataset, subject)
+queued_runs = {}
+
+# Finished subjects whose raw files are released once the writers have written all their runs
+pending_releases = set()
+
+# Mark a subject's outputs complete, so its raw files may be evicted to stay under the quota
+def release_raw_data(dataset_name, subject):
+    if raw_cache is None:
+        return
+    
+    raw_cache.unpin()
+    # Runs still queued for the writers: wait until they are on disk (see run_written)
+    if queued_runs.get((dataset_name, subject)):
+        pending_releases.add((dataset_name, subject))
+        return
+    raw_cache.mark_complete(f'{dataset_name}/{subject}')
+    raw_cache.enforce_quota()
+
+# Pack run outputs into one container per subject or per dataset (enable with --pack)
+pack_mode = None
+
+# Subjects whose outputs are packed once the writer processes have written them
+pending_packs = []
+
+# Move a finished subject's run files into its container
+def pack_subject(dataset_name, subject):
+    if pack_mode is None:
+        return
+    if writer_pool is not None:
+        pending_packs.append((dataset_name, subject))
+        return
+    
+    compact_directory(save_dirs[dataset_name], pack_mode, subjects=[subject])
+
+# A subject is done: pack its outputs and let its raw files be evicted
+def finish_subject(dataset_name, subject):
+    pack_subject(dataset_name, subject)
+    release_raw_data(dataset_name, subject)
+
+# Subjects that could not be processed, for the run report
+failed_subjects = []
+
+# Record a subject the process_* functions gave up on
+def subject_failed(dataset_name, subject, error):
+    failed_subjects.append({'dataset': dataset_name, 'subject': subject, 'error': str(error)})
+
 # Process BNCI2014_001 dataset
-def process_bnci2014_001():
+def process_bnci2014_001(subjects=None):
     dataset_name = 'BNCI2014_001'
     config = dataset_configs[dataset_name]
     save_dir = save_dirs[dataset_name]
@@ -136,10 +604,9 @@ def process_bnci2014_001():
     dataset = config['class']()
     
     # Process data for each subject
-    for subject in config['subjects']:
+    for subject in config['subjects'] if subjects is None else subjects:
         # Check if the subject has already been processed
-        subject_files = [f for f in os.listdir(save_dir) if f.startswith(f'subject_{subject}_')]
-        if subject_files:
+        if subject_outputs_exist(save_dir, subject):
             print(f"Subject {subject} already processed, skipping...")
             continue
             
@@ -148,7 +615,7 @@ def process_bnci2014_001():
                 print(f"Processing {dataset_name} subject {subject} (attempt {retry + 1}/{max_retries})")
                 
                 # Get raw data
-                raw_data = dataset.get_data(subjects=[subject])
+                raw_data = get_raw_data(dataset, dataset_name, subject)
                 
                 # Iterate through each session
                 for session in raw_data[subject].keys():
@@ -169,49 +636,46 @@ def process_bnci2014_001():
                                 raw = session_data[run]
                                 
                                 # Only select EEG channels
-                                raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
+                                with stage(dataset_name, 'pick'):
+                                    raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
                                 
                                 # Apply bandpass filter
-                                raw.filter(fmin, fmax, method='fir', phase='zero')
+                                with stage(dataset_name, 'filter'):
+                                    filter_engine.filter(raw, fmin, fmax, method='fir')
                                 
                                 # Get event information
-                                events, event_dict = mne.events_from_annotations(raw)
+                                with stage(dataset_name, 'events'):
+                                    events, event_dict = mne.events_from_annotations(raw)
                                 
                                 # Create epochs
-                                epochs = mne.Epochs(raw, events, event_id=event_dict, 
-                                                  tmin=config['epoch_params']['tmin'], 
-                                                  tmax=config['epoch_params']['tmax'],
-                                                  baseline=None, preload=True)
+                                with stage(dataset_name, 'epoch'):
+                                    epochs = epoch_run(raw, events, event_id=event_dict, 
+                                                      tmin=config['epoch_params']['tmin'], 
+                                                      tmax=config['epoch_params']['tmax'])
                                 
-                                # Convert to DataFrame
-                                df = epochs.to_data_frame()
+                                # Optional artifact rejection and re-referencing
+                                rejection = apply_cleaning(dataset_name, epochs)
                                 
                                 # Add label encoding
                                 label_map = config['event_id']
                                 
-                                # Add label column
-                                df['label'] = df['condition'].map(label_map)
-                                
-                                # Rearrange columns, place label next to condition
-                                cols = df.columns.tolist()
-                                condition_idx = cols.index('condition')
-                                cols.insert(condition_idx + 1, 'label')
-                                cols.remove('label')
-                                df = df[cols]
-                                
                                 # Add data information attributes
-                                df.attrs['sampling_rate'] = raw.info['sfreq']
-                                df.attrs['electrodes'] = raw.ch_names
-                                df.attrs['reference'] = raw.info.get('description', 'unknown')
+                                attrs = {}
+                                attrs['sampling_rate'] = raw.info['sfreq']
+                                attrs['electrodes'] = raw.ch_names
+                                attrs['reference'] = raw.info.get('description', 'unknown')
                                 
                                 # Add dataset-specific attributes
                                 for key, value in config['attrs'].items():
-                                    df.attrs[key] = value
+                                    attrs[key] = value
+                                
+                                if rejection is not None:
+                                    attrs['rejection'] = rejection
                                 
-                                # Save as CSV file
+                                # Save in the selected output formats
                                 filename = f"subject_{subject}_session_{session}_run_{run.split('_')[-1]}_data.csv"
                                 filepath = os.path.join(save_dir, filename)
-                                df.to_csv(filepath, index=False)
+                                write_run(dataset_name, epochs, attrs, filepath, label_map)
                                 
                                 print(f"Saved data for subject {subject}, session {session}, run {run.split('_')[-1]}")
                                 
@@ -223,7 +687,8 @@ def process_bnci2014_001():
                         print(f"Error processing session {session} for subject {subject}: {str(e)}")
                         continue
                         
-                # If all sessions are successfully processed, break the retry loop
+                # If all sessions are successfully processed, release the raw files and break the retry loop
+                finish_subject(dataset_name, subject)
                 break
                 
             except Exception as e:
@@ -233,10 +698,11 @@ def process_bnci2014_001():
                     time.sleep(5)
                 else:
                     print(f"Failed to process subject {subject} after {max_retries} attempts")
+                    subject_failed(dataset_name, subject, e)
                     continue
 
 # Process BNCI2014_002 dataset
-def process_bnci2014_002():
+def process_bnci2014_002(subjects=None):
     dataset_name = 'BNCI2014_002'
     config = dataset_configs[dataset_name]
     save_dir = save_dirs[dataset_name]
@@ -245,69 +711,76 @@ def process_bnci2014_002():
     dataset = config['class']()
     
     # Get all subjects
-    subjects = dataset.subject_list
+    if subjects is None:
+        subjects = dataset.subject_list
     
     # Process data for each subject
     for subject in subjects:
         print(f"Processing {dataset_name} subject {subject}")
         
-        # Get raw data
-        data = dataset.get_data(subjects=[subject])
-        
-        # Get all sessions and runs for this subject
-        sessions = list(data[subject].keys())
-        
-        # Process each session
-        for session in sessions:
-            runs = list(data[subject][session].keys())
+        try:
+            # Get raw data
+            data = get_raw_data(dataset, dataset_name, subject)
             
-            for run in runs:
-                # Get raw data
-                raw = data[subject][session][run]
-                
-                # Only select EEG channels
-                raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
-                
-                # Apply bandpass filter (8-30Hz)
-                raw.filter(fmin, fmax)
-                
-                # Get event information
-                events, event_id = mne.events_from_annotations(raw)
-                
-                # Create epochs
-                epochs = mne.Epochs(raw, events, event_id, 
-                                  tmin=config['epoch_params']['tmin'], 
-                                  tmax=config['epoch_params']['tmax'],
-                                  baseline=None, preload=True)
-                
-                # Convert to DataFrame
-                df = epochs.to_data_frame()
-                
-                # Add label encoding
-                label_map = config['event_id']
-                
-                # Add label column
-                df['label'] = df['condition'].map(label_map)
-                
-                # Rearrange columns, place label next to condition
-                cols = df.columns.tolist()
-                condition_idx = cols.index('condition')
-                cols.insert(condition_idx + 1, 'label')
-                cols.remove('label')
-                df = df[cols]
-                
-                # Add data information attributes
-                for key, value in config['attrs'].items():
-                    df.attrs[key] = value
+            # Get all sessions and runs for this subject
+            sessions = list(data[subject].keys())
+            
+            # Process each session
+            for session in sessions:
+                runs = list(data[subject][session].keys())
                 
-                # Save to CSV file
-                output_file = os.path.join(save_dir, 
-                                         f'subject_{subject}_session_{session}_run_{run}_data.csv')
-                df.to_csv(output_file, index=False)
-                print(f"Saved data for subject {subject}, session {session}, run {run}")
+                for run in runs:
+                    # Get raw data
+                    raw = data[subject][session][run]
+                    
+                    # Only select EEG channels
+                    with stage(dataset_name, 'pick'):
+                        raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
+                    
+                    # Apply bandpass filter (8-30Hz)
+                    with stage(dataset_name, 'filter'):
+                        filter_engine.filter(raw, fmin, fmax)
+                    
+                    # Get event information
+                    with stage(dataset_name, 'events'):
+                        events, event_id = mne.events_from_annotations(raw)
+                    
+                    # Create epochs
+                    with stage(dataset_name, 'epoch'):
+                        epochs = epoch_run(raw, events, event_id, 
+                                          tmin=config['epoch_params']['tmin'], 
+                                          tmax=config['epoch_params']['tmax'])
+                    
+                    # Optional artifact rejection and re-referencing
+                    rejection = apply_cleaning(dataset_name, epochs)
+                    
+                    # Add label encoding
+                    label_map = config['event_id']
+                    
+                    # Add data information attributes
+                    attrs = {}
+                    for key, value in config['attrs'].items():
+                        attrs[key] = value
+                    
+                    if rejection is not None:
+                        attrs['rejection'] = rejection
+                    
+                    # Save in the selected output formats
+                    output_file = os.path.join(save_dir, 
+                                             f'subject_{subject}_session_{session}_run_{run}_data.csv')
+                    write_run(dataset_name, epochs, attrs, output_file, label_map)
+                    print(f"Saved data for subject {subject}, session {session}, run {run}")
+            
+            # All runs written, the raw files may now be evicted
+            finish_subject(dataset_name, subject)
+        except Exception as e:
+            # Includes DownloadTimeout: the watchdog has recorded it, go on with the next subject
+            print(f"Error processing subject {subject}: {str(e)}")
+            subject_failed(dataset_name, subject, e)
+            continue
 
 # Process Lee2019_MI dataset
-def process_lee2019_mi():
+def process_lee2019_mi(subjects=None):
     dataset_name = 'Lee2019_MI'
     config = dataset_configs[dataset_name]
     save_dir = save_dirs[dataset_name]
@@ -316,15 +789,49 @@ def process_lee2019_mi():
     dataset = config['class']()
     
     # Get all subjects
-    subjects = dataset.subject_list
+    if subjects is None:
+        subjects = dataset.subject_list
+    
+    # Clean, label and save one run's epochs
+    def save_run(epochs, subject, session, run):
+        # Optional artifact rejection and re-referencing
+        rejection = apply_cleaning(dataset_name, epochs)
+        
+        # Add label encoding
+        label_map = config['event_id']
+        
+        # Add data information attributes
+        attrs = {}
+        for key, value in config['attrs'].items():
+            attrs[key] = value
+        
+        if rejection is not None:
+            attrs['rejection'] = rejection
+        
+        # Save in the selected output formats
+        output_file = os.path.join(save_dir, 
+                                 f'subject_{subject}_session_{session}_run_{run}_data.csv')
+        write_run(dataset_name, epochs, attrs, output_file, label_map)
+        print(f"Saved data for subject {subject}, session {session}, run {run}")
     
     # Process data for each subject
     for subject in subjects:
         print(f"Processing {dataset_name} subject {subject}")
         
         try:
+            if lee2019_out_of_core:
+                # Read, filter and epoch each run from the MAT-files, a few channels at a time
+                paths = get_raw_data(dataset, dataset_name, subject, files_only=True)
+                for session, run, epochs in read_lee2019_subject(
+                        dataset, paths, filter_engine, fmin, fmax,
+                        tmin=config['epoch_params']['tmin'], tmax=config['epoch_params']['tmax'],
+                        stage=lambda name: stage(dataset_name, name)):
+                    save_run(epochs, subject, session, run)
+                finish_subject(dataset_name, subject)
+                continue
+            
             # Get data
-            data = dataset.get_data(subjects=[subject])
+            data = get_raw_data(dataset, dataset_name, subject)
             
             # Process data
             if subject in data:
@@ -334,51 +841,34 @@ def process_lee2019_mi():
                         raw = data[subject][session][run]
                         
                         # Only select EEG channels
-                        raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
+                        with stage(dataset_name, 'pick'):
+                            raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
                         
                         # Apply bandpass filter (8-30Hz)
-                        raw.filter(fmin, fmax)
+                        with stage(dataset_name, 'filter'):
+                            filter_engine.filter(raw, fmin, fmax)
                         
                         # Get event information
-                        events, event_id = mne.events_from_annotations(raw)
+                        with stage(dataset_name, 'events'):
+                            events, event_id = mne.events_from_annotations(raw)
                         
                         # Create epochs
-                        epochs = mne.Epochs(raw, events, event_id, 
-                                          tmin=config['epoch_params']['tmin'], 
-                                          tmax=config['epoch_params']['tmax'],
-                                          baseline=None, preload=True)
-                        
-                        # Convert to DataFrame
-                        df = epochs.to_data_frame()
-                        
-                        # Add label encoding
-                        label_map = config['event_id']
-                        
-                        # Add label column
-                        df['label'] = df['condition'].map(label_map)
+                        with stage(dataset_name, 'epoch'):
+                            epochs = epoch_run(raw, events, event_id, 
+                                              tmin=config['epoch_params']['tmin'], 
+                                              tmax=config['epoch_params']['tmax'])
                         
-                        # Rearrange columns, place label next to condition
-                        cols = df.columns.tolist()
-                        condition_idx = cols.index('condition')
-                        cols.insert(condition_idx + 1, 'label')
-                        cols.remove('label')
-                        df = df[cols]
-                        
-                        # Add data information attributes
-                        for key, value in config['attrs'].items():
-                            df.attrs[key] = value
-                        
-                        # Save to CSV file
-                        output_file = os.path.join(save_dir, 
-                                                 f'subject_{subject}_session_{session}_run_{run}_data.csv')
-                        df.to_csv(output_file, index=False)
-                        print(f"Saved data for subject {subject}, session {session}, run {run}")
+                        save_run(epochs, subject, session, run)
+            
+            # All runs written, the raw files may now be evicted
+            finish_subject(dataset_name, subject)
         except Exception as e:
             print(f"Error processing subject {subject}: {str(e)}")
+            subject_failed(dataset_name, subject, e)
             continue
 
 # Process PhysionetMI dataset
-def process_physionet_mi():
+def process_physionet_mi(subjects=None):
     dataset_name = 'PhysionetMI'
     config = dataset_configs[dataset_name]
     save_dir = save_dirs[dataset_name]
@@ -395,10 +885,9 @@ def process_physionet_mi():
     }
     
     # Process data for each subject
-    for subject in range(1, 110):  # 109 subjects
+    for subject in config['subjects'] if subjects is None else subjects:  # 109 subjects
         # Check if the subject has already been processed
-        subject_files = [f for f in os.listdir(save_dir) if f.startswith(f'subject_{subject}_')]
-        if subject_files:
+        if subject_outputs_exist(save_dir, subject):
             print(f"Subject {subject} already processed, skipping...")
             continue
             
@@ -407,7 +896,7 @@ def process_physionet_mi():
                 print(f"Processing {dataset_name} subject {subject} (attempt {retry + 1}/{max_retries})")
                 
                 # Get raw data
-                raw_data = dataset.get_data(subjects=[subject])
+                raw_data = get_raw_data(dataset, dataset_name, subject)
                 
                 # Get all runs for this subject
                 subject_data = raw_data[subject]['0']  # According to PhysionetMI class definition, data is stored under key '0'
@@ -429,7 +918,7 @@ def process_physionet_mi():
                         
                         # Check if the run has already been processed
                         run_file = f"subject_{subject}_run_{run_number}_data.csv"
-                        if os.path.exists(os.path.join(save_dir, run_file)):
+                        if run_outputs_exist(os.path.join(save_dir, run_file)):
                             print(f"Run {run_number} already processed, skipping...")
                             continue
                             
@@ -437,13 +926,16 @@ def process_physionet_mi():
                         raw = subject_data[run]
                         
                         # Only select EEG channels
-                        raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
+                        with stage(dataset_name, 'pick'):
+                            raw.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
                         
                         # Apply bandpass filter
-                        raw.filter(fmin, fmax, method='fir', phase='zero')
+                        with stage(dataset_name, 'filter'):
+                            filter_engine.filter(raw, fmin, fmax, method='fir')
                         
                         # Get event information
-                        events, event_dict = mne.events_from_annotations(raw)
+                        with stage(dataset_name, 'events'):
+                            events, event_dict = mne.events_from_annotations(raw)
                         
                         # Modify event mapping based on run type
                         # Original event mapping: {'T0': 1, 'T1': 2, 'T2': 3}
@@ -479,11 +971,11 @@ def process_physionet_mi():
                             print(f"No events found for subject {subject}, run {run_number}, skipping...")
                             continue
                             
-                        epochs = mne.Epochs(raw, events, available_events, tmin=tmin, tmax=tmax,
-                                          baseline=None, preload=True)
+                        with stage(dataset_name, 'epoch'):
+                            epochs = epoch_run(raw, events, available_events, tmin=tmin, tmax=tmax)
                         
-                        # Convert to DataFrame
-                        df = epochs.to_data_frame()
+                        # Optional artifact rejection and re-referencing
+                        rejection = apply_cleaning(dataset_name, epochs)
                         
                         # Add label encoding
                         label_map = {
@@ -494,28 +986,22 @@ def process_physionet_mi():
                             'feet': 5
                         }
                         
-                        # Add label column
-                        df['label'] = df['condition'].map(label_map)
-                        
-                        # Rearrange columns, place label next to condition
-                        cols = df.columns.tolist()
-                        condition_idx = cols.index('condition')
-                        cols.insert(condition_idx + 1, 'label')
-                        cols.remove('label')
-                        df = df[cols]
-                        
                         # Add data information attributes
-                        df.attrs['sampling_rate'] = raw.info['sfreq']
-                        df.attrs['electrodes'] = raw.ch_names
-                        df.attrs['reference'] = raw.info.get('description', 'unknown')
-                        df.attrs['trial_duration'] = f"{tmax - tmin} seconds ({tmin}s-{tmax}s)"
-                        df.attrs['run_type'] = run_type
-                        df.attrs['is_baseline'] = run_number in [1, 2]
+                        attrs = {}
+                        attrs['sampling_rate'] = raw.info['sfreq']
+                        attrs['electrodes'] = raw.ch_names
+                        attrs['reference'] = raw.info.get('description', 'unknown')
+                        attrs['trial_duration'] = f"{tmax - tmin} seconds ({tmin}s-{tmax}s)"
+                        attrs['run_type'] = run_type
+                        attrs['is_baseline'] = run_number in [1, 2]
+                        
+                        if rejection is not None:
+                            attrs['rejection'] = rejection
                         
-                        # Save as CSV file
+                        # Save in the selected output formats
                         filename = f"subject_{subject}_run_{run_number}_data.csv"
                         filepath = os.path.join(save_dir, filename)
-                        df.to_csv(filepath, index=False)
+                        write_run(dataset_name, epochs, attrs, filepath, label_map)
                         
                         print(f"Saved data for subject {subject}, run {run_number}")
                         
@@ -523,7 +1009,8 @@ def process_physionet_mi():
                         print(f"Error processing run {run_number} for subject {subject}: {str(e)}")
                         continue
                         
-                # If all runs are successfully processed, break the retry loop
+                # If all runs are successfully processed, release the raw files and break the retry loop
+                finish_subject(dataset_name, subject)
                 break
                 
             except Exception as e:
@@ -533,10 +1020,11 @@ def process_physionet_mi():
                     time.sleep(5)
                 else:
                     print(f"Failed to process subject {subject} after {max_retries} attempts")
+                    subject_failed(dataset_name, subject, e)
                     continue
 
 # Process Schirrmeister2017 dataset
-def process_schirrmeister2017():
+def process_schirrmeister2017(subjects=None):
     dataset_name = 'Schirrmeister2017'
     config = dataset_configs[dataset_name]
     save_dir = save_dirs[dataset_name]
@@ -548,63 +1036,57 @@ def process_schirrmeister2017():
     motor_cortex_channels = None  # Need to fill in the 44 motor cortex sensor indices in actual use
     
     def process_raw_data(raw_data, is_test=False, subject=None, run=None):
-        """Process raw data and return DataFrame"""
+        """Process raw data and return Epochs and their attributes"""
         try:
             # Select EEG channels
-            raw_data.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
-            
-            # If motor cortex channels are specified, only select these channels
-            if motor_cortex_channels is not None:
-                raw_data.pick_channels(motor_cortex_channels)
+            with stage(dataset_name, 'pick'):
+                raw_data.pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
+                
+                # If motor cortex channels are specified, only select these channels
+                if motor_cortex_channels is not None:
+                    raw_data.pick_channels(motor_cortex_channels)
             
             # Apply bandpass filter
-            raw_data.filter(fmin, fmax, method='fir', phase='zero')
+            with stage(dataset_name, 'filter'):
+                filter_engine.filter(raw_data, fmin, fmax, method='fir')
             
             # Get event information
-            try:
-                events, _ = mne.events_from_annotations(raw_data)
-            except ValueError:
-                events = np.array([[0, 0, 1]])
+            with stage(dataset_name, 'events'):
+                try:
+                    events, _ = mne.events_from_annotations(raw_data)
+                except ValueError:
+                    events = np.array([[0, 0, 1]])
             
             # Create epochs
-            epochs = mne.Epochs(raw_data, events, config['event_id'], 
-                              tmin=config['epoch_params']['tmin'], 
-                              tmax=config['epoch_params']['tmax'],
-                              baseline=None, preload=True)
-            
-            # Convert to DataFrame
-            df = epochs.to_data_frame()
-            
-            # Add label encoding
-            df['label'] = df['condition'].map(config['event_id'])
-            
-            # Rearrange columns, place label next to condition
-            cols = df.columns.tolist()
-            condition_idx = cols.index('condition')
-            cols.insert(condition_idx + 1, 'label')
-            cols.remove('label')
-            df = df[cols]
+            with stage(dataset_name, 'epoch'):
+                epochs = epoch_run(raw_data, events, config['event_id'], 
+                                  tmin=config['epoch_params']['tmin'], 
+                                  tmax=config['epoch_params']['tmax'])
             
-            # Add dataset split information
-            df['is_test'] = is_test
+            # Optional artifact rejection and re-referencing
+            rejection = apply_cleaning(dataset_name, epochs)
             
             # Add data information attributes
-            df.attrs['sampling_rate'] = raw_data.info['sfreq']
-            df.attrs['electrodes'] = raw_data.ch_names
-            df.attrs['reference'] = raw_data.info.get('description', 'unknown')
+            attrs = {}
+            attrs['sampling_rate'] = raw_data.info['sfreq']
+            attrs['electrodes'] = raw_data.ch_names
+            attrs['reference'] = raw_data.info.get('description', 'unknown')
             
             # Add dataset-specific attributes
             for key, value in config['attrs'].items():
-                df.attrs[key] = value
+                attrs[key] = value
             
-            return df
+            if rejection is not None:
+                attrs['rejection'] = rejection
+            
+            return epochs, attrs
         except Exception as e:
             print(f"Error processing data: {str(e)}")
-            return None
+            return None, None
     
-    def save_dataframe(df, subject, is_test, run=None):
-        """Save DataFrame to CSV file"""
-        if df is None:
+    def save_epochs_data(epochs, attrs, subject, is_test, run=None):
+        """Save epochs in the selected output formats"""
+        if epochs is None:
             return
         
         set_type = 'test' if is_test else 'train'
@@ -614,16 +1096,18 @@ def process_schirrmeister2017():
             filename = f"subject_{subject}_{set_type}_data.csv"
             
         filepath = os.path.join(save_dir, filename)
-        df.to_csv(filepath, index=False)
+        # Add dataset split information as a column
+        write_run(dataset_name, epochs, attrs, filepath, config['event_id'],
+                  extra_columns={'is_test': is_test})
         print(f"Saved {set_type} data to: {filepath}")
     
     # Process data for each subject
-    for subject in range(1, 15):  # 14 subjects
+    for subject in config['subjects'] if subjects is None else subjects:  # 14 subjects
         try:
             print(f"\nStarting to process subject {subject}")
             
             # Get raw data
-            raw_data = dataset.get_data(subjects=[subject])
+            raw_data = get_raw_data(dataset, dataset_name, subject)
             
             # Get training and testing data
             sessions = raw_data[subject]
@@ -632,43 +1116,423 @@ def process_schirrmeister2017():
             
             # Process training data
             print("Processing training data...")
-            train_df = process_raw_data(train_raw, is_test=False, subject=subject)
-            save_dataframe(train_df, subject, is_test=False)
+            train_epochs, train_attrs = process_raw_data(train_raw, is_test=False, subject=subject)
+            save_epochs_data(train_epochs, train_attrs, subject, is_test=False)
             
             # Process testing data
             print("Processing testing data...")
-            test_df = process_raw_data(test_raw, is_test=True, subject=subject)
-            save_dataframe(test_df, subject, is_test=True)
+            test_epochs, test_attrs = process_raw_data(test_raw, is_test=True, subject=subject)
+            save_epochs_data(test_epochs, test_attrs, subject, is_test=True)
+            
+            # Both sets written, the raw files may now be evicted
+            finish_subject(dataset_name, subject)
                     
         except Exception as e:
             print(f"Error processing subject {subject}: {str(e)}")
+            subject_failed(dataset_name, subject, e)
             continue
 
+# Processing function for each dataset, in the order they are run
+process_functions = {
+    'BNCI2014_001': process_bnci2014_001,
+    'BNCI2014_002': process_bnci2014_002,
+    'Lee2019_MI': process_lee2019_mi,
+    'PhysionetMI': process_physionet_mi,
+    'Schirrmeister2017': process_schirrmeister2017
+}
+
+# Process one subject of a dataset (the unit of work of the recycled worker processes)
+# (raises if the subject could not be processed, so the worker reports it as failed)
+def process_subject(dataset_name, subject):
+    n_failed = len(failed_subjects)
+    process_functions[dataset_name](subjects=[subject])
+    if len(failed_subjects) > n_failed:
+        raise RuntimeError(failed_subjects[-1]['error'])
+
+# Records a worker process made about one subject, sent back to the parent (see merge_subject_records)
+def collect_subject_records(dataset_name, subject):
+    records = {}
+    if download_watchdog is not None:
+        for key, entries in (('timed_out', download_watchdog.timed_out), ('stalls', download_watchdog.stalls),
+                             ('failures', download_watchdog.failures)):
+            records[key] = [entry for entry in entries
+                            if entry['dataset'] == dataset_name and entry['subject'] == subject]
+    if stage_profiler is not None:
+        records['profiles'] = stage_profiler.take()
+    return records
+
+# Add a worker's records about one subject to this process's watchdog and profiler
+def merge_subject_records(records):
+    if download_watchdog is not None:
+        download_watchdog.timed_out.extend(records.get('timed_out', []))
+        download_watchdog.stalls.extend(records.get('stalls', []))
+        download_watchdog.failures.extend(records.get('failures', []))
+    if stage_profiler is not None:
+        stage_profiler.merge(records.get('profiles', {}))
+
+# Remove the loose output files of a subject whose worker was stopped before it finished
+def remove_partial_outputs(dataset_name, subject):
+    save_dir = save_dirs[dataset_name]
+    for f in os.listdir(save_dir):
+        if f.startswith(f'subject_{subject}_') and not f.endswith('_pack.zip'):
+            os.remove(os.path.join(save_dir, f))
+
+# Dataset and subject a run's output file belongs to
+def run_owner(filepath):
+    save_dir = os.path.normpath(os.path.dirname(filepath))
+    dataset_name = next(name for name, path in save_dirs.items() if os.path.normpath(path) == save_dir)
+    return dataset_name, subject_of(os.path.basename(filepath))
+
+# Subjects with a run the writer processes could not write
+failed_writes = set()
+
+# A writer process reports on a run: when it could not be written, the subject is recorded as failed
+# and its outputs removed (also those written afterwards), so a rerun processes it again
+# Once a finished subject's last run is written, its raw files may be evicted (kept if a run failed, to redo it)
+def run_written(filepath, error):
+    owner = run_owner(filepath)
+    queued_runs[owner] = queued_runs.get(owner, 1) - 1
+    if error is not None and owner not in failed_writes:
+        print(f"Could not write {filepath}, removing the outputs of {owner[0]} subject {owner[1]}")
+        subject_failed(*owner, error)
+        failed_writes.add(owner)
+    if owner in failed_writes:
+        remove_partial_outputs(*owner)
+    
+    if not queued_runs[owner] and owner in pending_releases:
+        pending_releases.discard(owner)
+        if owner not in failed_writes:
+            raw_cache.mark_complete(f'{owner[0]}/{owner[1]}')
+            raw_cache.enforce_quota()
+
+# Parse command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description='Download and process MOABB motor imagery datasets')
+    parser.add_argument('--datasets', nargs='+', choices=list(dataset_configs.keys()),
+                        default=list(dataset_configs.keys()),
+                        help='Datasets to process (default: all)')
+    parser.add_argument('--plan', action='store_true',
+                        help='Estimate disk, memory and time per dataset without downloading anything')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Download bandwidth in MB/s, used by --plan to estimate download time')
+    parser.add_argument('--formats', nargs='+', choices=['csv', 'npy'], default=['csv'],
+                        help='Output formats to write for every run (default: csv)')
+    parser.add_argument('--compact-tables', action='store_true',
+                        help='Build run tables with float32 channels and categorical/small integer columns '
+                             '(less memory; CSV values are written with float32 precision)')
+    parser.add_argument('--fast-csv', action='store_true',
+                        help='Write CSVs with the multi-process writer (same bytes as pandas, several times faster)')
+    parser.add_argument('--csv-jobs', type=int, default=None,
+                        help='Processes formatting CSV rows with --fast-csv (default: all cores)')
+    parser.add_argument('--csv-compression', choices=list(csv_compressions), default=None,
+                        help='Compress CSVs while writing them (<name>_data.csv.gz etc.; implies --fast-csv)')
+    parser.add_argument('--shards', action='store_true',
+                        help='After processing, write the epochs of each dataset into shuffled fixed-size tar shards '
+                             '(<save_dir>/shards, from the npy epoch arrays: use with --formats npy)')
+    parser.add_argument('--shard-size', type=parse_size, default=256 * 1024 ** 2,
+                        help='Approximate size of each tar shard, e.g. 512M (default: 256M)')
+    parser.add_argument('--shard-seed', type=int, default=0,
+                        help='Seed of the random assignment of trials to shards')
+    parser.add_argument('--pack', choices=['subject', 'dataset'], default=None,
+                        help='Move the run files of each finished subject into one container per subject '
+                             '(subject_<n>_pack.zip) or per dataset (dataset_pack.zip)')
+    parser.add_argument('--pack-existing', action='store_true',
+                        help='Move the already written run files of the selected datasets into containers '
+                             '(grouped as given by --pack, default: subject) and exit')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the outputs of the selected datasets against their expected subjects and runs '
+                             '(headers, sizes, last CSV rows) and exit; writes ./verify_report.json')
+    parser.add_argument('--verify-checksums', action='store_true',
+                        help='With --verify, also read every data file in full and compare its CRC32')
+    parser.add_argument('--verify-jobs', type=int, default=8,
+                        help='Threads checking runs with --verify (default: 8)')
+    parser.add_argument('--direct-epoching', action='store_true',
+                        help='Cut epochs with one NumPy copy per epoch instead of mne.Epochs '
+                             '(identical epochs; runs with projections or BAD annotations still use mne.Epochs)')
+    parser.add_argument('--lee-out-of-core', action='store_true',
+                        help='Read Lee2019_MI runs from the MAT-files a few channels at a time '
+                             '(same outputs, without holding a session in memory)')
+    parser.add_argument('--clean', action='store_true',
+                        help='Drop epochs failing peak-to-peak / flat thresholds before writing (see cleaning_params)')
+    parser.add_argument('--writers', type=int, default=0,
+                        help='Number of writer processes serializing outputs from shared memory (0 = write inline)')
+    parser.add_argument('--writer-buffers', type=int, default=4,
+                        help='Number of shared-memory buffers between compute and writers (bounds memory use)')
+    parser.add_argument('--writer-buffer-mb', type=int, default=512,
+                        help='Size of each shared-memory buffer in MB (must hold the largest run)')
+    parser.add_argument('--subject-workers', type=int, default=0,
+                        help='Process subjects in this many worker processes that are recycled as set below '
+                             '(0 = process them in this process)')
+    parser.add_argument('--worker-max-subjects', type=int, default=None,
+                        help='Replace a worker process after this many subjects')
+    parser.add_argument('--worker-max-rss', type=parse_size, default=None,
+                        help='Replace a worker process after a subject once its resident memory exceeds this, '
+                             'e.g. 8G')
+    parser.add_argument('--worker-hard-rss', type=parse_size, default=None,
+                        help='Stop a worker process exceeding this resident memory in the middle of a subject; '
+                             'the subject is retried in a new worker')
+    parser.add_argument('--schedule', choices=['dataset', 'global'], default='dataset',
+                        help="'dataset' processes the datasets one after another; 'global' puts the subjects of all "
+                             "selected datasets in one queue, longest first by channels x samples x runs, served "
+                             "to the subject workers (or processed in this process without --subject-workers) and "
+                             "reports the makespan")
+    parser.add_argument('--stall-timeout', type=float, default=None,
+                        help='Cancel and retry a download that receives no data for this many seconds')
+    parser.add_argument('--subject-deadline', type=float, default=None,
+                        help='Give up on a subject whose download takes longer than this many seconds in total')
+    parser.add_argument('--download-attempts', type=int, default=3,
+                        help='Download attempts per subject under the watchdog (default: 3)')
+    parser.add_argument('--filter-jobs', type=int, default=None,
+                        help='Threads used to band-pass the channels of each run (default: all cores, '
+                             'divided between the subject workers)')
+    parser.add_argument('--raw-cache-limit', type=parse_size, default=None,
+                        help='Disk quota for raw downloads in ./data, e.g. 50G; least recently used raw files '
+                             'of fully processed subjects are deleted to stay under it (default: no limit)')
+    parser.add_argument('--profile', nargs='?', const='./profiles', default=None, metavar='DIR',
+                        help='Profile every pipeline stage with cProfile; writes <dataset>_<stage>.prof files '
+                             'and summary.txt to DIR (default: ./profiles)')
+    parser.add_argument('--profile-top', type=int, default=20,
+                        help='Number of hottest functions per stage listed in the profile summary')
+    parser.add_argument('--features', nargs='+', choices=list(feature_params.keys()), default=[],
+                        help='Feature stages to compute after epoching and store next to each run')
+    parser.add_argument('--tfr', action='store_true',
+                        help='Compute time-frequency maps of every epoch and cache them next to each run (see tfr_params)')
+    parser.add_argument('--tfr-method', choices=['morlet', 'stft'], default=None,
+                        help=f"Time-frequency method (default: {tfr_params['method']})")
+    parser.add_argument('--tfr-freqs', nargs='+', type=float, default=None,
+                        help='Frequencies of the time-frequency maps in Hz')
+    parser.add_argument('--tfr-decim', type=int, default=None,
+                        help=f"Keep every n-th time point of the maps (default: {tfr_params['decim']})")
+    parser.add_argument('--montage', nargs='+', default=None,
+                        help="Build a channel index mapping every selected dataset to a common montage: "
+                             f"'intersection', a named set ({', '.join(montages)}) or a list of channel names")
+    parser.add_argument('--harmonize-outputs', action='store_true',
+                        help='Write runs with only the common montage channels, in common order (needs --montage)')
+    parser.add_argument('--benchmark-loader', action='store_true',
+                        help='Compare batches/s of the prefetching npy batch loader with reading the CSVs')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='Batch size for --benchmark-loader')
+    parser.add_argument('--shuffle', choices=['random', 'balanced'], default='random',
+                        help='Shuffling of the batch loader for --benchmark-loader')
+    parser.add_argument('--loader-workers', type=int, default=2,
+                        help='Background threads prefetching batches for --benchmark-loader')
+    parser.add_argument('--stream', action='store_true',
+                        help='Replay recorded runs through the streaming pipeline and report epoch latency')
+    parser.add_argument('--subject', type=int, default=1,
+                        help='Subject to replay with --stream')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed for --stream (1 = real time, 0 = as fast as possible)')
+    parser.add_argument('--chunk-duration', type=float, default=0.1,
+                        help='Chunk length in seconds for --stream')
+    parser.add_argument('--stream-filter', choices=['fir', 'iir'], default='fir',
+                        help='Causal filter used by --stream')
+    return parser.parse_args()
+
+# Replay recorded runs through the streaming pipeline
+def stream(dataset_name, subject, speed=1.0, chunk_duration=0.1, method='fir'):
+    config = dataset_configs[dataset_name]
+    for session, run, source in replay_moabb(config, subject, chunk_duration=chunk_duration, speed=speed):
+        print(f"\nStreaming {dataset_name} subject {subject}, session {session}, run {run}")
+        pipeline = StreamingPipeline(config, len(source.raw.ch_names), source.sfreq, fmin, fmax, method=method)
+        benchmark_latency(pipeline, source)
+
+# Save a summary of the run, including subjects whose downloads timed out
+def write_run_report(report):
+    report['finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+    if download_watchdog is not None:
+        report['download_timeouts'] = download_watchdog.timed_out
+        report['download_stalls'] = download_watchdog.stalls
+        report['download_failures'] = download_watchdog.failures
+        for entry in download_watchdog.timed_out:
+            print(f"Download timed out: {entry['dataset']} subject {entry['subject']}")
+    
+    with open(run_report_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Run report saved to {run_report_path}")
+
 # Main function
 def main():
+    args = parse_args()
+    enabled_features.extend(args.features)
+    output_formats[:] = args.formats
+    if args.clean:
+        cleaning_params['enabled'] = True
+    global compact_tables, direct_epoching, lee2019_out_of_core, tfr_enabled
+    compact_tables = args.compact_tables
+    direct_epoching = args.direct_epoching
+    lee2019_out_of_core = args.lee_out_of_core
+    tfr_enabled = args.tfr
+    for key in ('method', 'freqs', 'decim'):
+        if getattr(args, f'tfr_{key}') is not None:
+            tfr_params[key] = getattr(args, f'tfr_{key}')
+    
+    # Dry run: only estimate resources
+    if args.plan:
+        plan(dataset_configs, args.datasets, bandwidth=args.bandwidth, fmin=fmin, fmax=fmax)
+        return
+    
+    # Compare training input throughput on already processed runs
+    if args.benchmark_loader:
+        for dataset_name in args.datasets:
+            print(f"\nBatch loading benchmark for {dataset_name}:")
+            benchmark_loader(save_dirs[dataset_name], dataset_configs[dataset_name]['event_id'],
+                             args.batch_size, args.shuffle, args.loader_workers)
+        return
+    
+    # Online mode: replay recorded runs as live streams
+    if args.stream:
+        for dataset_name in args.datasets:
+            stream(dataset_name, args.subject, speed=args.speed,
+                   chunk_duration=args.chunk_duration, method=args.stream_filter)
+        return
+    
+    # Compaction only: move existing run files into containers
+    if args.pack_existing:
+        for dataset_name in args.datasets:
+            moved = compact_directory(save_dirs[dataset_name], args.pack or 'subject')
+            print(f"Packed {moved} files of {dataset_name} into containers")
+        return
+    
+    # Integrity check of the written outputs
+    if args.verify:
+        start = time.perf_counter()
+        results = verify_outputs(dataset_configs, save_dirs, args.datasets, args.verify_jobs, args.verify_checksums)
+        print_verification(results)
+        with open(verify_report_path, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"\nVerified in {time.perf_counter() - start:.1f} s, report saved to {verify_report_path}")
+        return
+    
+    # Channel mapping to a common montage, optionally applied to the written runs
+    global channel_index, harmonize_outputs
+    if args.montage:
+        named = len(args.montage) == 1 and (args.montage[0] == 'intersection' or args.montage[0] in montages)
+        montage = args.montage[0] if named else args.montage
+        channel_index = build_montage_index(args.datasets, montage)
+        harmonize_outputs = args.harmonize_outputs
+    
+    # Watch downloads for stalls and per-subject deadlines
+    global download_watchdog
+    if args.stall_timeout is not None or args.subject_deadline is not None:
+        download_watchdog = DownloadWatchdog(download_dir, args.stall_timeout or 120,
+                                             args.subject_deadline or 3600, args.download_attempts)
+    
     print("Starting to download and process all datasets...")
     
-    # Process BNCI2014_001 dataset
-    print("\nProcessing BNCI2014_001 dataset...")
-    process_bnci2014_001()
+    # Threads for channel-parallel filtering (each subject worker gets its share of the cores)
+    if args.filter_jobs is not None:
+        filter_engine.n_jobs = args.filter_jobs
+    elif args.subject_workers > 1:
+        filter_engine.n_jobs = max(1, (os.cpu_count() or 1) // args.subject_workers)
+    
+    # Keep raw downloads under the disk quota
+    global raw_cache
+    if args.raw_cache_limit is not None:
+        raw_cache = RawCache(download_dir, args.raw_cache_limit)
     
-    # Process BNCI2014_002 dataset
-    print("\nProcessing BNCI2014_002 dataset...")
-    process_bnci2014_002()
+    # Format CSV rows in parallel, compressing on the fly
+    global csv_writer
+    if args.fast_csv or args.csv_compression:
+        csv_writer = CsvWriter(args.csv_jobs or os.cpu_count(), compression=args.csv_compression)
     
-    # Process Lee2019_MI dataset
-    print("\nProcessing Lee2019_MI dataset...")
-    process_lee2019_mi()
+    # Start dedicated writer processes
+    global writer_pool
+    if args.writers > 0:
+        writer_pool = SharedMemoryWriterPool(args.writers, args.writer_buffers,
+                                             args.writer_buffer_mb * 1024 ** 2, csv_writer, on_written=run_written)
     
-    # Process PhysionetMI dataset
-    print("\nProcessing PhysionetMI dataset...")
-    process_physionet_mi()
+    # Profile each stage of each dataset
+    global stage_profiler
+    if args.profile:
+        stage_profiler = StageProfiler(args.profile, args.profile_top)
     
-    # Process Schirrmeister2017 dataset
-    print("\nProcessing Schirrmeister2017 dataset...")
-    process_schirrmeister2017()
+    # Pack outputs as subjects finish
+    global pack_mode
+    pack_mode = args.pack
+    
+    # Process subjects in worker processes that are replaced before memory piles up
+    worker_pool = None
+    if args.subject_workers > 0:
+        if writer_pool is not None:
+            print("--subject-workers cannot be combined with --writers; writing inline in the workers")
+            writer_pool.close()
+            writer_pool = None
+        worker_pool = RecyclingWorkerPool(process_subject, args.subject_workers, args.worker_max_subjects,
+                                          args.worker_max_rss, args.worker_hard_rss,
+                                          on_interrupt=remove_partial_outputs, collect_records=collect_subject_records,
+                                          merge_records=merge_subject_records)
+    
+    report = {'started': datetime.datetime.now().isoformat(timespec='seconds'), 'datasets': args.datasets}
+    try:
+        if args.schedule == 'global':
+            # One queue of all datasets' subjects, most expensive first
+            units = global_schedule(dataset_configs, args.datasets)
+            print(f"\nProcessing {len(units)} subjects of {len(args.datasets)} datasets, longest first...")
+            start = time.perf_counter()
+            if worker_pool is not None:
+                worker_pool.run(units)
+                timings = worker_pool.timings
+            else:
+                timings = []
+                for dataset_name, subject in units:
+                    unit_start = time.perf_counter()
+                    try:
+                        process_subject(dataset_name, subject)
+                    except RuntimeError as e:
+                        print(f"Error processing {dataset_name} subject {subject}: {str(e)}")
+                    timings.append({'dataset': dataset_name, 'subject': subject,
+                                    'seconds': time.perf_counter() - unit_start})
+            report['schedule'] = makespan_report(timings, max(args.subject_workers, 1),
+                                                 time.perf_counter() - start)
+            print_makespan(report['schedule'])
+        else:
+            for dataset_name in args.datasets:
+                print(f"\nProcessing {dataset_name} dataset...")
+                if worker_pool is not None:
+                    worker_pool.run([(dataset_name, subject)
+                                     for subject in dataset_configs[dataset_name]['subjects']])
+                else:
+                    process_functions[dataset_name]()
+        
+        # Bring feature and time-frequency caches of previously processed runs up to date
+        for dataset_name in args.datasets:
+            refresh_feature_cache(dataset_name)
+            refresh_tfr_cache(dataset_name)
+    finally:
+        # Wait for pending writes and release shared memory
+        if writer_pool is not None:
+            writer_pool.close()
+            writer_pool = None
+        
+        # Subjects finished while their runs were still being written
+        for dataset_name, subject in pending_packs:
+            pack_subject(dataset_name, subject)
+        
+        if worker_pool is not None:
+            report['workers'] = worker_pool.report()
+        else:
+            report['failed'] = failed_subjects
+        
+        # Merge the runs' normalization statistics per subject and dataset
+        for dataset_name in args.datasets:
+            save_norm_stats(save_dirs[dataset_name])
+        filter_engine.close()
+        if csv_writer is not None:
+            csv_writer.close()
+        write_run_report(report)
+        if stage_profiler is not None:
+            stage_profiler.save()
+    
+    # Shuffled tar shards for streaming training reads
+    if args.shards:
+        for dataset_name in args.datasets:
+            try:
+                shard_dir = write_shards(save_dirs[dataset_name], args.shard_size, args.shard_seed)
+                print(f"Wrote tar shards of {dataset_name} to {shard_dir}")
+            except ValueError as e:
+                print(f"Could not write shards of {dataset_name}: {str(e)}")
     
     print("\nAll datasets processing completed!")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,96 @@
+import os
+import json
+import zlib
+import numpy as np
+
+# File extensions of compressed CSV outputs, by compression method
+csv_compressions = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zstd': '.zst'}
+
+
+def epochs_path(filepath):
+    """Path of a run's epoch array, next to its CSV"""
+    return filepath.replace('_data.csv', '_epochs.npy')
+
+
+def meta_path(filepath):
+    """Path of a run's metadata sidecar, next to its CSV"""
+    return filepath.replace('_data.csv', '_meta.json')
+
+
+def csv_file(filepath):
+    """Path of a run's CSV as written, plain or compressed (filepath itself if there is none)"""
+    for path in [filepath] + [filepath + ext for ext in csv_compressions.values()]:
+        if os.path.exists(path):
+            return path
+    return filepath
+
+
+def csv_run_path(path):
+    """Run data path (..._data.csv) of a plain or compressed CSV, or None for other files"""
+    for ext in [''] + list(csv_compressions.values()):
+        if path.endswith('_data.csv' + ext):
+            return path[:len(path) - len(ext)]
+    return None
+
+
+def run_outputs_exist(filepath):
+    """Whether a run was already written in any output format"""
+    return os.path.exists(csv_file(filepath)) or os.path.exists(epochs_path(filepath))
+
+
+def file_checksum(path, offset=0, size=None, chunk=16 * 1024 ** 2):
+    """CRC32 of a file, or of `size` bytes from `offset` (e.g. a member stored in a container)"""
+    crc = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = os.path.getsize(path) - offset if size is None else size
+        while remaining > 0:
+            block = f.read(min(chunk, remaining))
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            remaining -= len(block)
+    return crc
+
+
+def read_npy_header(f):
+    """Shape, Fortran order, dtype and header length of the .npy array starting at f's position"""
+    start = f.tell()
+    version = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+        np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(f)
+    return shape, fortran_order, dtype, f.tell() - start
+
+
+def save_epochs(filepath, data, dtype=None):
+    """Store a run's (n_epochs, n_channels, n_times) array as .npy (memory-mappable)"""
+    np.save(epochs_path(filepath), data if dtype is None else data.astype(dtype))
+
+
+def save_run_meta(filepath, meta):
+    """Store a run's metadata (attrs, epoch index, channels) as JSON"""
+    with open(meta_path(filepath), 'w') as f:
+        json.dump(meta, f, indent=1, default=str)
+
+
+def load_run_meta(filepath):
+    """Load a run's metadata sidecar"""
+    with open(meta_path(filepath)) as f:
+        return json.load(f)
+
+
+def load_epochs(filepath, mmap=True):
+    """Load a run's epoch array and metadata.
+
+    With mmap=True the array is memory-mapped read-only, so only the
+    epochs that are actually accessed are read from disk.
+    """
+    data = np.load(epochs_path(filepath), mmap_mode='r' if mmap else None)
+    return data, load_run_meta(filepath)
+
+
+def list_runs(save_dir):
+    """Data file paths of all runs in a dataset directory that have metadata"""
+    return [os.path.join(save_dir, f.replace('_meta.json', '_data.csv'))
+            for f in sorted(os.listdir(save_dir)) if f.endswith('_meta.json')]
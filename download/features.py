@@ -0,0 +1,146 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy import signal
+from scipy.integrate import trapezoid
+from epoch_store import csv_file
+
+
+def feature_path(filepath, feature):
+    """Path of a feature file stored next to a run's data file"""
+    return filepath.replace('_data.csv', f'_{feature}.npz')
+
+
+def feature_fingerprint(epoch_info, params):
+    """Hash of everything a cached feature depends on.
+
+    epoch_info holds the dataset's epoching/filtering settings from
+    dataset_configs (epoch_params, event_id, band); params holds the
+    feature's own settings. A cached file whose fingerprint differs is stale.
+    """
+    payload = json.dumps({'epochs': epoch_info, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def epoch_index(epochs, label_map):
+    """Epoch ids, conditions and labels in the same order as the run's CSV rows"""
+    rev_event_id = {v: k for k, v in epochs.event_id.items()}
+    conditions = np.array([rev_event_id[k] for k in epochs.events[:, 2]])
+    labels = np.array([label_map.get(c, -1) for c in conditions])
+    return np.asarray(epochs.selection), conditions, labels
+
+
+def save_features(path, fingerprint, epoch_ids, conditions, labels, ch_names, **arrays):
+    """Store feature arrays together with the epoch index and fingerprint"""
+    np.savez(path, fingerprint=fingerprint, epoch=np.asarray(epoch_ids), condition=np.asarray(conditions, dtype=str),
+             label=np.asarray(labels), ch_names=np.asarray(ch_names, dtype=str), **arrays)
+
+
+def load_features(path, fingerprint=None):
+    """Load a cached feature file, or return None if it is missing or stale"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        if fingerprint is not None and str(cached['fingerprint']) != fingerprint:
+            return None
+        return {key: cached[key] for key in cached.files}
+
+
+def read_run_csv(filepath, label_map, pack=None):
+    """Rebuild the epochs array of a run from its CSV (read from `pack`, a RunPack, if given).
+
+    Returns data (n_epochs, n_channels, n_times) in Volts, epoch ids,
+    conditions, labels, channel names and sampling rate.
+    """
+    df = pd.read_csv(csv_file(filepath)) if pack is None else pack.read_csv(filepath)
+    ch_names = [c for c in df.columns if c not in ('time', 'condition', 'epoch', 'label', 'is_test')]
+    epoch_ids, first_rows = np.unique(df['epoch'].to_numpy(), return_index=True)
+    n_epochs = len(epoch_ids)
+    n_times = len(df) // n_epochs
+    times = df['time'].to_numpy()[:n_times]
+
+    # Rows are ordered by epoch then time; to_data_frame writes EEG in microvolts
+    data = df[ch_names].to_numpy().reshape(n_epochs, n_times, len(ch_names)).transpose(0, 2, 1) / 1e6
+    conditions = df['condition'].to_numpy()[np.sort(first_rows)]
+    labels = np.array([label_map.get(c, -1) for c in conditions])
+    sfreq = 1. / np.median(np.diff(times))
+    return data, df['epoch'].to_numpy()[np.sort(first_rows)], conditions, labels, ch_names, sfreq
+
+
+def compute_covariances(data, shrinkage=None):
+    """Spatial covariance of every epoch in one batched call.
+
+    data has shape (n_epochs, n_channels, n_times); the result has shape
+    (n_epochs, n_channels, n_channels). shrinkage can be None (empirical),
+    a float in [0, 1] (fixed shrinkage towards a scaled identity),
+    'ledoit_wolf' or 'oas'; the estimators match scikit-learn's
+    ledoit_wolf / OAS applied to each epoch separately.
+    """
+    X = data - data.mean(axis=-1, keepdims=True)
+    n_epochs, n_channels, n_times = X.shape
+    cov = X @ X.transpose(0, 2, 1) / n_times
+    if shrinkage is None:
+        return cov
+
+    mu = np.trace(cov, axis1=1, axis2=2) / n_channels
+    if shrinkage == 'ledoit_wolf':
+        X2 = X ** 2
+        beta_ = (X2 @ X2.transpose(0, 2, 1)).sum(axis=(1, 2))
+        delta_ = (cov ** 2).sum(axis=(1, 2))
+        beta = (beta_ / n_times - delta_) / (n_channels * n_times)
+        delta = (delta_ - 2 * mu * mu * n_channels + n_channels * mu ** 2) / n_channels
+        beta = np.minimum(beta, delta)
+        alpha = np.divide(beta, delta, out=np.zeros_like(beta), where=delta != 0)
+    elif shrinkage == 'oas':
+        mean_sq = (cov ** 2).mean(axis=(1, 2))
+        num = mean_sq + mu ** 2
+        den = (n_times + 1) * (mean_sq - mu ** 2 / n_channels)
+        alpha = np.minimum(np.divide(num, den, out=np.ones_like(num), where=den != 0), 1.)
+    else:
+        alpha = np.full(n_epochs, float(shrinkage))
+
+    alpha = alpha[:, None, None]
+    return (1 - alpha) * cov + alpha * mu[:, None, None] * np.eye(n_channels)
+
+
+def covariance_stage(data, sfreq, shrinkage=None):
+    """Feature stage: per-epoch spatial covariance"""
+    return {'cov': compute_covariances(data, shrinkage)}
+
+
+def compute_band_power(data, sfreq, bands, seg_duration=1.):
+    """Welch PSD and log band power of every epoch and channel in one batched pass.
+
+    data has shape (n_epochs, n_channels, n_times); bands maps a band name to
+    (fmin, fmax) in Hz. Returns freqs, psd (n_epochs, n_channels, n_freqs)
+    and log10 band power (n_epochs, n_channels, n_bands), as float32.
+    """
+    n_per_seg = min(data.shape[-1], int(round(seg_duration * sfreq)))
+    freqs, psd = signal.welch(data, fs=sfreq, nperseg=n_per_seg, axis=-1)
+
+    band_power = np.empty(data.shape[:2] + (len(bands),))
+    for i, (low, high) in enumerate(bands.values()):
+        mask = (freqs >= low) & (freqs <= high)
+        band_power[..., i] = trapezoid(psd[..., mask], freqs[mask], axis=-1)
+    return freqs, psd.astype(np.float32), np.log10(band_power).astype(np.float32)
+
+
+def psd_stage(data, sfreq, bands, seg_duration=1.):
+    """Feature stage: Welch PSD and log band power"""
+    freqs, psd, band_power = compute_band_power(data, sfreq, bands, seg_duration)
+    return {
+        'freqs': freqs.astype(np.float32),
+        'psd': psd,
+        'band_power': band_power,
+        'bands': np.array(list(bands.keys())),
+        'band_edges': np.array(list(bands.values()), dtype=np.float32)
+    }
+
+
+# Feature stages available after epoching, by name
+feature_stages = {
+    'covariance': covariance_stage,
+    'psd': psd_stage
+}
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+import scipy.fft
+import mne
+from concurrent.futures import ThreadPoolExecutor
+
+# Annotations at which raw.filter filters segments separately (concatenated recordings)
+SKIP_ANNOTATIONS = ('edge', 'bad_acq_skip')
+
+
+def fft_length(n_h, n_x):
+    """FFT block length for overlap-add, chosen with the same cost model as MNE"""
+    min_fft = 2 * n_h - 1
+    if n_x < min_fft:
+        return scipy.fft.next_fast_len(min_fft)
+    sizes = 2 ** np.arange(np.ceil(np.log2(min_fft)), np.ceil(np.log2(n_x)) + 1, dtype=int)
+    cost = np.ceil(n_x / (sizes - n_h + 1).astype(np.float64)) * sizes * (np.log2(sizes) + 1)
+    cost += 4e-5 * sizes * n_x
+    return int(sizes[np.argmin(cost)])
+
+
+def overlap_add(x, H, n_h, n_fft):
+    """Zero-phase FIR filter one channel with all overlap-add blocks in one batched FFT.
+
+    Gives the same result as MNE's zero-phase FIR filtering: the signal is
+    padded by odd reflection of its edges ('reflect_limited'), cut into
+    blocks of n_fft - n_h + 1 samples, every block is transformed at once,
+    and the filtered blocks are summed back with the kernel's delay removed.
+    """
+    n_times = len(x)
+    n_edge = n_h - 1
+    n_x = n_times + 2 * n_edge
+    n_seg = n_fft - n_h + 1
+    n_blocks = -(-n_x // n_seg)
+
+    # Padded signal, laid out directly as the first n_seg samples of each block
+    x_ext = np.zeros(n_blocks * n_seg)
+    x_ext[:n_edge] = 2 * x[0] - x[n_edge:0:-1]
+    x_ext[n_edge:n_edge + n_times] = x
+    x_ext[n_edge + n_times:n_x] = 2 * x[-1] - x[-2:-n_edge - 2:-1]
+    blocks = np.zeros((n_blocks, n_fft))
+    blocks[:, :n_seg] = x_ext.reshape(n_blocks, n_seg)
+
+    spectrum = scipy.fft.rfft(blocks, axis=-1, overwrite_x=True)
+    spectrum *= H
+    prod = scipy.fft.irfft(spectrum, n_fft, axis=-1, overwrite_x=True)
+
+    # Each block's tail (n_h - 1 < n_seg samples) overlaps the start of the next block
+    out = x_ext.reshape(n_blocks, n_seg)
+    out[:] = prod[:, :n_seg]
+    out[1:, :n_h - 1] += prod[:-1, n_seg:]
+
+    shift = (n_h - 1) // 2 + n_edge
+    return x_ext[shift:shift + n_times]
+
+
+class FilterEngine:
+    """Band-pass filtering with cached designs and channel-parallel FIR application.
+
+    Designs are made once per (sfreq, l_freq, h_freq, method) with the same
+    defaults as raw.filter and reused for every run. FIR kernels are applied
+    with batched overlap-add FFTs, one channel per task on a thread pool
+    (the FFTs release the GIL), so a single long run uses all n_jobs cores.
+    """
+
+    def __init__(self, n_jobs=None):
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.designs = {}
+        self.spectra = {}
+        self.executor = None
+
+    def design(self, sfreq, l_freq, h_freq, method='fir'):
+        """Filter design for a band, made on first use: FIR kernel or IIR parameters"""
+        key = (float(sfreq), l_freq, h_freq, method)
+        if key not in self.designs:
+            self.designs[key] = mne.filter.create_filter(
+                None, sfreq, l_freq, h_freq, method=method, phase='zero',
+                fir_window='hamming', fir_design='firwin', verbose=False)
+        return self.designs[key]
+
+    def kernel_spectrum(self, h, key, n_fft):
+        """FFT of a cached FIR kernel for one block length"""
+        if (key, n_fft) not in self.spectra:
+            self.spectra[(key, n_fft)] = scipy.fft.rfft(h, n_fft)
+        return self.spectra[(key, n_fft)]
+
+    def filter_array(self, data, sfreq, l_freq, h_freq):
+        """Zero-phase FIR band-pass of a (n_channels, n_times) array, returns a new array"""
+        key = (float(sfreq), l_freq, h_freq, 'fir')
+        h = self.design(sfreq, l_freq, h_freq)
+        n_h = len(h)
+        n_fft = fft_length(n_h, data.shape[1] + 2 * (n_h - 1))
+        H = self.kernel_spectrum(h, key, n_fft)
+
+        if self.executor is None and self.n_jobs > 1:
+            self.executor = ThreadPoolExecutor(self.n_jobs)
+        out = np.empty(data.shape)
+        if self.executor is None:
+            filtered = (overlap_add(row, H, n_h, n_fft) for row in data)
+        else:
+            filtered = self.executor.map(lambda row: overlap_add(row, H, n_h, n_fft), data)
+        for idx, row in enumerate(filtered):
+            out[idx] = row
+        return out
+
+    def filter(self, raw, l_freq, h_freq, method='fir'):
+        """Band-pass the data channels of a preloaded Raw in place, like raw.filter"""
+        sfreq = raw.info['sfreq']
+        design = self.design(sfreq, l_freq, h_freq, method)
+
+        # Cases the batched FIR path does not cover are left to MNE, with the cached design
+        segmented = any(desc.lower().startswith(SKIP_ANNOTATIONS) for desc in raw.annotations.description)
+        if method != 'fir' or segmented or len(design) > raw.n_times:
+            if method == 'fir':
+                return raw.filter(l_freq, h_freq, method='fir', phase='zero', n_jobs=self.n_jobs)
+            return raw.filter(l_freq, h_freq, method=method, iir_params=design, n_jobs=self.n_jobs)
+
+        raw.apply_function(lambda data: self.filter_array(data, sfreq, l_freq, h_freq),
+                           picks='data', channel_wise=False, verbose=False)
+
+        # Record the new pass band, as raw.filter does
+        with raw.info._unlock():
+            if l_freq is not None and l_freq > (raw.info['highpass'] or 0):
+                raw.info['highpass'] = float(l_freq)
+            if h_freq is not None and h_freq < raw.info['lowpass']:
+                raw.info['lowpass'] = float(h_freq)
+        return raw
+
+    def close(self):
+        """Stop the worker threads"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
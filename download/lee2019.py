@@ -0,0 +1,109 @@
+import numpy as np
+import mne
+from contextlib import nullcontext
+from moabb.datasets.preprocessing import SetRawAnnotations
+from matfile import read_struct, MatArray
+from epoching import window_starts, select_windows
+
+# Fields of a Lee2019 run struct needed for the EEG epochs (EMG and rest recordings are skipped)
+RUN_FIELDS = ('x', 't', 'fs', 'y_dec', 'chan')
+
+# MOABB's scaling of the recorded EEG (uV) to Volts
+EEG_SCALE = 1e-6
+
+
+def lee2019_run_names(dataset):
+    """(MAT-file variable, MOABB run name) of the runs MOABB loads for each session"""
+    runs = []
+    if dataset.train_run:
+        runs.append((f'EEG_{dataset.code_suffix}_train', '1train'))
+    if dataset.test_run:
+        runs.append((f'EEG_{dataset.code_suffix}_test', '4test'))
+    return runs
+
+
+def run_events(dataset, t, y_dec, n_samples, sfreq):
+    """Events and event ids of a run, as MOABB's annotations and mne.events_from_annotations give them.
+
+    MOABB writes the class codes into a stim channel at the trial onsets and
+    turns its steps into annotations; the same steps are run here on a
+    stim-only Raw, which costs one float per sample.
+    """
+    stim = np.zeros(n_samples)
+    for sample, code in zip(t.squeeze(), y_dec.squeeze()):
+        stim[sample] += code
+    stim_raw = mne.io.RawArray(stim[None], mne.create_info(['STI 014'], sfreq, 'stim'), verbose='WARNING')
+    SetRawAnnotations(dataset.event_id, interval=dataset.interval).transform(stim_raw)
+    return mne.events_from_annotations(stim_raw, verbose=False)
+
+
+def read_lee2019_run(dataset, path, variable, filter_engine, l_freq, h_freq, tmin, tmax,
+                     block_channels=8, scratch_dir=None, stage=None):
+    """Band-passed epochs of one Lee2019 run, read from its MAT-file a few channels at a time.
+
+    Gives the same epochs as loading the run with MOABB, keeping its EEG
+    channels, filtering with filter_engine.filter and epoching the
+    annotated trials, without building the run's full (channels x samples)
+    float64 matrix. The EEG matrix is memory-mapped (see matfile.read_struct)
+    and processed in blocks of `block_channels` channels: each block is
+    scaled to Volts, filtered, and its epoch windows copied into the output
+    array, so memory stays at the epochs plus one filtered block.
+
+    stage, if given, is called with a stage name and returns a context manager.
+    """
+    stage = stage or (lambda name: nullcontext())
+    with stage('load'):
+        fields = read_struct(path, variable, fields=RUN_FIELDS, lazy=('x',), scratch_dir=scratch_dir)
+    x = fields['x']
+    if not isinstance(x, MatArray):
+        raise ValueError(f"{variable} is too small to be read out of core")
+    try:
+        sfreq = fields['fs'].item()
+        ch_names = [np.squeeze(c).item() for c in np.ravel(fields['chan'])]
+        n_samples, n_channels = x.shape
+        if len(ch_names) != n_channels:
+            raise ValueError(f"{variable} has {n_channels} channels but {len(ch_names)} channel names")
+
+        with stage('events'):
+            events, event_id = run_events(dataset, fields['t'], fields['y_dec'], n_samples, sfreq)
+            raw_times, starts = window_starts(sfreq, 0, events, tmin, tmax)
+            n_times = len(raw_times)
+            keep, drop_log = select_windows(starts, n_times, n_samples, events, event_id)
+            selected = events[np.isin(events[:, 2], list(event_id.values()))]
+            if len(np.unique(selected[:, 0])) != len(selected):
+                raise ValueError(f"{variable} has repeated event samples")
+        if len(filter_engine.design(sfreq, l_freq, h_freq)) > n_samples:
+            raise ValueError(f"{variable} is shorter than the filter")
+
+        data = np.empty((len(keep), n_channels, n_times))
+        for first in range(0, n_channels, block_channels):
+            last = min(first + block_channels, n_channels)
+            with stage('load'):
+                # Same operations as MOABB's RawArray: class dtype, then scaled, then float64
+                signal = (x.columns(first, last) * EEG_SCALE).astype(np.float64).T
+            with stage('filter'):
+                signal = filter_engine.filter_array(signal, sfreq, l_freq, h_freq)
+            with stage('epoch'):
+                for epoch, start in enumerate(starts[keep]):
+                    data[epoch, first:last] = signal[:, start:start + n_times]
+            del signal
+    finally:
+        x.close()
+
+    info = mne.create_info(ch_names, sfreq, 'eeg')
+    info.set_montage(mne.channels.make_standard_montage('standard_1005'))
+    with info._unlock():
+        if l_freq is not None:
+            info['highpass'] = float(l_freq)
+        if h_freq is not None and h_freq < info['lowpass']:
+            info['lowpass'] = float(h_freq)
+    return mne.EpochsArray(data, info, events[keep], tmin=raw_times[0], event_id=event_id, baseline=None,
+                           on_missing='ignore', selection=keep, drop_log=drop_log, verbose=False)
+
+
+def read_lee2019_subject(dataset, paths, filter_engine, l_freq, h_freq, tmin, tmax, **kwargs):
+    """(session, run, epochs) of every run MOABB would load for a subject, from its MAT-files"""
+    for session, path in zip(dataset.sessions, paths):
+        for variable, run in lee2019_run_names(dataset):
+            epochs = read_lee2019_run(dataset, path, variable, filter_engine, l_freq, h_freq, tmin, tmax, **kwargs)
+            yield str(session), run, epochs
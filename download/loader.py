@@ -0,0 +1,234 @@
+import os
+import time
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from epoch_store import list_runs, epochs_path, load_run_meta, csv_run_path
+from features import read_run_csv
+from packs import RunPack, open_packs, subject_of
+from norm_stats import RunningStats
+
+# Containers opened by this process, so each index is read once
+open_pack = functools.lru_cache(maxsize=None)(RunPack)
+
+
+def run_meta(source):
+    """Metadata of a run given as a file path or as a (container path, file path) pair"""
+    if isinstance(source, tuple):
+        return open_pack(source[0]).load_meta(source[1])
+    return load_run_meta(source)
+
+
+def run_epochs(source):
+    """Memory-mapped epoch array of a run given as in run_meta"""
+    if isinstance(source, tuple):
+        return open_pack(source[0]).load_epochs(source[1])
+    return np.load(epochs_path(source), mmap_mode='r')
+
+
+def load_batch(filepaths, runs, epochs, scaling=None):
+    """Gather one batch of epochs from memory-mapped run arrays.
+
+    runs and epochs give, for every item of the batch, the index of its run
+    in filepaths (file paths or (container, file path) pairs) and its
+    position in that run's array. Each run is read
+    once, with its epochs in increasing order, and the rows are then put
+    back in batch order. scaling, if given, holds a (mean, std) pair of
+    per-channel arrays for each run, used to z-score its epochs.
+    """
+    order = np.lexsort((epochs, runs))
+    data = None
+    for run in np.unique(runs):
+        rows = order[runs[order] == run]
+        array = run_epochs(filepaths[run])
+        block = array[epochs[rows]]
+        if scaling is not None:
+            mean, std = scaling[run]
+            block = (block - mean[:, None]) / std[:, None]
+        if data is None:
+            data = np.empty((len(runs),) + block.shape[1:], dtype=block.dtype)
+        data[rows] = block
+    return data
+
+
+class EpochLoader:
+    """Shuffled, prefetching batch loader over the npy epoch store.
+
+    Runs are cut into blocks of `block_size` consecutive epochs. Each pass
+    shuffles the order of the blocks, then shuffles epochs within groups of
+    `mix_blocks` blocks, so a batch touches only a few neighbouring regions
+    of a few files and reads stay mostly sequential.
+
+    shuffle='random' visits every epoch once per pass. shuffle='balanced'
+    gives each batch the same number of epochs of every label: per-label
+    streams keep the block-local order and smaller classes are repeated
+    until the largest one is used up. shuffle=None keeps the stored order.
+
+    normalize='dataset' or 'subject' z-scores every channel with the
+    statistics stored in the runs' metadata, merged over all runs or over
+    the runs of each epoch's subject, without a pass over the data.
+
+    Batches are gathered by `n_workers` background threads (or processes
+    with workers='process') and up to `prefetch` batches are read ahead of
+    the consumer. Iterating yields (data, labels) with data of shape
+    (batch_size, n_channels, n_times).
+    """
+
+    def __init__(self, save_dirs, batch_size=64, shuffle='random', block_size=256, mix_blocks=4,
+                 n_workers=2, prefetch=4, workers='thread', drop_last=False, seed=0, normalize=None):
+        if isinstance(save_dirs, str):
+            save_dirs = [save_dirs]
+        self.filepaths = [f for save_dir in save_dirs for f in list_runs(save_dir)
+                          if os.path.exists(epochs_path(f))]
+
+        # Runs packed into containers are read from there
+        for save_dir in save_dirs:
+            for pack in open_packs(save_dir):
+                self.filepaths += [(pack.path, f) for f in pack.runs()
+                                   if os.path.basename(epochs_path(f)) in pack.index]
+        if not self.filepaths:
+            raise ValueError(f"No runs with stored epoch arrays in {save_dirs}; process them with --formats npy")
+
+        # Epoch index: run and position of every stored epoch, with its label
+        runs, positions, labels, shapes, metas = [], [], [], set(), []
+        for run, filepath in enumerate(self.filepaths):
+            meta = run_meta(filepath)
+            metas.append(meta)
+            shapes.add((len(meta['ch_names']), meta['n_times']))
+            runs.append(np.full(len(meta['label']), run))
+            positions.append(np.arange(len(meta['label'])))
+            labels.append(np.asarray(meta['label']))
+        if len(shapes) > 1:
+            raise ValueError(f"Runs have different epoch shapes {sorted(shapes)}; use one loader per dataset "
+                             "(or harmonized outputs with equal epoch lengths)")
+        self.runs = np.concatenate(runs)
+        self.positions = np.concatenate(positions)
+        self.labels = np.concatenate(labels)
+        self.scaling = self._run_scaling(metas, normalize) if normalize else None
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self.mix_blocks = mix_blocks
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.workers = workers
+        self.drop_last = drop_last
+        self.rng = np.random.default_rng(seed)
+
+    def _run_scaling(self, metas, normalize):
+        """Per-run (mean, std) channel arrays from the stored run statistics"""
+        if normalize not in ('dataset', 'subject'):
+            raise ValueError(f"Unknown normalization {normalize!r}")
+        if any(not meta.get('stats') for meta in metas):
+            raise ValueError("Some runs have no stored statistics; process them again to normalize")
+        groups = {}
+        for filepath, meta in zip(self.filepaths, metas):
+            path = filepath[1] if isinstance(filepath, tuple) else filepath
+            key = subject_of(os.path.basename(path)) if normalize == 'subject' else None
+            stats = RunningStats.from_dict(meta['stats'])
+            groups.setdefault(key, RunningStats(stats.ch_names)).merge(stats)
+
+        scaling = []
+        for filepath in self.filepaths:
+            path = filepath[1] if isinstance(filepath, tuple) else filepath
+            stats = groups[subject_of(os.path.basename(path)) if normalize == 'subject' else None]
+            std = stats.std()
+            scaling.append((stats.mean, np.where(std > 0, std, 1.)))
+        return scaling
+
+    def _block_local_order(self, items):
+        """Shuffle items (indices into the epoch index) block-wise, keeping reads local"""
+        blocks = [items[i:i + self.block_size] for i in range(0, len(items), self.block_size)]
+        self.rng.shuffle(blocks)
+        groups = []
+        for i in range(0, len(blocks), self.mix_blocks):
+            group = np.concatenate(blocks[i:i + self.mix_blocks])
+            self.rng.shuffle(group)
+            groups.append(group)
+        return np.concatenate(groups) if groups else items
+
+    def batch_shape(self):
+        """Epochs per batch and number of batches in one pass"""
+        if self.shuffle == 'balanced':
+            counts = np.unique(self.labels, return_counts=True)[1]
+            per_class = max(1, self.batch_size // len(counts))
+            return per_class * len(counts), -(-counts.max() // per_class)
+        n_batches = len(self.runs) // self.batch_size if self.drop_last else -(-len(self.runs) // self.batch_size)
+        return self.batch_size, n_batches
+
+    def epoch_order(self):
+        """Indices into the epoch index for one pass, grouped into batches"""
+        batch_size, n_batches = self.batch_shape()
+        items = np.arange(len(self.runs))
+        if self.shuffle is None:
+            order = items
+        elif self.shuffle == 'random':
+            order = self._block_local_order(items)
+        elif self.shuffle == 'balanced':
+            # Repeat smaller classes so every batch has the same number of epochs of each label
+            per_class = batch_size // len(np.unique(self.labels))
+            streams = [self._block_local_order(items[self.labels == c]) for c in np.unique(self.labels)]
+            order = np.concatenate([np.resize(stream, (n_batches, per_class)) for stream in streams], axis=1)
+            for row in order:
+                self.rng.shuffle(row)
+            order = order.reshape(-1)
+        else:
+            raise ValueError(f"Unknown shuffle mode {self.shuffle!r}")
+        return [order[i * batch_size:(i + 1) * batch_size] for i in range(n_batches)]
+
+    def __len__(self):
+        return self.batch_shape()[1]
+
+    def __iter__(self):
+        batches = self.epoch_order()
+        executor_class = ProcessPoolExecutor if self.workers == 'process' else ThreadPoolExecutor
+        with executor_class(self.n_workers) as executor:
+            # Keep up to `prefetch` batches in flight ahead of the consumer
+            pending = []
+            for batch in batches:
+                pending.append((executor.submit(load_batch, self.filepaths, self.runs[batch],
+                                                self.positions[batch], self.scaling), self.labels[batch]))
+                if len(pending) > self.prefetch:
+                    future, labels = pending.pop(0)
+                    yield future.result(), labels
+            for future, labels in pending:
+                yield future.result(), labels
+
+
+def iter_csv_batches(save_dir, label_map, batch_size=64, seed=0):
+    """Batches read from the CSV outputs, run by run, for comparison with EpochLoader"""
+    rng = np.random.default_rng(seed)
+    filepaths = sorted(os.path.join(save_dir, f) for f in os.listdir(save_dir) if csv_run_path(f))
+    for filepath in filepaths:
+        data, _, _, labels, _, _ = read_run_csv(filepath, label_map)
+        order = rng.permutation(len(labels))
+        for i in range(0, len(order), batch_size):
+            rows = order[i:i + batch_size]
+            yield data[rows], labels[rows]
+
+
+def benchmark_loader(save_dir, label_map, batch_size=64, shuffle='random', n_workers=2, workers='thread',
+                     prefetch=4):
+    """Print batches per second of EpochLoader against reading the run CSVs"""
+    results = {}
+    sources = {
+        'csv': lambda: iter_csv_batches(save_dir, label_map, batch_size),
+        'npy loader': lambda: EpochLoader(save_dir, batch_size, shuffle, n_workers=n_workers,
+                                          workers=workers, prefetch=prefetch)
+    }
+    for name, make_batches in sources.items():
+        start = time.perf_counter()
+        n_batches = 0
+        try:
+            for data, labels in make_batches():
+                n_batches += 1
+        except (ValueError, FileNotFoundError) as e:
+            print(f"  {name}: skipped ({str(e)})")
+            continue
+        seconds = time.perf_counter() - start
+        results[name] = n_batches / seconds if seconds > 0 else float('inf')
+        print(f"  {name:<12}{n_batches:6d} batches in {seconds:7.2f} s  ({results[name]:.1f} batches/s)")
+    if len(results) == 2 and results['csv'] > 0:
+        print(f"  speed-up: {results['npy loader'] / results['csv']:.1f}x")
+    return results
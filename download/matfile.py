@@ -0,0 +1,245 @@
+import io
+import os
+import zlib
+import tempfile
+import numpy as np
+
+# Data types of MAT-file v5 data elements
+mi_dtypes = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 9: 'f8', 12: 'i8', 13: 'u8',
+             16: 'u1', 17: 'u2', 18: 'u4'}
+MI_MATRIX, MI_COMPRESSED = 14, 15
+
+# Array classes: numeric classes by dtype, and the containers we read
+mx_dtypes = {6: 'f8', 7: 'f4', 8: 'i1', 9: 'u1', 10: 'i2', 11: 'u2', 12: 'i4', 13: 'u4', 14: 'i8', 15: 'u8'}
+MX_CELL, MX_STRUCT, MX_CHAR = 1, 2, 4
+
+# Array flag of complex arrays (logical arrays are kept as uint8, as loadmat does)
+COMPLEX_FLAG = 0x800
+
+CHUNK = 4 * 1024 ** 2
+
+
+class ZlibReader(io.RawIOBase):
+    """Decompressed bytes of a zlib stream stored in the next `size` bytes of a file"""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+        self.decompressor = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.decompressor.eof:
+            data = self.decompressor.unconsumed_tail
+            if not data and self.remaining > 0:
+                data = self.f.read(min(CHUNK, self.remaining))
+                self.remaining -= len(data)
+            if not data:
+                break
+            out = self.decompressor.decompress(data, len(buffer))
+            if out:
+                buffer[:len(out)] = out
+                return len(out)
+        return 0
+
+
+class MatStream:
+    """Sequential reader of MAT-file elements, counting the bytes it has consumed"""
+
+    def __init__(self, f, endian, seekable):
+        self.f = f
+        self.endian = endian
+        self.seekable = seekable
+        self.pos = 0
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise ValueError("Unexpected end of MAT-file")
+        self.pos += n
+        return data
+
+    def skip(self, n):
+        if self.seekable:
+            self.f.seek(n, 1)
+            self.pos += n
+            return
+        while n > 0:
+            n -= len(self.read(min(CHUNK, n)))
+
+    def tag(self):
+        """Type, size and (for small elements) data of the next element"""
+        raw = self.read(8)
+        first, second = np.frombuffer(raw, self.endian + 'u4')
+        if first >> 16:
+            # Small data element: type and size share the first 4 bytes, the data fills the next 4
+            return int(first & 0xFFFF), int(first >> 16), raw[4:4 + (first >> 16)]
+        return int(first), int(second), None
+
+    def element(self):
+        """Type and contents of the next data element, as a 1-d array"""
+        mtype, size, data = self.tag()
+        if data is None:
+            data = self.read(size)
+            self.skip(-size % 8)
+        return mtype, np.frombuffer(data, self.endian + mi_dtypes[mtype])
+
+
+class MatArray:
+    """Numeric MAT-file array, memory-mapped and converted to its class dtype as it is read.
+
+    MATLAB stores arrays in column order, so each column (e.g. a channel of
+    a samples x channels matrix) is one contiguous range of the file.
+    """
+
+    def __init__(self, path, offset, stored, dtype, shape, scratch=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = shape
+        self.scratch = scratch
+        self.data = np.memmap(path, dtype=stored, mode='r', offset=offset, shape=shape, order='F')
+
+    def columns(self, start, stop):
+        """Columns start:stop, read from disk"""
+        return np.asarray(self.data[:, start:stop]).astype(self.dtype)
+
+    def close(self):
+        """Release the memory map and delete the scratch copy, if any"""
+        self.data = None
+        if self.scratch:
+            os.remove(self.path)
+
+
+def _map_data(stream, stored, dtype, dims, size, path, scratch_dir):
+    """MatArray over an element's data: in place when uncompressed, else via a scratch copy"""
+    if stream.seekable:
+        array = MatArray(path, stream.f.tell(), stored, dtype, dims)
+        stream.skip(size + -size % 8)
+        return array
+
+    fd, scratch = tempfile.mkstemp(suffix='.bin', dir=scratch_dir or os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = stream.read(min(CHUNK, remaining))
+            f.write(block)
+            remaining -= len(block)
+    stream.skip(-size % 8)
+    return MatArray(scratch, 0, stored, dtype, dims, scratch=True)
+
+
+def _matrix_header(stream):
+    """Array flags, dimensions and name at the start of a matrix element"""
+    flags = int(stream.element()[1][0])
+    dims = tuple(int(d) for d in stream.element()[1])
+    name = stream.element()[1].tobytes().decode('ascii', 'replace')
+    return flags, dims, name
+
+
+def _read_matrix(stream, size, path, lazy=False, scratch_dir=None, fields=None, lazy_fields=(), header=None):
+    """Name and value of a matrix element whose tag has just been read.
+
+    Numeric arrays are returned with the dtype of their class (as scipy's
+    loadmat does), in column order; char arrays as strings, cells as object
+    arrays and 1x1 structs as dicts (other structs as lists of dicts).
+    With lazy=True a numeric array is returned as a MatArray instead of
+    being read. For structs, only `fields` (all when None) are read, and
+    those in `lazy_fields` are read lazily.
+    Other classes are skipped and returned as None. `header` is the
+    (start, flags, dims, name) of an element whose header was already read.
+    """
+    if size == 0:
+        return '', np.empty((0, 0))
+    if header is None:
+        header = (stream.pos,) + _matrix_header(stream)
+    start, flags, dims, name = header
+    mclass = flags & 0xFF
+
+    if mclass in mx_dtypes:
+        mtype, n_bytes, data = stream.tag()
+        stored = stream.endian + mi_dtypes[mtype]
+        if lazy and data is None:
+            value = _map_data(stream, stored, mx_dtypes[mclass], dims, n_bytes, path, scratch_dir)
+        else:
+            if data is None:
+                data = stream.read(n_bytes)
+                stream.skip(-n_bytes % 8)
+            value = np.frombuffer(data, stored).astype(mx_dtypes[mclass]).reshape(dims, order='F')
+            if flags & COMPLEX_FLAG:
+                mtype, imag = stream.element()
+                value = value + 1j * imag.astype(mx_dtypes[mclass]).reshape(dims, order='F')
+    elif mclass == MX_CHAR:
+        mtype, codes = stream.element()
+        text = codes.tobytes().decode('utf-8') if mtype == 16 else ''.join(map(chr, codes))
+        rows = dims[0] if dims else 0
+        value = text if rows <= 1 else [text[i::rows] for i in range(rows)]
+    elif mclass == MX_CELL:
+        value = np.empty(int(np.prod(dims)), dtype=object)
+        for i in range(len(value)):
+            _, n_bytes, _ = stream.tag()
+            value[i] = _read_matrix(stream, n_bytes, path, scratch_dir=scratch_dir)[1]
+        value = value.reshape(dims, order='F')
+    elif mclass == MX_STRUCT:
+        length = int(stream.element()[1][0])
+        names = stream.element()[1].tobytes()
+        names = [names[i:i + length].split(b'\0')[0].decode('ascii') for i in range(0, len(names), length)]
+        records = []
+        for _ in range(int(np.prod(dims))):
+            record = {}
+            for field in names:
+                _, n_bytes, _ = stream.tag()
+                if fields is not None and field not in fields:
+                    stream.skip(n_bytes)
+                    continue
+                record[field] = _read_matrix(stream, n_bytes, path, lazy=field in lazy_fields,
+                                             scratch_dir=scratch_dir)[1]
+            records.append(record)
+        value = records[0] if len(records) == 1 else records
+    else:
+        value = None
+
+    stream.skip(size - (stream.pos - start))
+    return name, value
+
+
+def read_struct(path, variable, fields=None, lazy=(), scratch_dir=None):
+    """Fields of a 1x1 struct variable of a MAT-file (v5 to v7.2), read without loading the file.
+
+    Only the `fields` given (all when None) are read; the other fields and
+    variables are skipped. Fields in `lazy` are returned as MatArray:
+    memory-mapped in place when the variable is stored uncompressed, or,
+    for compressed (v7) variables, streamed once into a scratch file in
+    `scratch_dir` (default: next to the MAT-file) that is memory-mapped
+    instead. Memory use stays at a few MB plus the small fields.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(128)
+        if header[:10] == b'MATLAB 7.3':
+            raise ValueError(f"{path} is an HDF5-based (v7.3) MAT-file")
+        endian = '<' if header[126:128] == b'IM' else '>'
+
+        # Walk the top-level variables, reading only the name of the ones we skip
+        while True:
+            tag = f.read(8)
+            if len(tag) < 8:
+                raise KeyError(f"{variable} not found in {path}")
+            mtype, size = (int(v) for v in np.frombuffer(tag, endian + 'u4'))
+            end = f.tell() + size
+            if mtype == MI_COMPRESSED:
+                stream = MatStream(io.BufferedReader(ZlibReader(f, size), CHUNK), endian, seekable=False)
+                mtype, size, _ = stream.tag()
+            else:
+                stream = MatStream(f, endian, seekable=True)
+            if mtype == MI_MATRIX and size:
+                header = (stream.pos,) + _matrix_header(stream)
+                if header[3] == variable:
+                    value = _read_matrix(stream, size, path, scratch_dir=scratch_dir, fields=fields,
+                                         lazy_fields=lazy, header=header)[1]
+                    break
+            f.seek(end)
+
+    if not isinstance(value, dict):
+        raise ValueError(f"{variable} in {path} is not a 1x1 struct")
+    return value
@@ -0,0 +1,130 @@
+import os
+import json
+import numpy as np
+from epoch_store import list_runs, load_run_meta
+from packs import open_packs, subject_of
+
+# Per-dataset file with the merged statistics, next to the runs
+NORM_STATS_FILE = 'norm_stats.json'
+
+
+class RunningStats:
+    """Per-channel count, mean, sum of squared deviations (M2), min and max.
+
+    Blocks of data are folded in with the pairwise update of Chan et al.,
+    which stays accurate over long recordings (unlike summing squares), and
+    accumulators filled by different workers or shards are merged the same
+    way. Values are in the unit of the data given (Volts for the stored
+    epoch arrays).
+    """
+
+    def __init__(self, ch_names):
+        self.ch_names = list(ch_names)
+        self.count = 0
+        self.mean = np.zeros(len(self.ch_names))
+        self.m2 = np.zeros(len(self.ch_names))
+        self.min = np.full(len(self.ch_names), np.inf)
+        self.max = np.full(len(self.ch_names), -np.inf)
+
+    def update(self, data, chunk=64):
+        """Add an (n_epochs, n_channels, n_times) array, `chunk` epochs at a time"""
+        for i in range(0, len(data), chunk):
+            block_data = np.asarray(data[i:i + chunk], dtype=np.float64)
+            values = block_data.transpose(1, 0, 2).reshape(len(self.ch_names), -1)
+            if not values.size:
+                continue
+            block = RunningStats(self.ch_names)
+            block.count = values.shape[1]
+            block.mean = values.mean(axis=1)
+            block.m2 = ((values - block.mean[:, None]) ** 2).sum(axis=1)
+            block.min, block.max = values.min(axis=1), values.max(axis=1)
+            self.merge(block)
+        return self
+
+    def merge(self, other):
+        """Fold in the statistics of another accumulator over the same channels"""
+        if other.ch_names != self.ch_names:
+            raise ValueError("Cannot merge statistics of different channel sets")
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.min, self.max = np.minimum(self.min, other.min), np.maximum(self.max, other.max)
+        self.count = count
+        return self
+
+    def variance(self, ddof=0):
+        """Per-channel variance"""
+        return self.m2 / max(self.count - ddof, 1)
+
+    def std(self, ddof=0):
+        """Per-channel standard deviation"""
+        return np.sqrt(self.variance(ddof))
+
+    def to_dict(self):
+        """JSON-serializable form"""
+        return {
+            'ch_names': self.ch_names,
+            'count': self.count,
+            'mean': self.mean.tolist(),
+            'm2': self.m2.tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, entry):
+        """Accumulator from the form written by to_dict"""
+        stats = cls(entry['ch_names'])
+        stats.count = entry['count']
+        for key in ('mean', 'm2', 'min', 'max'):
+            setattr(stats, key, np.asarray(entry[key], dtype=np.float64))
+        return stats
+
+
+def run_stats(save_dir):
+    """(run path, subject, RunningStats) of every run, loose or packed, with stored statistics"""
+    runs = [(filepath, load_run_meta(filepath)) for filepath in list_runs(save_dir)]
+    for pack in open_packs(save_dir):
+        runs += [(filepath, pack.load_meta(filepath)) for filepath in pack.runs()]
+    return [(filepath, subject_of(os.path.basename(filepath)), RunningStats.from_dict(meta['stats']))
+            for filepath, meta in runs if meta.get('stats')]
+
+
+def merge_run_stats(save_dir):
+    """Statistics of a dataset directory merged per subject and over all runs"""
+    dataset, subjects = None, {}
+    for filepath, subject, stats in run_stats(save_dir):
+        if dataset is None:
+            dataset = RunningStats(stats.ch_names)
+        if stats.ch_names != dataset.ch_names:
+            print(f"Skipping statistics of {filepath}: its channels differ from the other runs")
+            continue
+        dataset.merge(stats)
+        subjects.setdefault(subject, RunningStats(stats.ch_names)).merge(stats)
+    return dataset, subjects
+
+
+def save_norm_stats(save_dir):
+    """Write the merged statistics of a dataset directory to norm_stats.json"""
+    dataset, subjects = merge_run_stats(save_dir)
+    if dataset is None:
+        return None
+    path = os.path.join(save_dir, NORM_STATS_FILE)
+    with open(path, 'w') as f:
+        json.dump({
+            'unit': 'V',  # as the npy arrays; CSV channels are in microvolts (scale mean and std by 1e6)
+            'dataset': dataset.to_dict(),
+            'subjects': {str(subject): stats.to_dict() for subject, stats in sorted(subjects.items())}
+        }, f, indent=1)
+    return path
+
+
+def load_norm_stats(save_dir):
+    """Dataset and per-subject RunningStats from norm_stats.json"""
+    with open(os.path.join(save_dir, NORM_STATS_FILE)) as f:
+        stored = json.load(f)
+    return (RunningStats.from_dict(stored['dataset']),
+            {int(subject): RunningStats.from_dict(entry) for subject, entry in stored['subjects'].items()})
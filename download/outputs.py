@@ -0,0 +1,169 @@
+import os
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+import mne
+from epoch_store import save_epochs, save_run_meta, epochs_path, load_epochs, csv_file, file_checksum
+
+
+def run_info(epochs, label_map, attrs, formats, dataset_name, extra_columns=None, compact=False):
+    """Everything except the signal array that is needed to write a run.
+
+    The result only holds small Python objects, so it can be sent to a
+    writer process cheaply while the epochs array travels separately.
+    """
+    rev_event_id = {v: k for k, v in epochs.event_id.items()}
+    conditions = [rev_event_id[k] for k in epochs.events[:, 2]]
+    scalings = mne.defaults.DEFAULTS['scalings']
+    return {
+        'dataset': dataset_name,
+        'formats': list(formats),
+        'sfreq': epochs.info['sfreq'],
+        'tmin': epochs.tmin,
+        'times': epochs.times,
+        'ch_names': epochs.ch_names,
+        'scalings': [scalings.get(ch_type, 1.) for ch_type in epochs.get_channel_types()],
+        'epoch': np.asarray(epochs.selection).tolist(),
+        'condition': conditions,
+        'label_map': label_map,
+        'attrs': attrs,
+        'extra_columns': extra_columns or {},
+        'compact': compact
+    }
+
+
+def smallest_int_dtype(values):
+    """Smallest signed integer dtype that holds all values"""
+    values = np.atleast_1d(np.asarray(values, dtype=np.int64))
+    for dtype in (np.int8, np.int16, np.int32):
+        if not values.size or (values.min() >= np.iinfo(dtype).min and values.max() <= np.iinfo(dtype).max):
+            return dtype
+    return np.int64
+
+
+def build_frame(data, info, compact=None):
+    """Build the CSV table of a run from its epochs array.
+
+    Produces the same table as epochs.to_data_frame() followed by the label
+    column: time, condition, epoch, one column per channel (EEG in
+    microvolts), label, then any constant extra columns (e.g. is_test).
+
+    With compact=True (default: info['compact']) the table uses a fraction
+    of the memory: float32 channels, a categorical condition column whose
+    categories are the label_map keys (so tables of different runs share
+    codes), and the smallest integer dtype for epoch and label; conditions
+    missing from label_map get label -1.
+    """
+    if compact is None:
+        compact = info.get('compact', False)
+    n_epochs, n_channels, n_times = data.shape
+    scalings = np.asarray(info['scalings'])
+    label_map = info['label_map']
+
+    if compact:
+        # Scale in float64 and store float32 in one pass, without a float64 copy
+        values = np.empty((n_epochs * n_times, n_channels), dtype=np.float32)
+        np.multiply(data.transpose(0, 2, 1), scalings, out=values.reshape(n_epochs, n_times, n_channels),
+                    casting='same_kind')
+    else:
+        values = np.hstack(data).T if n_epochs else np.empty((0, n_channels))
+        values = values * scalings
+
+    df = pd.DataFrame(values, columns=info['ch_names'], copy=False)
+    df.insert(0, 'time', np.tile(info['times'], n_epochs))
+
+    if compact:
+        categories = list(label_map) + sorted(set(info['condition']) - set(label_map))
+        codes = np.array([categories.index(c) for c in info['condition']], dtype=smallest_int_dtype(len(categories)))
+        df.insert(1, 'condition', pd.Categorical.from_codes(np.repeat(codes, n_times), categories))
+        df.insert(2, 'epoch', np.repeat(np.asarray(info['epoch'], dtype=smallest_int_dtype(info['epoch'])), n_times))
+        labels = [label_map.get(c, -1) for c in info['condition']]
+        df['label'] = np.repeat(np.asarray(labels, dtype=smallest_int_dtype(labels)), n_times)
+    else:
+        df.insert(1, 'condition', np.repeat(info['condition'], n_times))
+        df.insert(2, 'epoch', np.repeat(info['epoch'], n_times))
+
+        # Labels are looked up once per epoch and repeated over its samples
+        labels = pd.Series(info['condition'], dtype=object).map(label_map).to_numpy()
+        df['label'] = np.repeat(labels, n_times)
+
+    for key, value in info['extra_columns'].items():
+        df[key] = value
+    df.attrs.update(info['attrs'])
+    return df
+
+
+def load_run_frame(filepath, label_map, compact=True):
+    """Load a processed run as a table, from its epoch array if stored, else from its CSV.
+
+    Both sources give the CSV layout; with compact=True the table uses the
+    compact dtypes described in build_frame.
+    """
+    if os.path.exists(epochs_path(filepath)):
+        data, meta = load_epochs(filepath)
+        info = {
+            'times': meta['tmin'] + np.arange(meta['n_times']) / meta['sfreq'],
+            'ch_names': meta['ch_names'],
+            'scalings': [1e6] * len(meta['ch_names']),  # EEG channels, written in microvolts
+            'epoch': meta['epoch'],
+            'condition': meta['condition'],
+            'label_map': label_map,
+            'attrs': meta['attrs'],
+            'extra_columns': meta.get('extra_columns', {})
+        }
+        return build_frame(data, info, compact)
+
+    filepath = csv_file(filepath)
+    if not compact:
+        return pd.read_csv(filepath)
+    columns = pd.read_csv(filepath, nrows=0).columns
+    dtypes = {c: np.float32 for c in columns if c not in ('time', 'condition', 'epoch', 'label', 'is_test')}
+    dtypes['condition'] = 'category'
+    df = pd.read_csv(filepath, dtype=dtypes)
+    extra = sorted(set(df['condition'].cat.categories) - set(label_map))
+    df['condition'] = df['condition'].cat.set_categories(list(label_map) + extra)
+    df['epoch'] = pd.to_numeric(df['epoch'], downcast='integer')
+    df['label'] = pd.to_numeric(df['label'].fillna(-1), downcast='integer')
+    return df
+
+
+def write_outputs(filepath, data, info, stage=None, csv_writer=None):
+    """Write one run's epochs in every requested format plus its metadata sidecar.
+
+    stage, if given, is called with a stage name ('to-frame') and returns a
+    context manager timing that part of the write. csv_writer, if given, is
+    a CsvWriter producing the same CSV without building the table.
+    """
+    if 'csv' in info['formats'] and csv_writer is not None:
+        csv_writer.write(filepath, data, info)
+    elif 'csv' in info['formats']:
+        with stage('to-frame') if stage is not None else nullcontext():
+            frame = build_frame(data, info)
+        frame.to_csv(filepath, index=False)
+
+    if 'npy' in info['formats']:
+        save_epochs(filepath, data)
+
+    # Size and CRC32 of each data file, checked by verify.py
+    written = [csv_file(filepath)] if 'csv' in info['formats'] else []
+    written += [epochs_path(filepath)] if 'npy' in info['formats'] else []
+    files = {os.path.basename(path): {'bytes': os.path.getsize(path), 'crc32': file_checksum(path)}
+             for path in written}
+
+    label_map = info['label_map']
+    save_run_meta(filepath, {
+        'dataset': info['dataset'],
+        'formats': info['formats'],
+        'sfreq': info['sfreq'],
+        'tmin': info['tmin'],
+        'n_times': len(info['times']),
+        'unit': 'V',  # npy arrays are in Volts, CSV channels in microvolts
+        'ch_names': info['ch_names'],
+        'epoch': info['epoch'],
+        'condition': info['condition'],
+        'label': [label_map.get(c, -1) for c in info['condition']],
+        'extra_columns': info['extra_columns'],
+        'stats': info.get('stats'),
+        'files': files,
+        'attrs': info['attrs']
+    })
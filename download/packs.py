@@ -0,0 +1,228 @@
+import os
+import io
+import re
+import json
+import shutil
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from epoch_store import epochs_path, meta_path, csv_run_path, csv_compressions, read_npy_header
+
+try:
+    import fcntl
+except ImportError:  # Windows: containers are not locked across processes
+    fcntl = None
+
+# Suffix of container files; per-subject containers are subject_<n>_pack.zip
+PACK_SUFFIX = '_pack.zip'
+DATASET_PACK = 'dataset' + PACK_SUFFIX
+
+
+def pack_path(save_dir, subject=None):
+    """Container of one subject's runs, or of the whole dataset directory when subject is None"""
+    return os.path.join(save_dir, f'subject_{subject}{PACK_SUFFIX}' if subject is not None else DATASET_PACK)
+
+
+def find_packs(save_dir):
+    """Container files in a dataset directory"""
+    return [os.path.join(save_dir, f) for f in sorted(os.listdir(save_dir)) if f.endswith(PACK_SUFFIX)]
+
+
+def subject_of(filename):
+    """Subject number in an output file name (None for other files)"""
+    match = re.match(r'subject_(\d+)_', filename)
+    return int(match.group(1)) if match else None
+
+
+# Member names of the containers read so far: path -> ((mtime, size), names)
+_name_cache = {}
+
+
+def pack_names(path):
+    """Member names of one container (empty if it does not exist), read once while it is unchanged"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return set()
+    version = (stat.st_mtime_ns, stat.st_size)
+    if _name_cache.get(path, (None,))[0] != version:
+        with zipfile.ZipFile(path) as pack:
+            _name_cache[path] = (version, set(pack.namelist()))
+    return _name_cache[path][1]
+
+
+def subject_outputs_exist(save_dir, subject):
+    """Whether any output of a subject exists in a dataset directory, loose or in a container.
+
+    Only the subject's own container and the dataset container can hold its
+    runs, so only those two are looked at.
+    """
+    prefix = f'subject_{subject}_'
+    if any(f.startswith(prefix) and PACK_SUFFIX not in f for f in os.listdir(save_dir)):
+        return True
+    return any(name.startswith(prefix)
+               for path in (pack_path(save_dir, subject), pack_path(save_dir)) for name in pack_names(path))
+
+
+def packed_names(save_dir):
+    """Names of all files stored in the containers of a dataset directory"""
+    names = set()
+    for path in find_packs(save_dir):
+        with zipfile.ZipFile(path) as pack:
+            names.update(pack.namelist())
+    return names
+
+
+@contextmanager
+def locked_pack(path):
+    """Exclusive lock on a container, held while it is updated (other processes wait for it)"""
+    lock_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.lock')
+    with open(lock_path, 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def check_members(path, filepaths):
+    """Raise if a container lacks one of the files, or holds a different size or damaged (CRC) copy of it"""
+    with zipfile.ZipFile(path) as pack:
+        for filepath in filepaths:
+            name = os.path.basename(filepath)
+            info = pack.getinfo(name)
+            if info.file_size != os.path.getsize(filepath):
+                raise zipfile.BadZipFile(f"{name} in {path} has {info.file_size} bytes, "
+                                         f"expected {os.path.getsize(filepath)}")
+            # Reading a member to its end checks its CRC
+            with pack.open(info) as member:
+                while member.read(1024 ** 2):
+                    pass
+
+
+def pack_files(path, filepaths, remove=True):
+    """Store files in a container, then delete the originals.
+
+    Files are stored uncompressed, so epoch arrays can still be memory-mapped
+    from the container. New names are appended; when a name is already in
+    the container, the container is rewritten with the new version. The
+    container is locked while it is updated, so processes packing into the
+    same one (e.g. the dataset container of several subject workers) take
+    turns, and the originals are only deleted once the container has been
+    reopened and their copies checked.
+    """
+    with locked_pack(path):
+        _pack_files(path, filepaths)
+        check_members(path, filepaths)
+
+    if remove:
+        for filepath in filepaths:
+            os.remove(filepath)
+
+
+def _pack_files(path, filepaths):
+    """Append or rewrite the files in a container (the caller holds its lock)"""
+    names = [os.path.basename(f) for f in filepaths]
+    existing = set()
+    if os.path.exists(path):
+        with zipfile.ZipFile(path) as pack:
+            existing = set(pack.namelist())
+
+    if existing & set(names):
+        # Copy the members that are kept into a new container, then swap it in
+        tmp_path = path + '.tmp'
+        with zipfile.ZipFile(path) as old, zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as new:
+            for info in old.infolist():
+                if info.filename not in names:
+                    with old.open(info) as src, new.open(info, 'w') as dst:
+                        shutil.copyfileobj(src, dst, 1024 ** 2)
+            for filepath, name in zip(filepaths, names):
+                new.write(filepath, name)
+        os.replace(tmp_path, path)
+    else:
+        with zipfile.ZipFile(path, 'a', zipfile.ZIP_STORED) as pack:
+            for filepath, name in zip(filepaths, names):
+                pack.write(filepath, name)
+
+
+def compact_directory(save_dir, by='subject', subjects=None):
+    """Move the per-run files of a dataset directory into containers.
+
+    by='subject' writes one container per subject, by='dataset' one for the
+    whole directory. subjects limits compaction to those subjects. Returns
+    the number of files moved.
+    """
+    groups = {}
+    for filename in sorted(os.listdir(save_dir)):
+        subject = subject_of(filename)
+        if subject is None or PACK_SUFFIX in filename or (subjects is not None and subject not in subjects):
+            continue
+        path = pack_path(save_dir, subject if by == 'subject' else None)
+        groups.setdefault(path, []).append(os.path.join(save_dir, filename))
+
+    for path, filepaths in groups.items():
+        pack_files(path, filepaths)
+    return sum(len(filepaths) for filepaths in groups.values())
+
+
+class RunPack:
+    """Read access to the runs stored in one container.
+
+    The member index (name -> offset and size of its bytes in the file) is
+    read once from the zip directory; after that, members are read with a
+    single seek, and epoch arrays are memory-mapped straight from the
+    container.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        with open(path, 'rb') as f, zipfile.ZipFile(f) as pack:
+            for info in pack.infolist():
+                # The data starts after the member's local header (30 bytes + name + extra field)
+                f.seek(info.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', f.read(4))
+                self.index[info.filename] = (info.header_offset + 30 + name_length + extra_length, info.file_size)
+
+    def runs(self):
+        """Run data paths (as if unpacked next to the container) of the runs with metadata"""
+        save_dir = os.path.dirname(self.path)
+        return [os.path.join(save_dir, name.replace('_meta.json', '_data.csv'))
+                for name in sorted(self.index) if name.endswith('_meta.json')]
+
+    def read(self, name):
+        """Bytes of one member"""
+        offset, size = self.index[name]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def load_meta(self, filepath):
+        """Metadata sidecar of a run"""
+        return json.loads(self.read(os.path.basename(meta_path(filepath))))
+
+    def load_epochs(self, filepath, mmap=True):
+        """Epoch array of a run, memory-mapped from the container with mmap=True"""
+        offset, _ = self.index[os.path.basename(epochs_path(filepath))]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            shape, fortran_order, dtype, header_length = read_npy_header(f)
+        if not mmap:
+            return np.load(io.BytesIO(self.read(os.path.basename(epochs_path(filepath)))))
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset + header_length, shape=shape,
+                         order='F' if fortran_order else 'C')
+
+    def read_csv(self, filepath, **kwargs):
+        """Table of a run from its (possibly compressed) CSV member"""
+        name = os.path.basename(filepath)
+        candidates = [n for n in self.index if n.startswith(name) and csv_run_path(n) == name]
+        if not candidates:
+            raise FileNotFoundError(f"{name} is not in {self.path}")
+        methods = {ext: method for method, ext in csv_compressions.items()}
+        compression = methods.get(os.path.splitext(candidates[0])[1])
+        return pd.read_csv(io.BytesIO(self.read(candidates[0])), compression=compression, **kwargs)
+
+
+def open_packs(save_dir):
+    """RunPack readers for all containers of a dataset directory"""
+    return [RunPack(path) for path in find_packs(save_dir)]
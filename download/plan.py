@@ -0,0 +1,164 @@
+import os
+import time
+import tempfile
+import numpy as np
+import mne
+from filtering import FilterEngine
+
+# Output formats the pipeline can write, used to report output size per format
+output_formats = ['csv', 'npy']
+
+MB = 1024 ** 2
+
+
+def format_bytes(n_bytes):
+    """Format a byte count as a human readable string"""
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n_bytes) < 1024 or unit == 'TB':
+            return f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1024
+
+
+def format_seconds(seconds):
+    """Format a duration in seconds as h/m/s"""
+    hours, rest = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+def calibrate(n_channels=22, sfreq=250., duration=120., fmin=8, fmax=30):
+    """Run a small synthetic pipeline and measure per-stage throughput.
+
+    Nothing is downloaded: a random RawArray with evenly spaced annotations
+    goes through the same filter engine / epoch / to_data_frame / to_csv steps as
+    the real pipeline, and costs are normalised per sample or per value.
+    """
+    rng = np.random.default_rng(0)
+    n_samples = int(duration * sfreq)
+    info = mne.create_info([f'EEG{i:03d}' for i in range(n_channels)], sfreq, 'eeg')
+    raw = mne.io.RawArray(rng.standard_normal((n_channels, n_samples)) * 1e-5, info, verbose=False)
+    onsets = np.arange(2., duration - 6., 8.)
+    descriptions = [['left_hand', 'right_hand'][i % 2] for i in range(len(onsets))]
+    raw.set_annotations(mne.Annotations(onsets, 4., descriptions))
+
+    # Filter throughput, in seconds per channel-sample
+    start = time.perf_counter()
+    FilterEngine().filter(raw, fmin, fmax, method='fir')
+    filter_cost = (time.perf_counter() - start) / (n_channels * n_samples)
+
+    # Epoching and DataFrame conversion, in seconds per output value
+    start = time.perf_counter()
+    events, event_dict = mne.events_from_annotations(raw, verbose=False)
+    epochs = mne.Epochs(raw, events, event_dict, tmin=0, tmax=4,
+                        baseline=None, preload=True, verbose=False)
+    df = epochs.to_data_frame()
+    n_values = df.shape[0] * n_channels
+    frame_cost = (time.perf_counter() - start) / n_values
+
+    # CSV write throughput and size, per output value
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, 'calibration.csv')
+        start = time.perf_counter()
+        df.to_csv(filepath, index=False)
+        csv_cost = (time.perf_counter() - start) / n_values
+        csv_bytes = os.path.getsize(filepath) / n_values
+
+    return {
+        'filter_seconds_per_sample': filter_cost,
+        'frame_seconds_per_value': frame_cost,
+        'csv_seconds_per_value': csv_cost,
+        'csv_bytes_per_value': csv_bytes,
+        'frame_bytes_per_row': df.memory_usage(deep=True).sum() / df.shape[0] - 8 * n_channels
+    }
+
+
+def estimate_dataset(dataset_name, config, calibration, bandwidth=None):
+    """Estimate disk, memory and time needed to process one dataset"""
+    rec = config['recording']
+    n_subjects = len(config['subjects'])
+    runs_per_subject = rec['sessions'] * rec['runs_per_session']
+    sfreq = rec['sfreq']
+    n_times = int(round((config['epoch_params']['tmax'] - config['epoch_params']['tmin']) * sfreq)) + 1
+    run_samples = int(rec['run_duration'] * sfreq)
+
+    # Output values per run (channels x samples kept in epochs)
+    epoch_rows = rec['trials_per_run'] * n_times
+    run_values = epoch_rows * rec['n_channels']
+
+    # Output size per format
+    bytes_per_value = {
+        'csv': calibration['csv_bytes_per_value'],
+        'npy': 8  # float64 epoch arrays
+    }
+    output_bytes = {fmt: run_values * bytes_per_value[fmt] * runs_per_subject * n_subjects
+                    for fmt in output_formats}
+
+    # Peak RAM per worker: MOABB keeps every run of a subject in memory (float64),
+    # and while one run is processed we also hold a filter copy, the epochs
+    # array and the DataFrame built from it
+    subject_raw = rec['n_raw_channels'] * run_samples * runs_per_subject * 8
+    run_copy = rec['n_channels'] * run_samples * 8
+    epochs_array = run_values * 8
+    frame = run_values * 8 + epoch_rows * calibration['frame_bytes_per_row']
+    peak_ram = subject_raw + run_copy + epochs_array + frame
+
+    # Runtime from the calibration benchmark
+    run_seconds = (rec['n_channels'] * run_samples * calibration['filter_seconds_per_sample'] +
+                   run_values * (calibration['frame_seconds_per_value'] +
+                                 calibration['csv_seconds_per_value']))
+    process_seconds = run_seconds * runs_per_subject * n_subjects
+
+    raw_bytes = rec['raw_bytes_per_subject'] * n_subjects
+    download_seconds = raw_bytes / (bandwidth * MB) if bandwidth else None
+
+    return {
+        'dataset': dataset_name,
+        'subjects': n_subjects,
+        'runs': runs_per_subject * n_subjects,
+        'raw_bytes': raw_bytes,
+        'output_bytes': output_bytes,
+        'peak_ram': peak_ram,
+        'process_seconds': process_seconds,
+        'download_seconds': download_seconds
+    }
+
+
+def print_plan(estimates):
+    """Print a per-dataset plan table and totals"""
+    for est in estimates:
+        print(f"\n{est['dataset']}: {est['subjects']} subjects, {est['runs']} runs")
+        print(f"  Raw download:      {format_bytes(est['raw_bytes'])}")
+        for fmt, n_bytes in est['output_bytes'].items():
+            print(f"  Output ({fmt}):".ljust(21) + format_bytes(n_bytes))
+        print(f"  Peak RAM / worker: {format_bytes(est['peak_ram'])}")
+        print(f"  Processing time:   {format_seconds(est['process_seconds'])}")
+        if est['download_seconds'] is not None:
+            print(f"  Download time:     {format_seconds(est['download_seconds'])}")
+
+    print("\nTotal:")
+    print(f"  Raw download:      {format_bytes(sum(e['raw_bytes'] for e in estimates))}")
+    for fmt in output_formats:
+        total = sum(e['output_bytes'][fmt] for e in estimates)
+        print(f"  Output ({fmt}):".ljust(21) + format_bytes(total))
+    print(f"  Peak RAM / worker: {format_bytes(max(e['peak_ram'] for e in estimates))}")
+    print(f"  Processing time:   {format_seconds(sum(e['process_seconds'] for e in estimates))}")
+    if all(e['download_seconds'] is not None for e in estimates):
+        print(f"  Download time:     {format_seconds(sum(e['download_seconds'] for e in estimates))}")
+
+
+def plan(dataset_configs, dataset_names=None, bandwidth=None, fmin=8, fmax=30):
+    """Estimate resources for the selected datasets without downloading anything"""
+    if dataset_names is None:
+        dataset_names = list(dataset_configs.keys())
+
+    print("Running local calibration benchmark...")
+    calibration = calibrate(fmin=fmin, fmax=fmax)
+
+    estimates = [estimate_dataset(name, dataset_configs[name], calibration, bandwidth)
+                 for name in dataset_names]
+    print_plan(estimates)
+    return estimates
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: index updates are not locked across processes
+    fcntl = None
+
+
+def parse_size(text):
+    """Parse a size such as '500M', '50G' or '1.5T' into bytes"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = str(text).strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def pid_alive(pid):
+    """Whether a process with this pid is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class RawCache:
+    """Size-limited view of the MOABB download directory with LRU eviction.
+
+    Raw files are registered per (dataset, subject) owner after get_data.
+    A file can only be evicted once its owner's processed outputs are marked
+    complete, and never while a live process has its owner pinned. Each
+    process pins one owner at a time (the subject it is working on).
+    """
+
+    def __init__(self, root='./data', limit_bytes=None):
+        self.root = root
+        self.limit_bytes = limit_bytes
+        self.index_path = os.path.join(root, 'raw_cache_index.json')
+        self.pin_dir = os.path.join(root, '.raw_cache_pins')
+        os.makedirs(self.pin_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked_index(self):
+        """Load the index under an exclusive lock and save it on exit"""
+        with open(self.index_path + '.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            index = {}
+            if os.path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    index = json.load(f)
+            yield index
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(self.index_path + '.tmp', self.index_path)
+
+    def _pinned_owners(self):
+        """Owners pinned by processes that are still running"""
+        owners = set()
+        for name in os.listdir(self.pin_dir):
+            if not name.isdigit():
+                continue
+            pin_path = os.path.join(self.pin_dir, name)
+            if not pid_alive(int(name)):
+                os.remove(pin_path)
+                continue
+            with open(pin_path) as f:
+                owners.add(f.read().strip())
+        return owners
+
+    def pin(self, owner):
+        """Mark owner as in use by this process (replaces this process's previous pin)"""
+        with open(os.path.join(self.pin_dir, str(os.getpid())), 'w') as f:
+            f.write(owner)
+
+    def unpin(self):
+        """Release this process's pin"""
+        pin_path = os.path.join(self.pin_dir, str(os.getpid()))
+        if os.path.exists(pin_path):
+            os.remove(pin_path)
+
+    def register(self, owner, paths):
+        """Record the raw files used by owner and refresh their last-use time"""
+        if isinstance(paths, str):
+            paths = [paths]
+        now = time.time()
+        with self._locked_index() as index:
+            for path in paths:
+                path = os.path.abspath(path)
+                if not os.path.isfile(path):
+                    continue
+                entry = index.setdefault(path, {'owner': owner, 'complete': False})
+                entry['size'] = os.path.getsize(path)
+                entry['last_used'] = now
+
+    def mark_complete(self, owner):
+        """Allow owner's raw files to be evicted: its outputs have been written"""
+        with self._locked_index() as index:
+            for entry in index.values():
+                if entry['owner'] == owner:
+                    entry['complete'] = True
+
+    def enforce_quota(self):
+        """Evict least-recently-used complete, unpinned raw files until under the limit"""
+        if self.limit_bytes is None:
+            return []
+
+        pinned = self._pinned_owners()
+        evicted = []
+        with self._locked_index() as index:
+            # Forget files that were removed by other means
+            for path in [p for p in index if not os.path.exists(p)]:
+                del index[path]
+
+            total = sum(entry['size'] for entry in index.values())
+            candidates = sorted((entry['last_used'], path) for path, entry in index.items()
+                                if entry['complete'] and entry['owner'] not in pinned)
+            for _, path in candidates:
+                if total <= self.limit_bytes:
+                    break
+                total -= index[path]['size']
+                os.remove(path)
+                del index[path]
+                evicted.append(path)
+
+        if evicted:
+            print(f"Raw cache: evicted {len(evicted)} files, {total / 1024 ** 3:.2f} GB in use")
+        elif total > self.limit_bytes:
+            print(f"Raw cache: {total / 1024 ** 3:.2f} GB in use exceeds the limit, "
+                  f"but no complete, unpinned files are left to evict")
+        return evicted
@@ -0,0 +1,64 @@
+def subject_cost(config):
+    """Estimated processing cost of one subject: channels x samples x runs"""
+    rec = config['recording']
+    samples = rec['run_duration'] * rec['sfreq']
+    return rec['n_channels'] * samples * rec['sessions'] * rec['runs_per_session']
+
+
+def global_schedule(dataset_configs, dataset_names):
+    """(dataset_name, subject) units of all selected datasets, longest first.
+
+    Handing the units to whichever worker is idle in this order (longest
+    processing time first) keeps the expensive subjects, e.g.
+    Schirrmeister2017's 128-channel recordings, from ending up as
+    stragglers, while the cheap ones fill the gaps at the end.
+    """
+    units = []
+    for dataset_name in dataset_names:
+        config = dataset_configs[dataset_name]
+        units += [(subject_cost(config), dataset_name, subject) for subject in config['subjects']]
+    # Stable sort: within a dataset, subjects keep their order
+    units.sort(key=lambda unit: -unit[0])
+    return [(dataset_name, subject) for _, dataset_name, subject in units]
+
+
+def makespan_report(timings, n_workers, wall_seconds):
+    """Compare the achieved makespan with the ideal one for the measured unit times.
+
+    No schedule can finish before the total work is spread evenly over the
+    workers, nor before the longest unit is done, so the ideal makespan is
+    the larger of the two. `timings` holds {'dataset', 'subject',
+    'seconds'} per completed unit.
+    """
+    durations = [timing['seconds'] for timing in timings]
+    total = sum(durations)
+    ideal = max(total / n_workers, max(durations, default=0.))
+    per_dataset = {}
+    for timing in timings:
+        entry = per_dataset.setdefault(timing['dataset'], {'units': 0, 'seconds': 0.})
+        entry['units'] += 1
+        entry['seconds'] += timing['seconds']
+    return {
+        'workers': n_workers,
+        'units': len(timings),
+        'work_seconds': total,
+        'makespan_seconds': wall_seconds,
+        'ideal_makespan_seconds': ideal,
+        'overhead': wall_seconds / ideal - 1 if ideal > 0 else 0.,
+        'utilization': total / (n_workers * wall_seconds) if wall_seconds > 0 else 0.,
+        'longest': max(timings, key=lambda timing: timing['seconds'], default=None),
+        'datasets': per_dataset
+    }
+
+
+def print_makespan(summary):
+    """Print the makespan comparison"""
+    print(f"\nScheduled {summary['units']} subjects on {summary['workers']} workers:")
+    for dataset_name, entry in summary['datasets'].items():
+        print(f"  {dataset_name}: {entry['units']} subjects, {entry['seconds']:.1f} s of work")
+    print(f"  Makespan:       {summary['makespan_seconds']:.1f} s")
+    print(f"  Ideal makespan: {summary['ideal_makespan_seconds']:.1f} s "
+          f"({summary['overhead']:+.1%} achieved vs ideal, {summary['utilization']:.1%} worker utilization)")
+    if summary['longest'] is not None:
+        longest = summary['longest']
+        print(f"  Longest unit:   {longest['dataset']} subject {longest['subject']} ({longest['seconds']:.1f} s)")
@@ -0,0 +1,173 @@
+import io
+import os
+import json
+import shutil
+import tarfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from loader import EpochLoader, load_batch, run_meta
+from packs import subject_of
+
+# Name of the shard index inside a shard directory
+SHARD_INDEX = 'index.json'
+
+
+def shard_dir_of(save_dir):
+    """Directory holding the tar shards of a dataset directory"""
+    return os.path.join(save_dir, 'shards')
+
+
+def _add_member(tar, name, payload):
+    """Add an in-memory file to a tar archive (fixed mtime, so rebuilt shards are identical)"""
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(payload))
+
+
+def _npy_bytes(array):
+    """A single trial in .npy format"""
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array))
+    return buffer.getvalue()
+
+
+def write_shards(save_dir, shard_bytes=256 * 1024 ** 2, seed=0, shard_dir=None):
+    """Write all stored epochs of a dataset directory into fixed-size tar shards.
+
+    Trials are assigned to shards in a random order (fixed by `seed`), so
+    each shard mixes subjects, runs and labels. Every trial is stored as
+    two members sharing a key, <run>_e<epoch>.npy (its (n_channels,
+    n_times) array) and <run>_e<epoch>.json (dataset, subject, run, epoch,
+    condition, label), and each shard holds about `shard_bytes` of arrays.
+    index.json lists the shards with their trial and label counts, and the
+    channel names, sampling rate and epoch timing shared by all trials.
+
+    Reads the npy epoch arrays, loose or packed; runs written only as CSV
+    are not included. The shards are built in a temporary directory that
+    then replaces any previous ones. Returns the shard directory.
+    """
+    index = EpochLoader(save_dir, shuffle=None)
+    metas = [run_meta(source) for source in index.filepaths]
+    trial = load_batch(index.filepaths, index.runs[:1], index.positions[:1])[0]
+    per_shard = max(1, shard_bytes // trial.nbytes)
+    order = np.random.default_rng(seed).permutation(len(index.runs))
+
+    shard_dir = shard_dir or shard_dir_of(save_dir)
+    tmp_dir = shard_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    shards = []
+    for shard, start in enumerate(range(0, len(order), per_shard)):
+        items = order[start:start + per_shard]
+        data = load_batch(index.filepaths, index.runs[items], index.positions[items])
+        name = f'shard-{shard:06d}.tar'
+        labels = {}
+        with tarfile.open(os.path.join(tmp_dir, name), 'w') as tar:
+            for array, run, position in zip(data, index.runs[items], index.positions[items]):
+                source, meta = index.filepaths[run], metas[run]
+                run_name = os.path.basename(source[1] if isinstance(source, tuple) else source)
+                run_name = run_name.replace('_data.csv', '')
+                epoch = meta['epoch'][position]
+                key = f'{run_name}_e{epoch:06d}'
+                _add_member(tar, key + '.npy', _npy_bytes(array))
+                _add_member(tar, key + '.json', json.dumps({
+                    'dataset': meta['dataset'],
+                    'run': run_name,
+                    'subject': subject_of(run_name),
+                    'epoch': epoch,
+                    'condition': meta['condition'][position],
+                    'label': meta['label'][position]
+                }).encode())
+                label = str(meta['label'][position])
+                labels[label] = labels.get(label, 0) + 1
+        shards.append({'name': name, 'n_trials': len(items),
+                       'bytes': os.path.getsize(os.path.join(tmp_dir, name)), 'labels': labels})
+
+    with open(os.path.join(tmp_dir, SHARD_INDEX), 'w') as f:
+        json.dump({
+            'dataset': metas[0]['dataset'],
+            'ch_names': metas[0]['ch_names'],
+            'sfreq': metas[0]['sfreq'],
+            'tmin': metas[0]['tmin'],
+            'n_times': metas[0]['n_times'],
+            'dtype': str(trial.dtype),
+            'unit': 'V',
+            'seed': seed,
+            'n_trials': int(len(order)),
+            'shards': shards
+        }, f, indent=1)
+
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.replace(tmp_dir, shard_dir)
+    return shard_dir
+
+
+class ShardReader:
+    """Streams the trials of a shard directory with large sequential reads.
+
+    Each shard is read in one go by background threads, up to `readahead`
+    shards ahead of the consumer, then unpacked in memory. shuffle=True
+    visits the shards in a new random order on every pass and mixes the
+    trials of `shuffle_shards` consecutive shards; as trials were assigned
+    to shards at random, this gives a well mixed stream without random
+    access. Iterating yields (array, metadata) per trial.
+    """
+
+    def __init__(self, shard_dir, shuffle=True, shuffle_shards=2, readahead=2, seed=0):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, SHARD_INDEX)) as f:
+            self.index = json.load(f)
+        self.shuffle = shuffle
+        self.shuffle_shards = shuffle_shards
+        self.readahead = readahead
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.index['n_trials']
+
+    def _read_shard(self, name):
+        """Trials of one shard, read with a single sequential read"""
+        with open(os.path.join(self.shard_dir, name), 'rb') as f:
+            payload = f.read()
+        trials = {}
+        with tarfile.open(fileobj=io.BytesIO(payload)) as tar:
+            for member in tar:
+                key, ext = member.name.rsplit('.', 1)
+                content = tar.extractfile(member).read()
+                entry = trials.setdefault(key, {})
+                entry[ext] = np.load(io.BytesIO(content)) if ext == 'npy' else json.loads(content)
+        return [(entry['npy'], entry['json']) for entry in trials.values()]
+
+    def __iter__(self):
+        names = [shard['name'] for shard in self.index['shards']]
+        if self.shuffle:
+            names = [names[i] for i in self.rng.permutation(len(names))]
+        group = self.shuffle_shards if self.shuffle else 1
+        with ThreadPoolExecutor(max(1, self.readahead)) as executor:
+            pending = [executor.submit(self._read_shard, name) for name in names[:self.readahead + group]]
+            next_name = len(pending)
+            while pending:
+                trials = []
+                for future in pending[:group]:
+                    trials += future.result()
+                pending = pending[group:]
+                for name in names[next_name:next_name + group]:
+                    pending.append(executor.submit(self._read_shard, name))
+                next_name += group
+                if self.shuffle:
+                    trials = [trials[i] for i in self.rng.permutation(len(trials))]
+                yield from trials
+
+    def batches(self, batch_size=64, drop_last=False):
+        """Stacked (data, labels) batches of the trial stream"""
+        data, labels = [], []
+        for array, meta in self:
+            data.append(array)
+            labels.append(meta['label'])
+            if len(data) == batch_size:
+                yield np.stack(data), np.array(labels)
+                data, labels = [], []
+        if data and not drop_last:
+            yield np.stack(data), np.array(labels)
@@ -0,0 +1,190 @@
+import os
+import io
+import re
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Processing stages timed in every process_* function, in pipeline order
+STAGES = ['load', 'pick', 'filter', 'events', 'epoch', 'clean', 'stats', 'to-frame', 'write', 'features']
+
+
+def current_rss(pid=None):
+    """Resident memory of this process (or of process pid) in bytes (None when it cannot be read)"""
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class StageRecorder:
+    """Accumulates wall time and peak memory per (dataset, stage).
+
+    Peak memory is the largest increase of the process's resident memory
+    over its value at the start of a stage. It is sampled by a background
+    thread every `interval` seconds, which keeps the overhead negligible
+    (unlike tracemalloc, which slows down pandas' CSV writer many times).
+    A nested stage (e.g. 'to-frame' inside 'write') is also counted in its
+    enclosing stage.
+    """
+
+    def __init__(self, trace_memory=True, interval=0.005):
+        self.results = {}
+        self.trace_memory = trace_memory and current_rss() is not None
+        self.interval = interval
+        self.peak_rss = 0
+        self.running = True
+        if self.trace_memory:
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+
+    def _sample(self):
+        """Keep track of the highest resident memory seen"""
+        while self.running:
+            self.peak_rss = max(self.peak_rss, current_rss())
+            time.sleep(self.interval)
+
+    @contextmanager
+    def stage(self, dataset_name, name):
+        """Time one execution of a stage and add it to the totals"""
+        outer_peak = self.peak_rss
+        if self.trace_memory:
+            start_rss = self.peak_rss = current_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = 0
+            if self.trace_memory:
+                peak = max(self.peak_rss, current_rss()) - start_rss
+            entry = self.results.setdefault(dataset_name, {}).setdefault(
+                name, {'seconds': 0., 'calls': 0, 'peak_mb': 0.})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+            entry['peak_mb'] = max(entry['peak_mb'], peak / 1024 ** 2)
+            self.peak_rss = max(outer_peak, self.peak_rss)
+
+    def close(self):
+        """Stop the memory sampler"""
+        self.running = False
+        if self.trace_memory:
+            self.sampler.join()
+
+
+def library(filename, function):
+    """Library a profiled function belongs to, for the per-stage breakdown"""
+    if filename == '~':
+        # C functions: file and OS calls, else the package of the method's type or module
+        if any(word in function for word in ('_io.', 'io.open', 'posix.', 'read', 'write', 'flush')):
+            return 'io'
+        match = re.search(r"(?:of '|built-in method )(\w+)\.", function)
+        if match is None or match.group(1) == 'builtins':
+            return 'builtins'
+        return 'stdlib' if match.group(1) in sys.stdlib_module_names else match.group(1).lstrip('_')
+    parts = filename.replace(os.sep, '/').split('/')
+    for marker in ('site-packages', 'dist-packages'):
+        if marker in parts and parts.index(marker) + 1 < len(parts):
+            return parts[parts.index(marker) + 1].split('.')[0]
+    if os.path.dirname(os.path.abspath(filename)) == os.path.dirname(os.path.abspath(__file__)):
+        return 'pipeline'
+    return 'stdlib'
+
+
+class StageProfiler:
+    """Deterministic cProfile profiles per (dataset, stage).
+
+    Each stage has its own profile, enabled only while the stage runs, so
+    the profiles can be opened separately with pstats or snakeviz. A nested
+    stage pauses the profile of its enclosing one. Only the calling thread
+    is profiled: work done in the filter engine's threads or in writer
+    processes shows up as time spent waiting for them. Profiles taken in
+    worker processes (see take) are merged in with merge.
+    """
+
+    def __init__(self, output_dir='./profiles', top=20):
+        self.output_dir = output_dir
+        self.top = top
+        self.profiles = {}
+        self.received = {}
+        self.active = []
+
+    @contextmanager
+    def stage(self, dataset_name, name):
+        """Profile one execution of a stage"""
+        profile = self.profiles.setdefault((dataset_name, name), cProfile.Profile())
+        if self.active:
+            self.active[-1].disable()
+        self.active.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.active.pop()
+            if self.active:
+                self.active[-1].enable()
+
+    def take(self):
+        """Statistics of the stages profiled so far, which are then reset (picklable, for merge)"""
+        records = {key: pstats.Stats(profile).stats for key, profile in self.profiles.items()}
+        self.profiles = {}
+        return records
+
+    def merge(self, records):
+        """Add statistics returned by take, e.g. in a worker process"""
+        for key, entries in records.items():
+            stats = pstats.Stats(stream=io.StringIO())
+            stats.stats = entries
+            stats.get_top_level_stats()
+            self.received.setdefault(key, pstats.Stats(stream=io.StringIO())).add(stats)
+
+    def stats(self, key):
+        """Statistics of one (dataset, stage), from this process and the merged ones"""
+        stats = pstats.Stats(stream=io.StringIO())
+        for source in (self.profiles, self.received):
+            if key in source:
+                stats.add(source[key])
+        return stats
+
+    def summary(self, dataset_name, name):
+        """Text summary of one stage: time per library and the hottest functions"""
+        stats = self.stats((dataset_name, name))
+        by_library = {}
+        for (filename, _, function), (_, _, tottime, _, _) in stats.stats.items():
+            lib = library(filename, function)
+            by_library[lib] = by_library.get(lib, 0.) + tottime
+
+        lines = [f"== {dataset_name} / {name}: {stats.total_tt:.3f} s"]
+        for lib, seconds in sorted(by_library.items(), key=lambda item: -item[1]):
+            share = seconds / stats.total_tt * 100 if stats.total_tt else 0.
+            lines.append(f"  {lib:<16}{seconds:9.3f} s {share:6.1f}%")
+        stats.stream = io.StringIO()
+        stats.sort_stats('tottime').print_stats(self.top)
+        lines.append(stats.stream.getvalue().split('\n\n', 1)[-1].rstrip())
+        return '\n'.join(lines)
+
+    def save(self):
+        """Write one .prof file per dataset and stage, plus summary.txt"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        summaries = []
+        for dataset_name, name in sorted(set(self.profiles) | set(self.received)):
+            self.stats((dataset_name, name)).dump_stats(os.path.join(self.output_dir, f'{dataset_name}_{name}.prof'))
+            summaries.append(self.summary(dataset_name, name))
+        with open(os.path.join(self.output_dir, 'summary.txt'), 'w') as f:
+            f.write('\n\n'.join(summaries) + '\n')
+        print(f"Stage profiles saved to {self.output_dir} (summary in summary.txt)")
@@ -0,0 +1,194 @@
+import time
+import numpy as np
+import mne
+from scipy import signal
+
+
+def design_causal_filter(sfreq, fmin, fmax, method='fir'):
+    """Design a causal band-pass filter for streaming use.
+
+    The offline pipeline uses a zero-phase FIR, which needs future samples.
+    Here the FIR is designed with minimum phase (same band edges, firwin design)
+    so it can be run sample by sample; 'iir' gives a 4th order Butterworth
+    in second-order sections with lower delay.
+    """
+    if method == 'fir':
+        h = mne.filter.create_filter(None, sfreq, fmin, fmax, method='fir', phase='minimum',
+                                     fir_design='firwin', verbose=False)
+        return {'b': h}
+    elif method == 'iir':
+        iir_params = mne.filter.create_filter(None, sfreq, fmin, fmax, method='iir',
+                                              iir_params=dict(order=4, ftype='butter', output='sos'),
+                                              verbose=False)
+        return {'sos': iir_params['sos']}
+    raise ValueError(f"Unknown streaming filter method: {method}")
+
+
+class StreamingFilter:
+    """Band-pass filter applied chunk by chunk, carrying filter state across chunks"""
+
+    def __init__(self, n_channels, sfreq, fmin, fmax, method='fir'):
+        self.coefs = design_causal_filter(sfreq, fmin, fmax, method)
+        if 'sos' in self.coefs:
+            self.zi = np.zeros((self.coefs['sos'].shape[0], n_channels, 2))
+        else:
+            self.zi = np.zeros((n_channels, len(self.coefs['b']) - 1))
+
+    def process(self, chunk):
+        """Filter a (n_channels, n_samples) chunk and update the filter state"""
+        if 'sos' in self.coefs:
+            out, self.zi = signal.sosfilt(self.coefs['sos'], chunk, axis=-1, zi=self.zi)
+        else:
+            out, self.zi = signal.lfilter(self.coefs['b'], 1., chunk, axis=-1, zi=self.zi)
+        return out
+
+
+class StreamingEpocher:
+    """Cut fixed windows around event markers from a stream of filtered chunks.
+
+    Windows follow the offline epoch definition: samples
+    round(tmin * sfreq) .. round(tmax * sfreq) relative to the marker, inclusive.
+    An epoch is emitted as soon as the chunk holding its last sample arrives,
+    and only the samples still needed by pending epochs are kept in memory.
+    """
+
+    def __init__(self, n_channels, sfreq, event_id, tmin, tmax):
+        self.event_id = event_id
+        self.start = int(round(tmin * sfreq))
+        self.stop = int(round(tmax * sfreq))
+        self.n_times = self.stop - self.start + 1
+        self.buffer = np.zeros((n_channels, 0))
+        self.buffer_start = 0  # Absolute sample index of buffer[:, 0]
+        self.n_seen = 0  # Absolute sample index after the last pushed sample
+        self.pending = []
+
+    def push(self, chunk, markers=()):
+        """Add a filtered chunk and its markers, return the list of completed epochs"""
+        for sample, description in markers:
+            if description in self.event_id:
+                self.pending.append((sample, description))
+
+        self.buffer = np.concatenate([self.buffer, chunk], axis=1)
+        self.n_seen += chunk.shape[1]
+
+        emitted = []
+        still_pending = []
+        for sample, description in self.pending:
+            first, last = sample + self.start, sample + self.stop
+            if first < self.buffer_start:
+                # Window starts before the data we kept (or before the stream began)
+                print(f"Dropping {description} epoch at sample {sample}: not enough buffered data")
+                continue
+            if last >= self.n_seen:
+                still_pending.append((sample, description))
+                continue
+            offset = first - self.buffer_start
+            emitted.append({
+                'data': self.buffer[:, offset:offset + self.n_times].copy(),
+                'condition': description,
+                'label': self.event_id[description],
+                'sample': sample,
+                'latency_samples': self.n_seen - 1 - last
+            })
+        self.pending = still_pending
+
+        # Keep only what pending epochs (and markers that may still arrive late) need
+        keep_from = self.n_seen - self.n_times
+        if self.pending:
+            keep_from = min(keep_from, min(s for s, _ in self.pending) + self.start)
+        keep_from = max(keep_from, self.buffer_start)
+        self.buffer = self.buffer[:, keep_from - self.buffer_start:]
+        self.buffer_start = keep_from
+        return emitted
+
+
+class StreamingPipeline:
+    """Streaming version of the dataset_configs preprocessing (band-pass + epoching)"""
+
+    def __init__(self, config, n_channels, sfreq, fmin, fmax, method='fir'):
+        self.sfreq = sfreq
+        self.filter = StreamingFilter(n_channels, sfreq, fmin, fmax, method)
+        self.epocher = StreamingEpocher(n_channels, sfreq, config['event_id'],
+                                        config['epoch_params']['tmin'],
+                                        config['epoch_params']['tmax'])
+
+    def push(self, chunk, markers=()):
+        """Filter a raw chunk and return the epochs it completes"""
+        return self.epocher.push(self.filter.process(chunk), markers)
+
+
+class ReplaySource:
+    """Replay a recorded Raw object as a live stream of (chunk, markers).
+
+    Markers are taken from the annotations as (absolute sample, description).
+    speed=1 replays in real time, speed=10 ten times faster, speed=0 as fast
+    as possible.
+    """
+
+    def __init__(self, raw, chunk_duration=0.1, speed=1.0):
+        self.raw = raw.copy().pick_types(eeg=True, meg=False, stim=False, eog=False, emg=False, misc=False)
+        self.sfreq = self.raw.info['sfreq']
+        self.chunk_size = max(1, int(round(chunk_duration * self.sfreq)))
+        self.speed = speed
+
+        onsets = self.raw.time_as_index(self.raw.annotations.onset, use_rounding=True,
+                                        origin=self.raw.annotations.orig_time)
+        self.markers = sorted(zip(onsets.tolist(), self.raw.annotations.description))
+
+    def __iter__(self):
+        data = self.raw.get_data()
+        n_samples = data.shape[1]
+        t_start = time.perf_counter()
+        marker_idx = 0
+        for first in range(0, n_samples, self.chunk_size):
+            last = min(first + self.chunk_size, n_samples)
+
+            # Wait until the chunk would have been recorded
+            if self.speed:
+                delay = last / self.sfreq / self.speed - (time.perf_counter() - t_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            markers = []
+            while marker_idx < len(self.markers) and self.markers[marker_idx][0] < last:
+                markers.append(self.markers[marker_idx])
+                marker_idx += 1
+            yield data[:, first:last], markers
+
+
+def replay_moabb(config, subject, chunk_duration=0.1, speed=1.0):
+    """Yield a ReplaySource for every run of a MOABB subject"""
+    dataset = config['class']()
+    raw_data = dataset.get_data(subjects=[subject])
+    for session, session_data in raw_data[subject].items():
+        for run, raw in session_data.items():
+            yield session, run, ReplaySource(raw, chunk_duration=chunk_duration, speed=speed)
+
+
+def benchmark_latency(pipeline, source):
+    """Run a replay source through a streaming pipeline and report epoch latency.
+
+    Latency is the wall time from the arrival of the chunk that holds an
+    epoch's last sample to the epoch being emitted, plus the buffering delay
+    of that sample inside its chunk.
+    """
+    latencies = []
+    n_epochs = 0
+    t_start = time.perf_counter()
+    for chunk, markers in source:
+        t_arrival = time.perf_counter()
+        epochs = pipeline.push(chunk, markers)
+        t_done = time.perf_counter()
+        for epoch in epochs:
+            latencies.append(t_done - t_arrival + epoch['latency_samples'] / pipeline.sfreq)
+        n_epochs += len(epochs)
+    elapsed = time.perf_counter() - t_start
+
+    stream_seconds = source.raw.n_times / source.sfreq
+    latencies = np.array(latencies) * 1000
+    print(f"Emitted {n_epochs} epochs from {stream_seconds:.1f}s of data in {elapsed:.2f}s "
+          f"({stream_seconds / elapsed:.1f}x real time)")
+    if n_epochs:
+        print(f"Latency: mean {latencies.mean():.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms, "
+              f"max {latencies.max():.1f} ms")
+    return latencies
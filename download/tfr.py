@@ -0,0 +1,125 @@
+import os
+import json
+import numpy as np
+from scipy import signal
+from mne.time_frequency import tfr_array_morlet
+from features import feature_fingerprint
+
+# Parameters that change how maps are computed, not what they contain
+RUNTIME_PARAMS = ('chunk_mb',)
+
+
+def tfr_path(filepath):
+    """Path of a run's time-frequency array, stored next to its data file"""
+    return filepath.replace('_data.csv', '_tfr.npy')
+
+
+def tfr_meta_path(filepath):
+    """Path of a run's time-frequency metadata sidecar"""
+    return filepath.replace('_data.csv', '_tfr.json')
+
+
+def tfr_fingerprint(epoch_info, params):
+    """Hash of the epoching settings and time-frequency parameters a cached map depends on"""
+    return feature_fingerprint(epoch_info, {k: v for k, v in params.items() if k not in RUNTIME_PARAMS})
+
+
+def chunk_epochs(n_channels, n_freqs, n_times, chunk_mb):
+    """Epochs per batch so one batch's complex coefficients stay within chunk_mb"""
+    per_epoch = n_channels * n_freqs * n_times * 16
+    return max(1, int(chunk_mb * 1024 ** 2 // per_epoch))
+
+
+def stft_window(sfreq, params):
+    """STFT window length in samples"""
+    return int(round(params['stft_window'] * sfreq))
+
+
+def tfr_axes(n_times, sfreq, tmin, params):
+    """Frequencies and times of the maps of epochs of n_times samples starting at tmin"""
+    times = tmin + np.arange(n_times) / sfreq
+    if params['method'] == 'morlet':
+        return np.asarray(params['freqs'], dtype=float), times[::params['decim']]
+
+    # STFT: the bins nearest to the requested frequencies, one frame every decim samples
+    n_per_seg = stft_window(sfreq, params)
+    bins = np.fft.rfftfreq(n_per_seg, 1. / sfreq)
+    picks = np.unique(np.abs(bins[:, None] - np.asarray(params['freqs'])[None]).argmin(axis=0))
+    n_frames = (n_times + 2 * (n_per_seg // 2) - n_per_seg) // params['decim'] + 1
+    return bins[picks], times[0] + np.arange(n_frames) * params['decim'] / sfreq
+
+
+def tfr_power(data, sfreq, params):
+    """Power maps (n_epochs, n_channels, n_freqs, n_times) of a batch of epochs in Volts.
+
+    'morlet' convolves each epoch with Morlet wavelets (n_cycles per
+    frequency) and keeps every decim-th sample. 'stft' uses a Hann window of
+    stft_window seconds advanced by decim samples, keeping the bins nearest
+    to the requested frequencies.
+    """
+    if params['method'] == 'morlet':
+        return tfr_array_morlet(data, sfreq, np.asarray(params['freqs'], dtype=float), n_cycles=params['n_cycles'],
+                                decim=params['decim'], output='power', verbose=False)
+
+    n_per_seg = stft_window(sfreq, params)
+    bins, _ = tfr_axes(data.shape[-1], sfreq, 0., params)
+    _, _, spectrum = signal.stft(data, fs=sfreq, window='hann', nperseg=n_per_seg,
+                                 noverlap=n_per_seg - params['decim'], boundary='even', padded=False, axis=-1)
+    picks = np.searchsorted(np.fft.rfftfreq(n_per_seg, 1. / sfreq), bins)
+    return np.abs(spectrum[:, :, picks]) ** 2
+
+
+def compute_tfr(filepath, data, sfreq, tmin, params, fingerprint, epoch_ids, conditions, labels, ch_names):
+    """Compute the time-frequency maps of a run's epochs in batches and store them next to the run.
+
+    data is the (n_epochs, n_channels, n_times) array in Volts, e.g. the
+    memory-mapped epoch array, from which one batch of epochs is read at a
+    time. Each batch is transformed and written straight into the output
+    .npy (opened as a memory map), so memory stays at one batch whatever
+    the run's length. Maps are stored as power in uV^2, or its log10 with
+    log=True, in `dtype` (float16 keeps the file small). The sidecar is
+    written last, so an interrupted run leaves no valid cache behind.
+    """
+    n_epochs, n_channels, n_times = data.shape
+    freqs, times = tfr_axes(n_times, sfreq, tmin, params)
+    shape = (n_epochs, n_channels, len(freqs), len(times))
+    step = chunk_epochs(n_channels, len(freqs), n_times, params['chunk_mb'])
+
+    tmp_path = tfr_path(filepath) + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=params['dtype'], shape=shape)
+    for start in range(0, n_epochs, step):
+        power = tfr_power(np.asarray(data[start:start + step], dtype=np.float64), sfreq, params) * 1e12
+        out[start:start + step] = np.log10(power) if params['log'] else power
+    out.flush()
+    del out
+    os.replace(tmp_path, tfr_path(filepath))
+
+    meta = {
+        'fingerprint': fingerprint,
+        'method': params['method'],
+        'freqs': freqs.tolist(),
+        'times': times.tolist(),
+        'unit': 'log10(uV^2)' if params['log'] else 'uV^2',
+        'ch_names': list(ch_names),
+        'epoch': np.asarray(epoch_ids).tolist(),
+        'condition': np.asarray(conditions).tolist(),
+        'label': np.asarray(labels).tolist()
+    }
+    with open(tfr_meta_path(filepath), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def load_tfr(filepath, fingerprint=None, mmap=True):
+    """A run's time-frequency maps and metadata, or None if they are missing or stale.
+
+    With mmap=True the maps are memory-mapped read-only, so only the epochs
+    that are accessed are read from disk.
+    """
+    if not os.path.exists(tfr_meta_path(filepath)) or not os.path.exists(tfr_path(filepath)):
+        return None
+    with open(tfr_meta_path(filepath)) as f:
+        meta = json.load(f)
+    if fingerprint is not None and meta['fingerprint'] != fingerprint:
+        return None
+    return np.load(tfr_path(filepath), mmap_mode='r' if mmap else None), meta
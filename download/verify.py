@@ -0,0 +1,288 @@
+import os
+import io
+import bz2
+import csv
+import gzip
+import json
+import lzma
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from epoch_store import file_checksum, read_npy_header, csv_compressions
+from packs import find_packs, RunPack, PACK_SUFFIX
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Readers of compressed CSVs by extension, wrapping a file object positioned at the data
+readers = {
+    '.gz': lambda f: gzip.GzipFile(fileobj=f),
+    '.bz2': bz2.BZ2File,
+    '.xz': lzma.LZMAFile,
+    '.zst': lambda f: io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+}
+
+# Bytes read from the end of a plain CSV to check its last row
+TAIL_BYTES = 64 * 1024
+
+
+def file_locations(save_dir):
+    """(path, offset, size) of every output file of a dataset directory, loose or in a container"""
+    locations = {}
+    for path in find_packs(save_dir):
+        pack = RunPack(path)
+        for name, (offset, size) in pack.index.items():
+            locations[name] = (path, offset, size)
+    for name in os.listdir(save_dir):
+        path = os.path.join(save_dir, name)
+        if not name.endswith(PACK_SUFFIX) and os.path.isfile(path):
+            locations[name] = (path, 0, os.path.getsize(path))
+    return locations
+
+
+def read_range(location, start=0, length=None):
+    """Bytes of a file (or container member) from `start`, up to `length` of them"""
+    path, offset, size = location
+    length = size - start if length is None else min(length, size - start)
+    with open(path, 'rb') as f:
+        f.seek(offset + start)
+        return f.read(length)
+
+
+def expected_n_times(config, sfreq):
+    """Samples per epoch for the dataset's epoch window, as MNE counts them"""
+    params = config['epoch_params']
+    return int(round(params['tmax'] * sfreq)) - int(round(params['tmin'] * sfreq)) + 1
+
+
+def check_npy(location, shape):
+    """Problems with an epoch array, from its header and file size"""
+    array_shape, _, dtype, header_length = read_npy_header(io.BytesIO(read_range(location, 0, 4096)))
+    if array_shape != shape:
+        return [f"epoch array has shape {array_shape}, expected {shape}"]
+    n_bytes = header_length + dtype.itemsize * shape[0] * shape[1] * shape[2]
+    if location[2] != n_bytes:
+        return [f"epoch array has {location[2]} bytes, expected {n_bytes}"]
+    return []
+
+
+def csv_names(run):
+    """Possible names of a run's CSV, plain or compressed"""
+    return [run + '_data.csv' + ext for ext in [''] + list(csv_compressions.values())]
+
+
+def run_of(name):
+    """Run of an output file name: its metadata sidecar, CSV or epoch array (None for other files)"""
+    for suffix in ['_meta.json', '_epochs.npy'] + csv_names(''):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def read_header(name, location):
+    """Column names of a (possibly compressed) CSV"""
+    ext = os.path.splitext(name)[1]
+    with open(location[0], 'rb') as f:
+        f.seek(location[1])
+        stream = readers[ext](f) if ext in readers else f
+        header = stream.readline().decode().rstrip('\r\n')
+    return next(csv.reader([header]), [])
+
+
+def read_last_row(location):
+    """Fields of the last row of a plain CSV (None when it ends in the middle of a row)"""
+    tail = read_range(location, max(0, location[2] - TAIL_BYTES))
+    if not tail.endswith(b'\n'):
+        return None
+    return next(csv.reader([tail.rstrip(b'\r\n').rsplit(b'\n', 1)[-1].decode()]))
+
+
+def check_csv(name, location, meta):
+    """Problems with a run's CSV, from its header row and (uncompressed) last row"""
+    columns = ['time', 'condition', 'epoch'] + meta['ch_names'] + ['label'] + list(meta['extra_columns'])
+    ext = os.path.splitext(name)[1]
+    if ext == '.zst' and zstandard is None:
+        return []
+    if read_header(name, location) != columns:
+        return ["CSV header does not match the run's channels"]
+    if ext in readers:
+        return []
+
+    # The last row must be complete and belong to the last epoch
+    fields = read_last_row(location)
+    if fields is None:
+        return ["CSV ends in the middle of a row"]
+    if len(fields) != len(columns):
+        return [f"last CSV row has {len(fields)} fields, expected {len(columns)}"]
+    if meta['epoch'] and fields[2] != str(meta['epoch'][-1]):
+        return [f"last CSV row is from epoch {fields[2]}, expected {meta['epoch'][-1]}"]
+    return []
+
+
+def check_bare_csv(name, location, config):
+    """Problems with the CSV of a run without metadata sidecar, and its channel names.
+
+    The channels are taken from the header, which must be that of a run
+    table. For plain CSVs, the first and last rows must be 1 / sfreq *
+    (expected_n_times - 1) apart, so the last epoch is complete.
+    """
+    ext = os.path.splitext(name)[1]
+    if ext == '.zst' and zstandard is None:
+        return [], None
+    columns = read_header(name, location)
+    if columns[:3] != ['time', 'condition', 'epoch'] or 'label' not in columns:
+        return ["CSV header is not that of a run table"], None
+    ch_names = tuple(columns[3:columns.index('label')])
+    if ext in readers:
+        return [], ch_names
+
+    rows = read_range(location, 0, TAIL_BYTES).split(b'\n')
+    if len(rows) < 3:
+        return ["no epochs"], ch_names
+    first = next(csv.reader([rows[1].decode()]))
+    last = read_last_row(location)
+    if last is None:
+        return ["CSV ends in the middle of a row"], ch_names
+    if len(last) != len(columns):
+        return [f"last CSV row has {len(last)} fields, expected {len(columns)}"], ch_names
+    sfreq = config['recording']['sfreq']
+    n_times = expected_n_times(config, sfreq)
+    samples = int(round((float(last[0]) - float(first[0])) * sfreq)) + 1
+    if samples != n_times:
+        return [f"last CSV epoch ends at sample {samples}, expected {n_times}"], ch_names
+    return [], ch_names
+
+
+def check_bare_run(locations, run, config):
+    """Problems with a run written without metadata sidecar, and its channel names.
+
+    Only the CSV header and last row and the epoch array's header and size
+    can be checked: the sizes and CRC32 recorded at write time are not
+    available.
+    """
+    problems, ch_names = [], None
+    name = next((n for n in csv_names(run) if n in locations), None)
+    if name is not None:
+        problems, ch_names = check_bare_csv(name, locations[name], config)
+    if run + '_epochs.npy' in locations:
+        location = locations[run + '_epochs.npy']
+        shape = read_npy_header(io.BytesIO(read_range(location, 0, 4096)))[0]
+        n_channels = len(ch_names) if ch_names is not None else shape[1]
+        problems += check_npy(location, (shape[0], n_channels, expected_n_times(config, config['recording']['sfreq'])))
+    return problems, ch_names
+
+
+def check_run(locations, run, config, checksums=False):
+    """Problems with one run's outputs and its channel names.
+
+    Reads the metadata sidecar, the header of each data file and the last
+    row of plain CSVs, and compares file sizes with those recorded when the
+    run was written. With checksums=True the data files are also read in
+    full and their CRC32 compared with the recorded one. Runs without a
+    sidecar are checked with check_bare_run.
+    """
+    try:
+        if run + '_meta.json' not in locations:
+            return check_bare_run(locations, run, config)
+        meta = json.loads(read_range(locations[run + '_meta.json']))
+        n_epochs = len(meta['epoch'])
+        problems = []
+        if not n_epochs:
+            problems.append("no epochs")
+        if len(meta['condition']) != n_epochs or len(meta['label']) != n_epochs:
+            problems.append("metadata has different numbers of epochs, conditions and labels")
+        n_times = expected_n_times(config, meta['sfreq'])
+        if meta['n_times'] != n_times:
+            problems.append(f"{meta['n_times']} samples per epoch, expected {n_times}")
+
+        for fmt in meta['formats']:
+            if fmt == 'npy':
+                name = run + '_epochs.npy'
+            else:
+                names = csv_names(run)
+                name = next((n for n in names if n in locations), names[0])
+            if name not in locations:
+                problems.append(f"{name} is missing")
+            elif fmt == 'npy':
+                problems += check_npy(locations[name], (n_epochs, len(meta['ch_names']), meta['n_times']))
+            else:
+                problems += check_csv(name, locations[name], meta)
+
+        # Sizes and checksums recorded at write time
+        for name, entry in (meta.get('files') or {}).items():
+            if name not in locations:
+                continue
+            if locations[name][2] != entry['bytes']:
+                problems.append(f"{name} has {locations[name][2]} bytes, {entry['bytes']} were written")
+            elif checksums and file_checksum(*locations[name]) != entry['crc32']:
+                problems.append(f"{name} does not match its checksum")
+        return problems, tuple(meta['ch_names'])
+    except Exception as e:
+        # Damaged metadata, headers or compressed streams
+        return [f"unreadable: {str(e)}"], None
+
+
+def verify_outputs(dataset_configs, save_dirs, dataset_names, n_jobs=8, checksums=False):
+    """Check the outputs of the selected datasets against their expected subjects and runs.
+
+    Every subject in a dataset's 'subjects' should have one output per
+    entry of its 'runs'. Runs are checked on `n_jobs` threads. Runs whose
+    channels differ from the dataset's most common channel set are flagged
+    too. A run is present when its metadata sidecar, CSV or epoch array
+    is; runs without a sidecar (e.g. written by older versions) are checked
+    from their headers only, and listed under 'no_sidecar' since their
+    sizes and checksums cannot be checked. Returns per dataset the number
+    of expected and complete runs, the missing runs, the problems per run
+    and any runs that were not expected.
+    """
+    results = {}
+    with ThreadPoolExecutor(n_jobs) as executor:
+        checks = {}
+        for dataset_name in dataset_names:
+            config = dataset_configs[dataset_name]
+            locations = file_locations(save_dirs[dataset_name])
+            present = {run_of(name) for name in locations} - {None}
+            expected = [f'subject_{subject}_{run}' for subject in config['subjects'] for run in config['runs']]
+            checks[dataset_name] = {run: executor.submit(check_run, locations, run, config, checksums)
+                                    for run in expected if run in present}
+            results[dataset_name] = {
+                'expected': len(expected),
+                'complete': 0,
+                'missing': [run for run in expected if run not in present],
+                'problems': {},
+                'unexpected': sorted(present - set(expected)),
+                'no_sidecar': [run for run in expected if run in present and run + '_meta.json' not in locations]
+            }
+
+        for dataset_name, futures in checks.items():
+            runs = {run: future.result() for run, future in futures.items()}
+            channels = Counter(ch_names for _, ch_names in runs.values() if ch_names is not None)
+            common = channels.most_common(1)[0][0] if channels else None
+            for run, (problems, ch_names) in runs.items():
+                if ch_names is not None and ch_names != common:
+                    problems.append(f"channels differ from the dataset's other runs ({len(ch_names)} vs {len(common)})")
+                if problems:
+                    results[dataset_name]['problems'][run] = problems
+            results[dataset_name]['complete'] = len(runs) - len(results[dataset_name]['problems'])
+    return results
+
+
+def print_verification(results, limit=10):
+    """Print a summary per dataset, listing up to `limit` missing and faulty runs"""
+    for dataset_name, result in results.items():
+        print(f"\n{dataset_name}: {result['complete']}/{result['expected']} runs complete, "
+              f"{len(result['missing'])} missing, {len(result['problems'])} with problems")
+        for run in result['missing'][:limit]:
+            print(f"  missing: {run}")
+        if len(result['missing']) > limit:
+            print(f"  ... and {len(result['missing']) - limit} more missing")
+        for run, problems in list(result['problems'].items())[:limit]:
+            print(f"  {run}: {'; '.join(problems)}")
+        if len(result['problems']) > limit:
+            print(f"  ... and {len(result['problems']) - limit} more with problems")
+        if result['no_sidecar']:
+            print(f"  {len(result['no_sidecar'])} runs have no metadata sidecar: checked from their headers, "
+                  f"sizes and checksums unavailable")
+        if result['unexpected']:
+            print(f"  {len(result['unexpected'])} runs not in the expected list, e.g. {result['unexpected'][0]}")
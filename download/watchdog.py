@@ -0,0 +1,165 @@
+import os
+import time
+import multiprocessing as mp
+
+
+class DownloadTimeout(RuntimeError):
+    """A subject's download stalled on every attempt or missed its deadline"""
+
+
+def list_files(path):
+    """Paths of the files below path"""
+    return {os.path.join(root, name) for root, _, files in os.walk(path) for name in files}
+
+
+def open_files(pid, path):
+    """Files below path that process pid has open, or None where /proc cannot be read"""
+    root = os.path.realpath(path) + os.sep
+    fd_dir = f'/proc/{pid}/fd'
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return None
+    files = set()
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:  # closed while scanning
+            continue
+        if target.startswith(root):
+            files.add(target)
+    return files
+
+
+class DownloadProgress:
+    """Bytes written by one download process, ignoring other processes' downloads.
+
+    Follows the files below the download directory that the process has open
+    (from /proc on Linux), remembering the last size of each, so files that
+    were completed and closed still count. Where /proc is not available, the
+    files created below the directory since the attempt started are counted
+    instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.existing = list_files(path)
+        self.sizes = {}
+
+    def bytes(self, pid):
+        """Bytes written so far by process pid (created after this object)"""
+        files = open_files(pid, self.path)
+        if files is None:
+            files = list_files(self.path) - self.existing
+        for path in files:
+            try:
+                self.sizes[path] = os.path.getsize(path)
+            except OSError:  # renamed or removed while scanning
+                pass
+        return sum(self.sizes.values())
+
+    def partial_files(self):
+        """Pooch's in-progress download files among those the process wrote"""
+        return {f for f in self.sizes if os.path.basename(f).startswith('tmp') and os.path.exists(f)}
+
+
+def _download(dataset, subject):
+    """Child process: fetch a subject's raw files without loading them"""
+    dataset.data_path(subject)
+
+
+class DownloadWatchdog:
+    """Runs each subject's download in a child process and watches its progress.
+
+    Progress is the number of bytes the subject's own download process has
+    written (see DownloadProgress), so concurrent downloads of other subjects
+    cannot hide a stalled one. When it does not grow for stall_timeout
+    seconds the transfer is cancelled (the child is terminated and the
+    partial files it wrote are removed) and started again, up to
+    max_attempts times; a transfer whose process fails (e.g. on a
+    connection reset) is started again the same way and listed in
+    `failures`. All attempts for a subject share one deadline of
+    subject_deadline seconds, until its files are downloaded; subjects
+    that stall out or miss it raise DownloadTimeout and are listed in
+    `timed_out`, subjects whose every attempt failed raise RuntimeError.
+    """
+
+    def __init__(self, download_dir, stall_timeout=120, subject_deadline=3600, max_attempts=3,
+                 poll_interval=2.):
+        self.download_dir = download_dir
+        self.stall_timeout = stall_timeout
+        self.subject_deadline = subject_deadline
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.deadlines = {}
+        self.timed_out = []
+        self.stalls = []
+        self.failures = []
+
+    def _attempt(self, dataset, subject, deadline):
+        """One download attempt: 'done', 'failed', 'stalled' or 'deadline'"""
+        progress = DownloadProgress(self.download_dir)
+        process = mp.Process(target=_download, args=(dataset, subject), daemon=True)
+        process.start()
+
+        last_bytes, last_progress = progress.bytes(process.pid), time.time()
+        status = None
+        while status is None:
+            process.join(self.poll_interval)
+            now = time.time()
+            if not process.is_alive():
+                if process.exitcode == 0:
+                    return 'done'
+                status = 'failed'
+            elif now > deadline:
+                status = 'deadline'
+            else:
+                n_bytes = progress.bytes(process.pid)
+                if n_bytes != last_bytes:
+                    last_bytes, last_progress = n_bytes, now
+                elif now - last_progress > self.stall_timeout:
+                    status = 'stalled'
+
+        # Cancel the transfer and drop its partial files
+        process.terminate()
+        process.join()
+        for path in progress.partial_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return status
+
+    def fetch(self, dataset, dataset_name, subject):
+        """Make sure a subject's raw files are downloaded, or raise DownloadTimeout"""
+        key = (dataset_name, subject)
+        deadline = self.deadlines.setdefault(key, time.time() + self.subject_deadline)
+
+        status = None
+        for attempt in range(self.max_attempts):
+            if time.time() > deadline:
+                status = 'deadline'
+                break
+            status = self._attempt(dataset, subject, deadline)
+            if status == 'done':
+                # Later calls for this subject (e.g. a processing retry) get a new deadline
+                del self.deadlines[key]
+                return
+            if status == 'deadline':
+                break
+            entry = {'dataset': dataset_name, 'subject': subject, 'attempt': attempt + 1}
+            if status == 'failed':
+                self.failures.append(entry)
+                print(f"Download of {dataset_name} subject {subject} failed "
+                      f"(attempt {attempt + 1}/{self.max_attempts})")
+            else:
+                self.stalls.append(entry)
+                print(f"Download of {dataset_name} subject {subject} stalled for {self.stall_timeout}s, "
+                      f"cancelled (attempt {attempt + 1}/{self.max_attempts})")
+
+        if status == 'failed':
+            raise RuntimeError(f"Download of {dataset_name} subject {subject} failed "
+                               f"after {self.max_attempts} attempts")
+        if key not in [(t['dataset'], t['subject']) for t in self.timed_out]:
+            self.timed_out.append({'dataset': dataset_name, 'subject': subject})
+        raise DownloadTimeout(f"Download of {dataset_name} subject {subject} timed out")
@@ -0,0 +1,169 @@
+import time
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from collections import deque
+from stages import current_rss
+
+
+def _worker_loop(conn, process_subject, max_subjects, max_rss, collect_records):
+    """Worker process: process subjects until told to stop or due for recycling"""
+    done = 0
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        dataset_name, subject = task
+        try:
+            process_subject(dataset_name, subject)
+            status, error = 'done', None
+        except Exception as e:
+            print(f"Error processing {dataset_name} subject {subject}: {str(e)}")
+            status, error = 'failed', str(e)
+        records = collect_records(dataset_name, subject) if collect_records is not None else None
+
+        # Retire after enough subjects or once memory has grown past the cap
+        done += 1
+        rss = current_rss()
+        reason = None
+        if max_subjects is not None and done >= max_subjects:
+            reason = 'subjects'
+        elif max_rss is not None and rss is not None and rss > max_rss:
+            reason = 'rss'
+        conn.send((status, error, rss, reason, records))
+        if reason is not None:
+            break
+    conn.close()
+
+
+class RecyclingWorkerPool:
+    """Processes (dataset, subject) units in worker processes that are regularly replaced.
+
+    A worker exits after `max_subjects` subjects or, between subjects, once
+    its resident memory exceeds `max_rss` bytes; a fresh worker takes its
+    place, so memory retained by MNE, MOABB and pandas is returned to the
+    system. With `hard_rss`, a worker growing past it in the middle of a
+    subject is terminated, and that subject (like one whose worker crashed)
+    is cleaned up with `on_interrupt` and retried in a new worker, up to
+    `max_attempts` times.
+
+    Idle workers take the next unit from the queue, so units are balanced
+    across workers whatever their cost; the time of every completed unit is
+    kept in `timings`. Workers are forked, so they inherit the pipeline's
+    configuration as set up by the parent. Whatever a worker records about a
+    subject in its own memory is lost with it unless sent back: after each
+    subject the worker calls `collect_records(dataset_name, subject)` and the
+    parent passes the (picklable) result to `merge_records`.
+    """
+
+    def __init__(self, process_subject, n_workers=1, max_subjects=None, max_rss=None, hard_rss=None,
+                 max_attempts=3, on_interrupt=None, collect_records=None, merge_records=None, poll_interval=1.):
+        self.process_subject = process_subject
+        self.n_workers = n_workers
+        self.max_subjects = max_subjects
+        self.max_rss = max_rss
+        self.hard_rss = hard_rss
+        self.max_attempts = max_attempts
+        self.on_interrupt = on_interrupt
+        self.collect_records = collect_records
+        self.merge_records = merge_records
+        self.poll_interval = poll_interval
+        self.context = mp.get_context('fork')
+        self.recycled = []
+        self.interrupted = []
+        self.failed = []
+        self.timings = []
+
+    def _start_worker(self):
+        """New worker process and the parent's end of its pipe"""
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_loop, args=(child_conn, self.process_subject, self.max_subjects,
+                                                                  self.max_rss, self.collect_records))
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': parent_conn, 'task': None}
+
+    def _stop_worker(self, worker, kill=False):
+        """Stop a worker process, terminating it if it is busy"""
+        if kill:
+            worker['process'].terminate()
+        else:
+            try:
+                worker['conn'].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        worker['process'].join()
+        worker['conn'].close()
+
+    def _interrupted(self, worker, attempts, pending, reason):
+        """Clean up and requeue the subject of a worker that did not finish it"""
+        task = worker['task']
+        self.interrupted.append({'dataset': task[0], 'subject': task[1], 'reason': reason})
+        print(f"Worker {worker['process'].pid} stopped during {task[0]} subject {task[1]} ({reason})")
+        if self.on_interrupt is not None:
+            self.on_interrupt(*task)
+        if attempts[task] < self.max_attempts:
+            pending.appendleft(task)
+        else:
+            self.failed.append({'dataset': task[0], 'subject': task[1]})
+            print(f"Giving up on {task[0]} subject {task[1]} after {attempts[task]} attempts")
+
+    def run(self, tasks):
+        """Process all (dataset_name, subject) units, in order, across the workers"""
+        pending = deque(tasks)
+        attempts = {task: 0 for task in tasks}
+        workers = []
+        try:
+            while pending or any(worker['task'] is not None for worker in workers):
+                # Keep every worker slot busy
+                while len(workers) < self.n_workers and pending:
+                    workers.append(self._start_worker())
+                for worker in workers:
+                    if worker['task'] is None and pending:
+                        worker['task'] = pending.popleft()
+                        worker['started'] = time.perf_counter()
+                        attempts[worker['task']] += 1
+                        worker['conn'].send(worker['task'])
+
+                busy = [worker for worker in workers if worker['task'] is not None]
+                ready = wait([worker['conn'] for worker in busy], timeout=self.poll_interval)
+                for worker in busy:
+                    if worker['conn'] in ready:
+                        try:
+                            status, error, rss, reason, records = worker['conn'].recv()
+                        except (EOFError, OSError):
+                            # The worker died in the middle of the subject
+                            worker['process'].join()
+                            self._interrupted(worker, attempts, pending, f"exit code {worker['process'].exitcode}")
+                            workers.remove(worker)
+                            continue
+
+                        dataset_name, subject = worker['task']
+                        self.timings.append({'dataset': dataset_name, 'subject': subject,
+                                             'seconds': time.perf_counter() - worker['started']})
+                        if status == 'failed':
+                            self.failed.append({'dataset': dataset_name, 'subject': subject, 'error': error})
+                        if records is not None and self.merge_records is not None:
+                            self.merge_records(records)
+                        worker['task'] = None
+                        if reason is not None:
+                            rss_mb = rss / 1024 ** 2 if rss is not None else None
+                            self.recycled.append({'pid': worker['process'].pid, 'reason': reason, 'rss_mb': rss_mb})
+                            worker['process'].join()
+                            worker['conn'].close()
+                            workers.remove(worker)
+
+                    elif self.hard_rss is not None:
+                        # Interrupt a subject whose worker grows past the hard cap
+                        rss = current_rss(worker['process'].pid)
+                        if rss is not None and rss > self.hard_rss:
+                            self._stop_worker(worker, kill=True)
+                            self._interrupted(worker, attempts, pending, f"{rss / 1024 ** 2:.0f} MB resident")
+                            workers.remove(worker)
+        finally:
+            for worker in workers:
+                self._stop_worker(worker, kill=worker['task'] is not None)
+
+    def report(self):
+        """Recycling, interruptions and failures, for the run report"""
+        return {'recycled': self.recycled, 'interrupted': self.interrupted, 'failed': self.failed}
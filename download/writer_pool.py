@@ -0,0 +1,112 @@
+import queue
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from outputs import write_outputs
+
+
+def _writer_loop(buffers, tasks, free, results, csv_writer):
+    """Writer process: serialize runs from shared-memory buffers to disk, reporting each run's outcome"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        idx, shape, dtype, filepath, info = task
+        data = np.ndarray(shape, dtype=dtype, buffer=buffers[idx].buf)
+        error = None
+        try:
+            write_outputs(filepath, data, info, csv_writer=csv_writer)
+        except Exception as e:
+            print(f"Error writing {filepath}: {str(e)}")
+            error = str(e)
+        finally:
+            # Give the buffer back to the compute side
+            del data
+            free.put(idx)
+        results.put((filepath, error))
+
+    for buffer in buffers:
+        buffer.close()
+
+
+class SharedMemoryWriterPool:
+    """Dedicated writer processes fed through a fixed set of shared-memory buffers.
+
+    The compute process copies each finished epochs array into a free buffer
+    and only sends the buffer index, shape and small run metadata through the
+    task queue; the signal array itself is never pickled. When all buffers
+    are in flight, submit() blocks, so memory use is bounded by
+    n_buffers * buffer_bytes.
+
+    Writers send back (filepath, error) for every run, error being None
+    once the run is written. These results are collected in submit() and
+    close() and passed to `on_written(filepath, error)` in this process.
+    """
+
+    def __init__(self, n_writers=1, n_buffers=4, buffer_bytes=512 * 1024 ** 2, csv_writer=None, on_written=None):
+        self.buffer_bytes = buffer_bytes
+        self.csv_writer = csv_writer
+        self.on_written = on_written
+        self.buffers = [shared_memory.SharedMemory(create=True, size=buffer_bytes)
+                        for _ in range(n_buffers)]
+        self.tasks = mp.Queue()
+        self.free = mp.Queue()
+        self.results = mp.Queue()
+        for idx in range(n_buffers):
+            self.free.put(idx)
+
+        self.writers = [mp.Process(target=_writer_loop,
+                                   args=(self.buffers, self.tasks, self.free, self.results, csv_writer), daemon=True)
+                        for _ in range(n_writers)]
+        for writer in self.writers:
+            writer.start()
+
+    def _acquire(self):
+        """Wait for a free buffer, failing if every writer has died"""
+        while True:
+            try:
+                return self.free.get(timeout=1)
+            except queue.Empty:
+                if not any(writer.is_alive() for writer in self.writers):
+                    raise RuntimeError("All writer processes have exited")
+
+    def _collect(self, timeout=None):
+        """Pass the results of the runs written so far to on_written (waiting up to timeout for each)"""
+        while True:
+            try:
+                filepath, error = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+            except queue.Empty:
+                return
+            if self.on_written is not None:
+                self.on_written(filepath, error)
+
+    def submit(self, filepath, data, info):
+        """Queue one run for writing; blocks while all buffers are in use"""
+        self._collect()
+        if data.nbytes > self.buffer_bytes:
+            print(f"Run is larger than a shared buffer ({data.nbytes} bytes), writing {filepath} inline")
+            write_outputs(filepath, data, info, csv_writer=self.csv_writer)
+            if self.on_written is not None:
+                self.on_written(filepath, None)
+            return
+
+        idx = self._acquire()
+        view = np.ndarray(data.shape, dtype=data.dtype, buffer=self.buffers[idx].buf)
+        view[...] = data
+        del view
+        self.tasks.put((idx, data.shape, data.dtype.str, filepath, info))
+
+    def close(self):
+        """Wait for queued runs to be written, stop the writers and free the buffers"""
+        for _ in self.writers:
+            self.tasks.put(None)
+        # Keep reading results while the writers finish, so none blocks on a full result queue
+        while any(writer.is_alive() for writer in self.writers):
+            self._collect(timeout=0.1)
+        for writer in self.writers:
+            writer.join()
+        self._collect()
+        for buffer in self.buffers:
+            buffer.close()
+            buffer.unlink()